@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Model loading: meta-device construction and memory-mapped weights vs the eager path
+===================================================================================
+
+Loads each model of a checkpoint directory (voice encoder, T3, S3Gen) the eager way (built with random init, then
+`load_state_dict(load_file(...))`) and with `meta_init` (parameters built on the meta device, then assigned the
+tensors of the memory-mapped safetensors file), reports the time of both, and checks that the loaded weights and
+buffers are identical. Run twice to see the effect of the page cache.
+
+Usage:
+    python benchmarks/bench_cold_start.py --ckpt_dir CKPT_DIR
+    python benchmarks/bench_cold_start.py --ckpt_dir CKPT_DIR --components t3 --device cuda
+"""
+
+import argparse
+import gc
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bhavesh_ai_voice_cloner.model_registry import load_s3gen, load_t3, load_ve
+
+LOADERS = dict(ve=load_ve, t3=load_t3, s3gen=load_s3gen)
+
+
+def timed_load(loader, ckpt_dir, device, meta_init):
+    t0 = time.perf_counter()
+    model = loader(ckpt_dir, device, meta_init=meta_init)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - t0, model
+
+
+def mismatches(a, b):
+    "Names of the parameters and buffers (persistent or not) that differ."
+    a_tensors = dict(a.named_parameters()) | dict(a.named_buffers())
+    b_tensors = dict(b.named_parameters()) | dict(b.named_buffers())
+    if a_tensors.keys() != b_tensors.keys():
+        return sorted(a_tensors.keys() ^ b_tensors.keys())
+    return [k for k in a_tensors if not torch.equal(a_tensors[k], b_tensors[k])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Model loading time")
+    parser.add_argument("--ckpt_dir", type=str, required=True)
+    parser.add_argument("--components", nargs="+", default=list(LOADERS), choices=list(LOADERS))
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    failed = False
+    total = dict(eager=0.0, meta=0.0)
+    print(f"{'model':>6} | {'eager':>8} | {'meta+mmap':>9} | {'speedup':>7}")
+    for name in args.components:
+        loader = LOADERS[name]
+        eager_time, eager = timed_load(loader, args.ckpt_dir, args.device, meta_init=False)
+        meta_time, meta = timed_load(loader, args.ckpt_dir, args.device, meta_init=True)
+        total["eager"] += eager_time
+        total["meta"] += meta_time
+        print(f"{name:>6} | {eager_time:7.2f}s | {meta_time:8.2f}s | {eager_time / meta_time:6.1f}x")
+        if diff := mismatches(eager, meta):
+            failed = True
+            print(f"       {len(diff)} tensors differ: {diff[:5]}")
+        del eager, meta
+        gc.collect()
+    print(f"{'total':>6} | {total['eager']:7.2f}s | {total['meta']:8.2f}s | {total['eager'] / total['meta']:6.1f}x")
+
+    if failed:
+        sys.exit("the two loading paths give different models")
+
+
+if __name__ == "__main__":
+    main()
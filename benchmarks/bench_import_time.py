@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Package import time
+===================
+
+Times, in fresh interpreters, the imports that CLI tools and workers do: the package alone (`__version__`), the
+voice conversion front-end and the TTS front-end, next to `import torch` as a reference. Each import must leave
+out the heavy modules it does not need (e.g. torch for `__version__`, T3 / transformers-Llama and the watermarker
+for `BhaveshVC`, which are imported when a model is built): exits with an error if one gets imported, or if an
+import exceeds its `--budget` in seconds. `--top` lists the slowest modules of each import (`python -X importtime`).
+
+Usage:
+    python benchmarks/bench_import_time.py
+    python benchmarks/bench_import_time.py --repeats 5 --top 10 --budget vc=8 tts=9
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+SRC_DIR = Path(__file__).parent.parent / "src"
+
+# name: (statement, modules it must not import)
+TARGETS = {
+    "torch": ("import torch", []),
+    "version": (
+        "import bhavesh_ai_voice_cloner; bhavesh_ai_voice_cloner.__version__",
+        ["torch", "numpy", "librosa", "transformers", "diffusers", "huggingface_hub"],
+    ),
+    "vc": (
+        "from bhavesh_ai_voice_cloner import BhaveshVC",
+        ["perth", "bhavesh_ai_voice_cloner.models.t3", "bhavesh_ai_voice_cloner.tts", "scipy.signal", "numba"],
+    ),
+    "tts": (
+        "from bhavesh_ai_voice_cloner import BhaveshTTS",
+        ["perth", "bhavesh_ai_voice_cloner.vc", "scipy.signal", "numba"],
+    ),
+}
+
+# reports the import time and the forbidden modules imported
+CHILD = """
+import sys, time
+t0 = time.perf_counter()
+{statement}
+print(time.perf_counter() - t0)
+print("imported:", *[m for m in {forbidden!r} if m in sys.modules])
+"""
+
+
+def run(statement, forbidden, importtime=False):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(SRC_DIR), os.environ.get("PYTHONPATH", "")]))
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", CHILD.format(statement=statement, forbidden=forbidden)]
+    out = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True)
+    seconds, imported = out.stdout.strip().split("\n")[-2:]
+    return float(seconds), imported.split()[1:], out.stderr
+
+
+def slowest_modules(importtime_log, top):
+    "The `top` modules with the largest self time in a `-X importtime` log: (seconds, name)."
+    modules = []
+    for line in importtime_log.splitlines():
+        if m := re.match(r"import time:\s+(\d+) \|\s+\d+ \|\s*(\S+)", line):
+            modules.append((int(m.group(1)) / 1e6, m.group(2)))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Package import time")
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--top", type=int, default=0, help="List the slowest modules of each import")
+    parser.add_argument("--budget", nargs="*", default=[], help="Max seconds per import, as name=seconds")
+    args = parser.parse_args()
+    budgets = {name: float(seconds) for name, seconds in (b.split("=") for b in args.budget)}
+
+    errors = []
+    print(f"{'import':>8} | {'best':>6} | {'worst':>6} | statement")
+    for name in args.targets:
+        statement, forbidden = TARGETS[name]
+        times = []
+        for _ in range(args.repeats):
+            seconds, imported, _ = run(statement, forbidden)
+            times.append(seconds)
+        print(f"{name:>8} | {min(times):5.2f}s | {max(times):5.2f}s | {statement}")
+        if imported:
+            errors.append(f"{name} imports {imported}")
+        if name in budgets and min(times) > budgets[name]:
+            errors.append(f"{name} takes {min(times):.2f}s, over its budget of {budgets[name]}s")
+        if args.top:
+            _, _, log = run(statement, forbidden, importtime=True)
+            for seconds, module in slowest_modules(log, args.top):
+                print(f"{'':>8}   {seconds:5.2f}s   {module}")
+
+    if errors:
+        sys.exit("\n".join(errors))
+
+
+if __name__ == "__main__":
+    main()
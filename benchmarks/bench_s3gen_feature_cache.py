@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+S3Gen flow decoder: mid block feature caching
+=============================================
+
+Times the CFM flow decoder (`S3Gen.flow_inference`) with `S3Gen.set_flow_feature_cache` for several reuse
+schedules, and reports the distance of each mel-spectrogram from the uncached one along with how many
+estimator calls ran in full and how much the cached residual drifted between them. Quality numbers are only
+meaningful with real weights (`--ckpt_dir`).
+
+Usage:
+    python benchmarks/bench_s3gen_feature_cache.py --ckpt_dir CKPT_DIR --audio speech.wav --ref voice.wav
+    python benchmarks/bench_s3gen_feature_cache.py --schedules 2 3 0,1,2,4,6,8 --num_shallow_blocks 0 2
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import librosa
+import numpy as np
+import torch
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bench_s3gen_solvers import load_s3gen, parse_config
+from bhavesh_ai_voice_cloner.models.s3gen import S3GEN_SR
+from bhavesh_ai_voice_cloner.models.s3tokenizer import S3_SR
+
+
+def parse_schedule(schedule):
+    "'N' (every N-th call) or 'i,j,k' (explicit call indices)"
+    if "," in schedule:
+        return [int(i) for i in schedule.split(",")]
+    return int(schedule)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="S3Gen mid block feature cache benchmark")
+    parser.add_argument("--ckpt_dir", type=str, default=None, help="Directory with s3gen.safetensors (default: random init)")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--audio", type=str, default=None, help="Speech to take the tokens from (default: random tokens)")
+    parser.add_argument("--ref", type=str, default=None, help="Reference voice (default: synthetic tone)")
+    parser.add_argument("--num_tokens", type=int, default=100, help="Number of random tokens without --audio")
+    parser.add_argument("--config", type=str, default="euler:10", help="'solver:steps' or a preset name")
+    parser.add_argument("--schedules", type=str, nargs="+", default=["2", "3"], help="'N' or comma-separated call indices")
+    parser.add_argument("--num_shallow_blocks", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--repeats", type=int, default=2)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    s3gen = load_s3gen(args.ckpt_dir, args.device)
+
+    if args.ref:
+        ref_wav, _ = librosa.load(args.ref, sr=S3GEN_SR)
+    else:
+        t = np.arange(3 * S3GEN_SR) / S3GEN_SR
+        ref_wav = (0.3 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+    ref_dict = s3gen.embed_ref(torch.from_numpy(ref_wav[:10 * S3GEN_SR]), S3GEN_SR)
+
+    if args.audio:
+        audio_16, _ = librosa.load(args.audio, sr=S3_SR)
+        speech_tokens, _ = s3gen.tokenizer(torch.from_numpy(audio_16)[None].to(args.device))
+    else:
+        speech_tokens = torch.randint(0, 6561, (1, args.num_tokens), device=args.device)
+    solver, n_timesteps, calls = parse_config(args.config)
+    print(f"{speech_tokens.size(1)} speech tokens, {args.config} ({calls} estimator calls), device {args.device}")
+
+    def run():
+        best, mels = float("inf"), None
+        for _ in range(args.repeats):
+            t0 = time.perf_counter()
+            mels = s3gen.flow_inference(speech_tokens, ref_dict=ref_dict, finalize=True, n_timesteps=n_timesteps, solver=solver)
+            best = min(best, time.perf_counter() - t0)
+        return best, mels
+
+    s3gen.set_flow_feature_cache(schedule=None)
+    ref_time, ref_mels = run()
+    print(f"{'schedule':>14} | {'shallow':>7} | {'full/reused':>11} | {'latency':>9} | {'speedup':>7} | {'mel L1':>7} | {'mel RMSE':>8} | {'drift':>6}")
+    print(f"{'off':>14} | {'-':>7} | {f'{calls}/0':>11} | {ref_time * 1000:7.0f}ms | {1:6.2f}x | {0:7.4f} | {0:8.4f} | {'-':>6}")
+    for schedule in args.schedules:
+        for num_shallow_blocks in args.num_shallow_blocks:
+            s3gen.set_flow_feature_cache(schedule=parse_schedule(schedule), num_shallow_blocks=num_shallow_blocks)
+            latency, mels = run()
+            stats = s3gen.flow.decoder.last_feature_cache
+            l1 = (mels - ref_mels).abs().mean().item()
+            rmse = (mels - ref_mels).pow(2).mean().sqrt().item()
+            drift = np.mean(stats.residual_drift) if stats.residual_drift else 0.0
+            print(
+                f"{schedule:>14} | {num_shallow_blocks:>7} | {f'{stats.num_full}/{stats.num_reused}':>11}"
+                f" | {latency * 1000:7.0f}ms | {ref_time / latency:6.2f}x | {l1:7.4f} | {rmse:8.4f} | {drift:6.3f}"
+            )
+    s3gen.set_flow_feature_cache(schedule=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+S3Gen flow decoder: eager PyTorch vs ONNX Runtime estimator
+==========================================================
+
+Exports the CFM estimator to ONNX (unless `--onnx_path` was exported from the same weights already), then times `S3Gen.flow_inference`
+with the "torch" and "onnxruntime" estimator backends, reports the mel-spectrogram difference between them,
+and measures the throughput of `--concurrency` threads sharing one backend with 1 and with N sessions.
+
+Usage:
+    python benchmarks/bench_s3gen_onnx.py --ckpt_dir CKPT_DIR
+    python benchmarks/bench_s3gen_onnx.py --num_tokens 50 150 --concurrency 4 --intra_op_num_threads 2
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bench_s3gen_solvers import load_s3gen
+from bhavesh_ai_voice_cloner.models.s3gen import S3GEN_SR
+
+
+def main():
+    parser = argparse.ArgumentParser(description="S3Gen estimator backend benchmark")
+    parser.add_argument("--ckpt_dir", type=str, default=None, help="Directory with s3gen.safetensors (default: random init)")
+    parser.add_argument("--onnx_path", type=str, default=None, help="Exported estimator (default: export to a temp dir)")
+    parser.add_argument("--num_tokens", type=int, nargs="+", default=[25, 100], help="Utterance lengths in speech tokens")
+    parser.add_argument("--concurrency", type=int, default=2, help="Number of threads for the throughput test")
+    parser.add_argument("--intra_op_num_threads", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=2)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    s3gen = load_s3gen(args.ckpt_dir, "cpu")
+    t = np.arange(3 * S3GEN_SR) / S3GEN_SR
+    ref_wav = torch.from_numpy((0.3 * np.sin(2 * np.pi * 220 * t)).astype(np.float32))
+    ref_dict = s3gen.embed_ref(ref_wav, S3GEN_SR)
+
+    onnx_path = Path(args.onnx_path or Path(tempfile.mkdtemp()) / "s3gen_estimator.onnx")
+    t0 = time.perf_counter()
+    source_fpath = Path(args.ckpt_dir) / "s3gen.safetensors" if args.ckpt_dir else None
+    backend_kwargs = dict(onnx_path=onnx_path, intra_op_num_threads=args.intra_op_num_threads, source_fpath=source_fpath)
+    s3gen.set_estimator_backend("onnxruntime", num_sessions=1, **backend_kwargs)
+    print(f"onnxruntime backend ready in {time.perf_counter() - t0:.1f}s ({onnx_path})")
+
+    def run(speech_tokens):
+        return s3gen.flow_inference(speech_tokens, ref_dict=ref_dict, finalize=True)
+
+    def timed(speech_tokens):
+        best, mels = float("inf"), None
+        for _ in range(args.repeats):
+            t0 = time.perf_counter()
+            mels = run(speech_tokens)
+            best = min(best, time.perf_counter() - t0)
+        return best, mels
+
+    print(f"{'tokens':>6} | {'torch':>9} | {'onnxruntime':>11} | {'speedup':>7} | {'mel max diff':>12}")
+    for num_tokens in args.num_tokens:
+        speech_tokens = torch.randint(0, 6561, (1, num_tokens))
+        s3gen.set_estimator_backend("torch")
+        torch_time, torch_mels = timed(speech_tokens)
+        s3gen.set_estimator_backend("onnxruntime", num_sessions=1, **backend_kwargs)
+        ort_time, ort_mels = timed(speech_tokens)
+        diff = (torch_mels - ort_mels).abs().max().item()
+        print(f"{num_tokens:>6} | {torch_time * 1000:7.0f}ms | {ort_time * 1000:9.0f}ms | {torch_time / ort_time:6.2f}x | {diff:12.2e}")
+
+    speech_tokens = torch.randint(0, 6561, (1, args.num_tokens[0]))
+    n_requests = 2 * args.concurrency
+    for num_sessions in sorted({1, args.concurrency}):
+        s3gen.set_estimator_backend("onnxruntime", num_sessions=num_sessions, **backend_kwargs)
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            t0 = time.perf_counter()
+            list(pool.map(lambda _: run(speech_tokens), range(n_requests)))
+            elapsed = time.perf_counter() - t0
+        print(f"{args.concurrency} threads, {num_sessions} session(s): {n_requests / elapsed:.2f} requests/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+S3Gen flow decoder: ODE solvers and step counts
+===============================================
+
+Times the CFM flow decoder (`S3Gen.flow_inference`) for several solver / step count settings and reports
+the distance of each mel-spectrogram from the 10-step Euler reference (the default). Speech tokens come from
+`--audio` (tokenized with the S3 tokenizer, like voice conversion) or are random.
+
+Usage:
+    python benchmarks/bench_s3gen_solvers.py --ckpt_dir CKPT_DIR --audio speech.wav --ref voice.wav
+    python benchmarks/bench_s3gen_solvers.py --configs euler:10 dpm++2m:4 heun:3 fast balanced
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import librosa
+import numpy as np
+import torch
+from safetensors.torch import load_file
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bhavesh_ai_voice_cloner.models.s3gen import S3GEN_SR, S3Gen, CFM_SOLVER_PRESETS
+from bhavesh_ai_voice_cloner.models.s3tokenizer import S3_SR
+
+DEFAULT_CONFIGS = ["euler:10", "euler:6", "euler:4", "midpoint:3", "heun:3", "dpm++2m:6", "dpm++2m:4", "dpm++2m:3"]
+
+
+def load_s3gen(ckpt_dir, device):
+    s3gen = S3Gen()
+    if ckpt_dir is not None:
+        s3gen.load_state_dict(load_file(Path(ckpt_dir) / "s3gen.safetensors"), strict=False)
+    return s3gen.to(device).eval()
+
+
+def parse_config(config):
+    "'solver:steps' or a preset name -> (solver, n_timesteps, estimator calls)"
+    if config in CFM_SOLVER_PRESETS:
+        solver, n_timesteps = CFM_SOLVER_PRESETS[config].solver, CFM_SOLVER_PRESETS[config].n_timesteps
+    else:
+        solver, n_timesteps = config.split(":")
+        n_timesteps = int(n_timesteps)
+    calls = n_timesteps * (2 if solver in ("heun", "midpoint") else 1)
+    return solver, n_timesteps, calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="S3Gen CFM solver benchmark")
+    parser.add_argument("--ckpt_dir", type=str, default=None, help="Directory with s3gen.safetensors (default: random init)")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--audio", type=str, default=None, help="Speech to take the tokens from (default: random tokens)")
+    parser.add_argument("--ref", type=str, default=None, help="Reference voice (default: synthetic tone)")
+    parser.add_argument("--num_tokens", type=int, default=100, help="Number of random tokens without --audio")
+    parser.add_argument("--configs", type=str, nargs="+", default=DEFAULT_CONFIGS, help="'solver:steps' or preset names")
+    parser.add_argument("--repeats", type=int, default=2)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    s3gen = load_s3gen(args.ckpt_dir, args.device)
+
+    if args.ref:
+        ref_wav, _ = librosa.load(args.ref, sr=S3GEN_SR)
+    else:
+        t = np.arange(3 * S3GEN_SR) / S3GEN_SR
+        ref_wav = (0.3 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+    ref_dict = s3gen.embed_ref(torch.from_numpy(ref_wav[:10 * S3GEN_SR]), S3GEN_SR)
+
+    if args.audio:
+        audio_16, _ = librosa.load(args.audio, sr=S3_SR)
+        speech_tokens, _ = s3gen.tokenizer(torch.from_numpy(audio_16)[None].to(args.device))
+    else:
+        speech_tokens = torch.randint(0, 6561, (1, args.num_tokens), device=args.device)
+    print(f"{speech_tokens.size(1)} speech tokens ({speech_tokens.size(1) / 25:.1f}s of audio), device {args.device}")
+
+    def run(solver, n_timesteps):
+        best, mels = float("inf"), None
+        for _ in range(args.repeats):
+            t0 = time.perf_counter()
+            mels = s3gen.flow_inference(speech_tokens, ref_dict=ref_dict, finalize=True, n_timesteps=n_timesteps, solver=solver)
+            best = min(best, time.perf_counter() - t0)
+        return best, mels
+
+    ref_time, ref_mels = run("euler", 10)
+    print(f"{'config':>12} | {'calls':>5} | {'latency':>9} | {'speedup':>7} | {'mel L1':>7} | {'mel RMSE':>8}")
+    for config in args.configs:
+        solver, n_timesteps, calls = parse_config(config)
+        latency, mels = run(solver, n_timesteps)
+        l1 = (mels - ref_mels).abs().mean().item()
+        rmse = (mels - ref_mels).pow(2).mean().sqrt().item()
+        print(f"{config:>12} | {calls:>5} | {latency * 1000:7.0f}ms | {ref_time / latency:6.2f}x | {l1:7.4f} | {rmse:8.4f}")
+
+
+if __name__ == "__main__":
+    main()
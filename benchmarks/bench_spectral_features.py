@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Spectral features: shared batched frontend vs the per-clip implementations
+=========================================================================
+
+Computes the four spectral features of the package with `SpectralFrontend` on a padded batch of clips of
+different lengths, and with the per-clip implementations they replace:
+    - S3 tokenizer log-mel: `S3Tokenizer.log_mel_spectrogram`
+    - S3Gen mel: `s3gen.utils.mel.mel_spectrogram`
+    - CAMPPlus fbank: `torchaudio.compliance.kaldi.fbank`
+    - voice encoder mel: `voice_encoder.melspec.melspectrogram` (numpy / librosa)
+Reports the largest difference over the valid frames of every clip (exits with an error above `--atol`,
+relative to the feature's range) and the time of both.
+
+Usage:
+    python benchmarks/bench_spectral_features.py
+    python benchmarks/bench_spectral_features.py --num_clips 32 --max_seconds 10 --device cuda
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torchaudio.compliance.kaldi as Kaldi
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bhavesh_ai_voice_cloner.models.s3gen.utils.mel import mel_spectrogram
+from bhavesh_ai_voice_cloner.models.s3tokenizer import S3_SR, S3Tokenizer
+from bhavesh_ai_voice_cloner.models.s3gen import S3GEN_SR
+from bhavesh_ai_voice_cloner.models.spectral import get_spectral_frontend
+from bhavesh_ai_voice_cloner.models.voice_encoder import VoiceEncConfig
+from bhavesh_ai_voice_cloner.models.voice_encoder.melspec import melspectrogram
+
+
+def make_clips(num_clips, min_seconds, max_seconds, sr, seed=0):
+    "Harmonic tones in noise, of random lengths."
+    rng = np.random.RandomState(seed)
+    clips = []
+    for _ in range(num_clips):
+        n = int(rng.uniform(min_seconds, max_seconds) * sr)
+        t = np.arange(n) / sr
+        f0 = rng.uniform(90, 300)
+        wav = sum(0.2 / k * np.sin(2 * np.pi * k * f0 * t) for k in range(1, 6)) + 0.02 * rng.randn(n)
+        clips.append(torch.from_numpy(wav.astype(np.float32)))
+    return clips
+
+
+def timed(fn, repeats):
+    best, out = float("inf"), None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def max_diff(reference, batch, lens, time_dim):
+    "Largest |difference| over the valid frames, and the range of the reference features."
+    diff, lo, hi = 0.0, np.inf, -np.inf
+    for i, ref in enumerate(reference):
+        ref = torch.as_tensor(ref).float()
+        got = batch[i].narrow(time_dim, 0, lens[i]).cpu()
+        assert got.shape == ref.shape, f"clip {i}: {tuple(got.shape)} vs {tuple(ref.shape)}"
+        diff = max(diff, (got - ref).abs().max().item())
+        lo, hi = min(lo, ref.min().item()), max(hi, ref.max().item())
+    return diff, hi - lo
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spectral frontend equivalence and speed")
+    parser.add_argument("--num_clips", type=int, default=8)
+    parser.add_argument("--min_seconds", type=float, default=1.0)
+    parser.add_argument("--max_seconds", type=float, default=6.0)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--atol", type=float, default=1e-4, help="Tolerance, relative to the feature range")
+    args = parser.parse_args()
+
+    frontend = get_spectral_frontend(args.device)
+    tokenizer = S3Tokenizer().to(args.device)
+    ve_hp = VoiceEncConfig()
+    clips_16 = [c.to(args.device) for c in make_clips(args.num_clips, args.min_seconds, args.max_seconds, S3_SR)]
+    clips_24 = [c.to(args.device) for c in make_clips(args.num_clips, args.min_seconds, args.max_seconds, S3GEN_SR)]
+
+    features = [
+        # name, per-clip reference, batched, time dim of the features of a clip
+        (
+            "s3 log-mel",
+            lambda: [tokenizer.log_mel_spectrogram(c) for c in clips_16],
+            lambda: frontend.s3_log_mel(clips_16),
+            1,
+        ),
+        (
+            "s3gen mel",
+            lambda: [mel_spectrogram(c)[0] for c in clips_24],
+            lambda: frontend.s3gen_mel(clips_24),
+            1,
+        ),
+        (
+            "kaldi fbank",
+            lambda: [Kaldi.fbank(c.unsqueeze(0), num_mel_bins=80) for c in clips_16],
+            lambda: frontend.kaldi_fbank(clips_16),
+            0,
+        ),
+        (
+            "ve mel",
+            lambda: [melspectrogram(c.cpu().numpy(), ve_hp) for c in clips_16],
+            lambda: frontend.ve_mel(clips_16),
+            1,
+        ),
+    ]
+
+    failed = False
+    print(f"{args.num_clips} clips of {args.min_seconds}-{args.max_seconds}s on {args.device}")
+    print(f"{'feature':>12} | {'per clip':>9} | {'batched':>9} | {'speedup':>7} | {'max diff':>9} | {'rel diff':>9}")
+    for name, reference_fn, batched_fn, time_dim in features:
+        reference_time, reference = timed(reference_fn, args.repeats)
+        batched_time, (batch, lens) = timed(batched_fn, args.repeats)
+        diff, value_range = max_diff(reference, batch, lens.tolist(), time_dim)
+        rel_diff = diff / value_range
+        failed |= rel_diff > args.atol
+        print(
+            f"{name:>12} | {reference_time * 1000:7.1f}ms | {batched_time * 1000:7.1f}ms | "
+            f"{reference_time / batched_time:6.2f}x | {diff:9.2e} | {rel_diff:9.2e}"
+        )
+
+    # the S3 tokenizer and the voice encoder share one STFT
+    shared_time, _ = timed(lambda: (frontend.ve_mel(spec=(spec := frontend.power_spectrogram(clips_16))), frontend.s3_log_mel(spec=spec)), args.repeats)
+    separate_time, _ = timed(lambda: (frontend.ve_mel(clips_16), frontend.s3_log_mel(clips_16)), args.repeats)
+    print(f"s3 log-mel + ve mel: {separate_time * 1000:.1f}ms with 2 STFTs, {shared_time * 1000:.1f}ms with one")
+
+    if failed:
+        sys.exit(f"features differ by more than {args.atol} (relative)")
+
+
+if __name__ == "__main__":
+    main()
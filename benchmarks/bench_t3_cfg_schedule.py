@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+T3 CFG schedules: speed and quality against constant CFG
+========================================================
+
+Synthesizes each text with every CFG schedule (`T3CFGSchedule`), from the same seed, and reports:
+    * speed: T3 decode tokens/s, and the number of tokens sampled with CFG (the rest decode at batch 1)
+    * length: the number of speech tokens (a schedule that lets the speech ramble shows up here first)
+    * speaker similarity: cosine of the voice encoder embedding of the audio and the conditioning speaker embedding
+    * audio: L1 distance of the time-averaged log-mel spectra to the constant-CFG audio, next to the same distance
+      between two constant-CFG samples of different seeds (the sampling noise floor; S3Gen renders with noise, so
+      even the constant schedule is not at 0)
+Needs real weights: a randomly initialized T3 never samples the stop token.
+
+Usage:
+    python benchmarks/bench_t3_cfg_schedule.py --ckpt_dir CKPT_DIR
+    python benchmarks/bench_t3_cfg_schedule.py --ckpt_dir CKPT_DIR --schedules constant cutoff:50 alignment --save_dir out/
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torchaudio as ta
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bhavesh_ai_voice_cloner.tts import BhaveshTTS
+from bhavesh_ai_voice_cloner.models.s3tokenizer import S3_SR
+from bhavesh_ai_voice_cloner.models.s3gen.utils.mel import mel_spectrogram
+from bhavesh_ai_voice_cloner.models.voice_encoder import VoiceEncoder
+
+DEFAULT_TEXTS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "Guidance matters most at the start of an utterance, where the voice and the prosody are set.",
+    "Please call Stella and ask her to bring these things with her from the store.",
+]
+DEFAULT_SCHEDULES = ["constant", "linear:100", "cutoff:25", "cutoff:50", "alignment"]
+
+
+@torch.inference_mode()
+def sample(tts, text_tokens, seed, max_new_tokens, cfg_weight, cfg_schedule):
+    "Speech tokens (1D, with the stop token if sampled), decode tokens/s and the number of tokens sampled with CFG."
+    text_tokens = torch.cat([text_tokens, text_tokens])
+    torch.manual_seed(seed)
+    session = tts.t3.decode_engine.session(
+        t3_cond=tts.conds.t3, text_tokens=text_tokens, max_new_tokens=max_new_tokens, cfg_weight=cfg_weight,
+        cfg_schedule=cfg_schedule,
+    )
+    t0 = time.perf_counter()
+    for _ in session:
+        pass
+    speech_tokens = session.generated_ids[0, 1:]
+    n_cfg = speech_tokens.numel() if session.uncond_dropped_at is None else session.uncond_dropped_at
+    return speech_tokens, speech_tokens.numel() / (time.perf_counter() - t0), n_cfg
+
+
+def mean_log_mel(wav):
+    return mel_spectrogram(torch.as_tensor(wav).view(1, -1)).mean(dim=-1)  # (1, n_mels)
+
+
+def speaker_similarity(tts, wav):
+    wav_16k = ta.functional.resample(torch.as_tensor(wav).view(-1), tts.sr, S3_SR)
+    embed = tts.ve.embeds_from_wavs([wav_16k.numpy()], sample_rate=S3_SR, as_spk=True)
+    return float(VoiceEncoder.voice_similarity(embed, tts.conds.t3.speaker_emb.view(-1).cpu().numpy()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T3 CFG schedules, speed and quality against constant CFG")
+    parser.add_argument("--ckpt_dir", type=str, required=True)
+    parser.add_argument("--audio_prompt", type=str, default=None, help="Reference voice (default: built-in voice)")
+    parser.add_argument("--texts", type=str, nargs="+", default=DEFAULT_TEXTS)
+    parser.add_argument("--schedules", type=str, nargs="+", default=DEFAULT_SCHEDULES)
+    parser.add_argument("--max_new_tokens", type=int, default=1000)
+    parser.add_argument("--cfg_weight", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save_dir", type=str, default=None, help="Write the synthesized wavs here")
+    args = parser.parse_args()
+
+    tts = BhaveshTTS.from_local(args.ckpt_dir, "cpu")
+    if args.audio_prompt:
+        tts.prepare_conditionals(args.audio_prompt)
+
+    save_dir = Path(args.save_dir) if args.save_dir else None
+    if save_dir is not None:
+        save_dir.mkdir(parents=True, exist_ok=True)
+
+    print(f"{'text':>4} | {'schedule':>12} | {'tok/s':>6} | {'CFG tokens':>10} | {'tokens':>6} | {'spk sim':>7} | {'mel L1':>6} | {'floor':>6}")
+    for i, text in enumerate(args.texts):
+        text_tokens = tts._text_to_tokens(text)
+        tokens_ref, _, _ = sample(tts, text_tokens, args.seed, args.max_new_tokens, args.cfg_weight, "constant")
+        tokens_b, _, _ = sample(tts, text_tokens, args.seed + 1, args.max_new_tokens, args.cfg_weight, "constant")
+        reference = mean_log_mel(tts._speech_tokens_to_wav(tokens_ref))
+        floor_l1 = (reference - mean_log_mel(tts._speech_tokens_to_wav(tokens_b))).abs().mean().item()
+        for schedule in args.schedules:
+            tokens, speed, n_cfg = sample(tts, text_tokens, args.seed, args.max_new_tokens, args.cfg_weight, schedule)
+            wav = tts._speech_tokens_to_wav(tokens)
+            mel_l1 = (mean_log_mel(wav) - reference).abs().mean().item()
+            print(
+                f"{i:>4} | {schedule:>12} | {speed:6.1f} | {n_cfg:10d} | {tokens.numel():6d} | {speaker_similarity(tts, wav):7.3f} |"
+                f" {mel_l1:6.3f} | {floor_l1:6.3f}"
+            )
+            if save_dir is not None:
+                ta.save(str(save_dir / f"{i}_{schedule.replace(':', '_')}.wav"), torch.as_tensor(wav).view(1, -1), tts.sr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+T3 decode throughput: legacy path vs lean decode path vs lean + static KV cache
+===============================================================================
+
+The legacy path is what `T3.inference` used to do every step: `output_attentions=True` (eager attention in all
+layers), `output_hidden_states=True` and speech logits for every position. The lean path keeps SDPA, skips the
+hidden state tuple and only projects the last position. The static variant also swaps the concatenating
+`DynamicCache` for a preallocated `T3StaticCache`; the median and worst per-token step time show how steady
+decoding is as the cache grows.
+
+Usage:
+    python benchmarks/bench_t3_decode.py                        # random weights (speed only)
+    python benchmarks/bench_t3_decode.py --ckpt_dir CKPT_DIR     # real T3 weights
+    python benchmarks/bench_t3_decode.py --steps 1000 --cfg_weight 0
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+from safetensors.torch import load_file
+from transformers import DynamicCache
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bhavesh_ai_voice_cloner.models.t3 import T3
+from bhavesh_ai_voice_cloner.models.t3.inference import T3HuggingfaceBackend, T3StaticCache
+from bhavesh_ai_voice_cloner.models.t3.modules.cond_enc import T3Cond
+
+
+def load_t3(ckpt_dir, device):
+    t3 = T3()
+    if ckpt_dir is not None:
+        t3_state = load_file(Path(ckpt_dir) / "t3_cfg.safetensors")
+        if "model" in t3_state.keys():
+            t3_state = t3_state["model"][0]
+        t3.load_state_dict(t3_state)
+    return t3.to(device).eval()
+
+
+def dummy_inputs(t3, text_len, cfg_weight):
+    hp = t3.hp
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, hp.speaker_embed_size),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, hp.speech_cond_prompt_len)),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    ).to(device=t3.device)
+    text_tokens = torch.randint(1, hp.text_tokens_dict_size - 1, (1, text_len))
+    text_tokens[:, 0] = hp.start_text_token
+    text_tokens[:, -1] = hp.stop_text_token
+    text_tokens = text_tokens.to(t3.device)
+    if cfg_weight > 0:
+        text_tokens = torch.cat([text_tokens, text_tokens])
+    return t3_cond, text_tokens
+
+
+@torch.inference_mode()
+def run_decode(t3, backend, inputs_embeds, steps, lean, static=False):
+    "Prefill, then `steps` greedy decode steps. Returns (prefill seconds, per-step decode seconds)."
+    B = inputs_embeds.size(0)
+    if static:
+        past = T3StaticCache(t3.cfg, B, inputs_embeds.size(1) + steps, device=t3.device, dtype=inputs_embeds.dtype)
+    else:
+        past = DynamicCache()
+    if lean:
+        step_kwargs = dict(output_attentions=False, output_hidden_states=False, num_logits_to_keep=1)
+    else:
+        step_kwargs = dict(output_attentions=True, output_hidden_states=True)
+
+    t0 = time.perf_counter()
+    output = backend(inputs_embeds=inputs_embeds, past_key_values=past, use_cache=True, **step_kwargs)
+    past = output.past_key_values
+    prefill_s = time.perf_counter() - t0
+
+    step_s = []
+    for i in range(steps):
+        t0 = time.perf_counter()
+        next_token = output.logits[:1, -1, :].argmax(dim=-1, keepdim=True)  # (1, 1)
+        next_token_embed = t3.speech_emb(next_token) + t3.speech_pos_emb.get_fixed_embedding(i + 1)
+        output = backend(inputs_embeds=next_token_embed.expand(B, -1, -1), past_key_values=past, **step_kwargs)
+        past = output.past_key_values
+        step_s.append(time.perf_counter() - t0)
+    return prefill_s, step_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T3 decode throughput, legacy vs lean vs static KV cache")
+    parser.add_argument("--ckpt_dir", type=str, default=None, help="Directory with t3_cfg.safetensors (default: random init)")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--text_len", type=int, default=64, help="Number of text tokens")
+    parser.add_argument("--steps", type=int, default=100, help="Decode steps per run")
+    parser.add_argument("--cfg_weight", type=float, default=0.5, help="> 0 decodes the CFG pair (batch 2)")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    t3 = load_t3(args.ckpt_dir, args.device)
+    backend = T3HuggingfaceBackend(
+        config=t3.cfg,
+        llama=t3.tfmr,
+        speech_enc=t3.speech_emb,
+        speech_head=t3.speech_head,
+    )
+    t3_cond, text_tokens = dummy_inputs(t3, args.text_len, args.cfg_weight)
+    with torch.inference_mode():
+        inputs_embeds, _ = t3.prepare_inference_embeds(t3_cond=t3_cond, text_tokens=text_tokens, cfg_weight=args.cfg_weight)
+
+    print(f"prefill length {inputs_embeds.size(1)}, batch {inputs_embeds.size(0)}, {args.steps} steps, device {args.device}")
+    run_decode(t3, backend, inputs_embeds, 2, lean=True)  # warmup
+
+    results = {}
+    for name, lean, static in [("legacy", False, False), ("lean", True, False), ("static", True, True)]:
+        best_prefill, best_steps = float("inf"), None
+        for _ in range(args.repeats):
+            prefill_s, step_s = run_decode(t3, backend, inputs_embeds, args.steps, lean=lean, static=static)
+            best_prefill = min(best_prefill, prefill_s)
+            if best_steps is None or sum(step_s) < sum(best_steps):
+                best_steps = step_s
+        results[name] = args.steps / sum(best_steps)
+        step_ms = sorted(s * 1000 for s in best_steps)
+        print(
+            f"{name:>8}: prefill {best_prefill * 1000:7.1f} ms | decode {results[name]:6.2f} tokens/s"
+            f" | step median {step_ms[len(step_ms) // 2]:6.1f} ms, max {step_ms[-1]:6.1f} ms"
+        )
+
+    print(f"speedup lean vs legacy: {results['lean'] / results['legacy']:.2f}x")
+    print(f"speedup static vs lean: {results['static'] / results['lean']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
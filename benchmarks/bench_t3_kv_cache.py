@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+T3 KV cache storage: fp32 (static) vs fp16 vs int8
+==================================================
+
+Reports the KV cache memory of one generation stream (conditioning prompt + text + speech tokens, both rows of
+the CFG pair) in each storage format and how many streams fit in a RAM budget, then decodes the same requests
+with each format and compares the sampled speech tokens to the fp32 cache: the share of equal tokens and the
+first position where they differ, greedy and sampled from the same seed, and the decode speed.
+
+Usage:
+    python benchmarks/bench_t3_kv_cache.py                        # random weights (memory and speed only)
+    python benchmarks/bench_t3_kv_cache.py --ckpt_dir CKPT_DIR     # real T3 weights, for the token agreement
+    python benchmarks/bench_t3_kv_cache.py --speech_tokens 1000 --steps 300 --ram_gb 16
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bhavesh_ai_voice_cloner.model_registry import load_t3
+from bhavesh_ai_voice_cloner.models.t3 import T3
+from bhavesh_ai_voice_cloner.models.t3.inference.kv_cache import new_static_cache
+from bhavesh_ai_voice_cloner.models.t3.modules.cond_enc import T3Cond
+
+KV_CACHES = ["static", "fp16", "int8"]
+
+
+def dummy_inputs(t3, text_len):
+    hp = t3.hp
+    t3_cond = T3Cond(
+        speaker_emb=torch.randn(1, hp.speaker_embed_size),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, hp.speech_cond_prompt_len)),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    ).to(device=t3.device)
+    text_tokens = torch.randint(1, hp.text_tokens_dict_size - 1, (1, text_len))
+    text_tokens[:, 0] = hp.start_text_token
+    text_tokens[:, -1] = hp.stop_text_token
+    return t3_cond, text_tokens.to(t3.device)
+
+
+def agreement(tokens, reference):
+    "(share of equal tokens over the reference length, first differing position or None)"
+    n = min(tokens.numel(), reference.numel())
+    differ = (tokens[:n] != reference[:n]).nonzero()
+    if len(differ) > 0:
+        first_diff = differ[0].item()
+    else:
+        first_diff = n if tokens.numel() != reference.numel() else None
+    return (n - len(differ)) / max(reference.numel(), 1), first_diff
+
+
+@torch.inference_mode()
+def decode(t3, t3_cond, text_tokens, kv_cache, steps, cfg_weight, greedy, seed):
+    if cfg_weight > 0:
+        text_tokens = torch.cat([text_tokens, text_tokens])
+    sampling = dict(min_p=1.0, repetition_penalty=1.0) if greedy else {}
+    torch.manual_seed(seed)
+    t0 = time.perf_counter()
+    tokens = t3.inference(
+        t3_cond=t3_cond, text_tokens=text_tokens, max_new_tokens=steps, cfg_weight=cfg_weight, kv_cache=kv_cache, **sampling,
+    )[0]
+    return tokens, tokens.numel() / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T3 KV cache storage formats, memory and token agreement")
+    parser.add_argument("--ckpt_dir", type=str, default=None, help="Directory with t3_cfg.safetensors (default: random init)")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--text_len", type=int, default=64, help="Number of text tokens")
+    parser.add_argument("--speech_tokens", type=int, default=1000, help="Speech tokens of the stream sized for memory")
+    parser.add_argument("--steps", type=int, default=100, help="Decode steps of the agreement runs")
+    parser.add_argument("--cfg_weight", type=float, default=0.5)
+    parser.add_argument("--ram_gb", type=float, default=8.0, help="RAM budget for the KV caches of concurrent streams")
+    parser.add_argument("--seeds", type=int, default=2, help="Sampled runs per format")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    t3 = load_t3(args.ckpt_dir, args.device) if args.ckpt_dir else T3().to(args.device).eval()
+    hp = t3.hp
+    n_rows = 2 if args.cfg_weight > 0 else 1
+    stream_len = hp.speech_cond_prompt_len + 2 + args.text_len + args.speech_tokens
+
+    print(f"stream of {stream_len} tokens ({hp.speech_cond_prompt_len} prompt, {args.text_len} text, {args.speech_tokens} speech), {n_rows} rows")
+    print(f"{'kv_cache':>8} | {'MB/stream':>9} | {'scratch MB':>10} | streams in {args.ram_gb:g} GB")
+    for kv_cache in KV_CACHES:
+        cache = new_static_cache(t3.cfg, n_rows, stream_len, device=args.device, kv_cache=kv_cache)
+        scratch = getattr(cache, "scratch_nbytes", 0)
+        print(f"{kv_cache:>8} | {cache.nbytes / 2**20:9.1f} | {scratch / 2**20:10.1f} | {int(args.ram_gb * 2**30 // (cache.nbytes + scratch))}")
+        del cache
+
+    t3_cond, text_tokens = dummy_inputs(t3, args.text_len)
+    runs = [("greedy", True, 0)] + [(f"seed {seed}", False, seed) for seed in range(args.seeds)]
+    print(f"\n{'kv_cache':>8} | {'run':>7} | {'tokens/s':>8} | {'same tokens':>11} | first difference")
+    for name, greedy, seed in runs:
+        reference, speed = decode(t3, t3_cond, text_tokens, "static", args.steps, args.cfg_weight, greedy, seed)
+        print(f"{'static':>8} | {name:>7} | {speed:8.2f} | {'':>11} |")
+        for kv_cache in KV_CACHES[1:]:
+            tokens, speed = decode(t3, t3_cond, text_tokens, kv_cache, args.steps, args.cfg_weight, greedy, seed)
+            same, first_diff = agreement(tokens, reference)
+            print(f"{kv_cache:>8} | {name:>7} | {speed:8.2f} | {same:11.1%} | {'-' if first_diff is None else first_diff}")
+
+
+if __name__ == "__main__":
+    main()
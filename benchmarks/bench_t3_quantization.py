@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+T3 int8 quantization: speed and accuracy against fp32
+=====================================================
+
+Loads T3 in fp32 and with `t3_quantization` (the pre-quantized checkpoint is written on the first run), then
+for each text:
+    * speed: decode tokens/s of `T3.inference` with both models, from the same seed
+    * speech-token distributions: the fp32 sample is scored by both models (teacher forcing, no CFG): mean
+      KL(fp32 || int8) per token and agreement of their most likely tokens
+    * audio: the S3Gen renderings of both samples, compared by the L1 distance of their time-averaged log-mel
+      spectra, next to the same distance between two fp32 samples of different seeds (the sampling noise floor)
+Needs real weights: a randomly initialized T3 has near-uniform distributions and never samples the stop token.
+
+Usage:
+    python benchmarks/bench_t3_quantization.py --ckpt_dir CKPT_DIR
+    python benchmarks/bench_t3_quantization.py --ckpt_dir CKPT_DIR --audio_prompt voice.wav --save_dir out/
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+import torchaudio as ta
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bhavesh_ai_voice_cloner.tts import BhaveshTTS
+from bhavesh_ai_voice_cloner.models.s3gen.utils.mel import mel_spectrogram
+
+DEFAULT_TEXTS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "Quantized weights cut the memory traffic of every decoding step, which is what bounds speed on a CPU.",
+    "Please call Stella and ask her to bring these things with her from the store.",
+]
+
+
+@torch.inference_mode()
+def sample(tts, text_tokens, seed, max_new_tokens, cfg_weight):
+    "Speech tokens (1D, with the stop token if sampled) and decode tokens/s."
+    if cfg_weight > 0:
+        text_tokens = torch.cat([text_tokens, text_tokens])
+    torch.manual_seed(seed)
+    t0 = time.perf_counter()
+    speech_tokens = tts.t3.inference(
+        t3_cond=tts.conds.t3, text_tokens=text_tokens, max_new_tokens=max_new_tokens, cfg_weight=cfg_weight,
+    )[0]
+    return speech_tokens, speech_tokens.numel() / (time.perf_counter() - t0)
+
+
+@torch.inference_mode()
+def teacher_forced_log_probs(t3, t3_cond, text_tokens, speech_tokens):
+    "(T, vocab) log-probabilities of each speech token given the previous ones."
+    speech_tokens = F.pad(speech_tokens[None], (1, 0), value=t3.hp.start_speech_token)
+    speech_logits = t3(
+        t3_cond=t3_cond,
+        text_tokens=text_tokens,
+        text_token_lens=torch.tensor([text_tokens.size(1)]),
+        speech_tokens=speech_tokens,
+        speech_token_lens=torch.tensor([speech_tokens.size(1)]),
+    ).speech_logits
+    return speech_logits[0, :-1].float().log_softmax(dim=-1)
+
+
+def mean_log_mel(wav):
+    return mel_spectrogram(torch.as_tensor(wav).view(1, -1)).mean(dim=-1)  # (1, n_mels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T3 int8 quantization, speed and accuracy against fp32")
+    parser.add_argument("--ckpt_dir", type=str, required=True)
+    parser.add_argument("--quantization", type=str, default="int8")
+    parser.add_argument("--audio_prompt", type=str, default=None, help="Reference voice (default: built-in voice)")
+    parser.add_argument("--texts", type=str, nargs="+", default=DEFAULT_TEXTS)
+    parser.add_argument("--max_new_tokens", type=int, default=1000)
+    parser.add_argument("--cfg_weight", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save_dir", type=str, default=None, help="Write the synthesized wavs here")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    fp32 = BhaveshTTS.from_local(args.ckpt_dir, "cpu")
+    fp32_load = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    quantized = BhaveshTTS.from_local(args.ckpt_dir, "cpu", t3_quantization=args.quantization)
+    quantized_load = time.perf_counter() - t0
+    if args.audio_prompt:
+        fp32.prepare_conditionals(args.audio_prompt)
+        quantized.conds = fp32.conds
+    print(f"load: fp32 {fp32_load:.1f}s, {args.quantization} {quantized_load:.1f}s (S3Gen and VE are shared)")
+
+    save_dir = Path(args.save_dir) if args.save_dir else None
+    if save_dir is not None:
+        save_dir.mkdir(parents=True, exist_ok=True)
+
+    print(f"{'text':>4} | {'fp32 tok/s':>10} | {'int8 tok/s':>10} | {'KL':>7} | {'top-1':>6} | {'mel L1':>6} | {'fp32 floor':>10} | tokens fp32 / q / fp32'")
+    for i, text in enumerate(args.texts):
+        text_tokens = fp32._text_to_tokens(text)
+        tokens_fp32, speed_fp32 = sample(fp32, text_tokens, args.seed, args.max_new_tokens, args.cfg_weight)
+        tokens_q, speed_q = sample(quantized, text_tokens, args.seed, args.max_new_tokens, args.cfg_weight)
+        tokens_fp32_b, _ = sample(fp32, text_tokens, args.seed + 1, args.max_new_tokens, args.cfg_weight)
+
+        log_p = teacher_forced_log_probs(fp32.t3, fp32.conds.t3, text_tokens, tokens_fp32)
+        log_q = teacher_forced_log_probs(quantized.t3, fp32.conds.t3, text_tokens, tokens_fp32)
+        kl = (log_p.exp() * (log_p - log_q)).sum(dim=-1).mean().item()
+        top1 = (log_p.argmax(dim=-1) == log_q.argmax(dim=-1)).float().mean().item()
+
+        wavs = {name: fp32._speech_tokens_to_wav(tokens) for name, tokens in [("fp32", tokens_fp32), ("q", tokens_q), ("fp32_b", tokens_fp32_b)]}
+        mel_l1 = (mean_log_mel(wavs["fp32"]) - mean_log_mel(wavs["q"])).abs().mean().item()
+        floor_l1 = (mean_log_mel(wavs["fp32"]) - mean_log_mel(wavs["fp32_b"])).abs().mean().item()
+        print(
+            f"{i:>4} | {speed_fp32:10.1f} | {speed_q:10.1f} | {kl:7.4f} | {top1:6.1%} | {mel_l1:6.3f} | {floor_l1:10.3f} |"
+            f" {tokens_fp32.numel()} / {tokens_q.numel()} / {tokens_fp32_b.numel()}"
+        )
+        if save_dir is not None:
+            for name, wav in wavs.items():
+                ta.save(str(save_dir / f"{i}_{name}.wav"), torch.as_tensor(wav).view(1, -1), fp32.sr)
+
+
+if __name__ == "__main__":
+    main()
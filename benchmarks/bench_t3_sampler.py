@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+T3 per-step sampling overhead: HF logits processors vs the fused `T3Sampler`
+============================================================================
+
+Times everything a T3 decode step does besides the transformer, on fixed random logits: CFG, temperature,
+repetition penalty, min_p, top_p, sampling, recording the token and embedding it for the next step. The legacy
+path is what `T3.inference` used to do (`RepetitionPenaltyLogitsProcessor` / `MinPLogitsWarper` /
+`TopPLogitsWarper`, `torch.cat` of the generated ids, `get_fixed_embedding` per step); the fused path is
+`T3Sampler` with its token buffer and the position embedding table. Also checks that both sample the same
+tokens from the same seed, and times a batch of rows with different parameters.
+
+Usage:
+    python benchmarks/bench_t3_sampler.py
+    python benchmarks/bench_t3_sampler.py --steps 1000 --top_p 0.9 --batch_size 8
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+from transformers.generation.logits_process import MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bhavesh_ai_voice_cloner.models.t3.inference import T3Sampler
+from bhavesh_ai_voice_cloner.models.t3.modules.learned_pos_emb import LearnedPositionEmbeddings
+from bhavesh_ai_voice_cloner.models.t3.modules.t3_config import T3Config
+
+
+def make_logits(steps, n_rows, vocab_size, scale):
+    "Per-step (n_rows, vocab) logits, peaked enough for min_p / top_p to keep a few tokens."
+    return [scale * torch.randn(n_rows, vocab_size) for _ in range(steps)]
+
+
+@torch.inference_mode()
+def run_legacy(logits_seq, speech_emb, pos_emb, hp, args):
+    processors = (
+        RepetitionPenaltyLogitsProcessor(penalty=float(args.repetition_penalty)),
+        MinPLogitsWarper(min_p=args.min_p),
+        TopPLogitsWarper(top_p=args.top_p),
+    )
+    generated_ids = torch.tensor([[hp.start_speech_token]], dtype=torch.long)
+    for i, logits in enumerate(logits_seq):
+        if args.cfg_weight > 0.0:
+            logits = logits[0:1] + args.cfg_weight * (logits[0:1] - logits[1:2])
+        if args.temperature != 1.0:
+            logits = logits / args.temperature
+        logits = processors[0](generated_ids, logits)
+        logits = processors[1](None, logits)
+        logits = processors[2](None, logits)
+        next_token = torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1)
+        generated_ids = torch.cat([generated_ids, next_token], dim=1)
+        next_token_embed = speech_emb(next_token) + pos_emb.get_fixed_embedding(i + 1)
+        if args.cfg_weight > 0.0:
+            next_token_embed = torch.cat([next_token_embed, next_token_embed])
+    return generated_ids[:, 1:]
+
+
+@torch.inference_mode()
+def run_fused(logits_seq, speech_emb, pos_emb, hp, args, batch_size=1, **row_params):
+    params = dict(temperature=args.temperature, min_p=args.min_p, top_p=args.top_p, repetition_penalty=args.repetition_penalty)
+    sampler = T3Sampler(
+        hp.speech_tokens_dict_size,
+        len(logits_seq),
+        hp.start_speech_token,
+        batch_size=batch_size,
+        cfg_weight=args.cfg_weight,
+        **(params | row_params),
+    )
+    pos_table = pos_emb.emb.weight
+    n_rows = logits_seq[0].size(0)
+    for i, logits in enumerate(logits_seq):
+        next_token = sampler.sample(logits)
+        next_token_embed = speech_emb(next_token) + pos_table[i + 1]
+        if args.cfg_weight > 0.0:
+            next_token_embed = next_token_embed.repeat(n_rows // batch_size, 1, 1)
+    return sampler.generated_ids[:, 1:]
+
+
+def timed(fn, repeats):
+    best, result = float("inf"), None
+    for _ in range(repeats):
+        torch.manual_seed(0)
+        t0 = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T3 per-step sampling overhead, HF processors vs T3Sampler")
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--temperature", type=float, default=0.8)
+    parser.add_argument("--min_p", type=float, default=0.05)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--repetition_penalty", type=float, default=1.2)
+    parser.add_argument("--cfg_weight", type=float, default=0.5)
+    parser.add_argument("--logit_scale", type=float, default=4.0, help="Std of the random logits")
+    parser.add_argument("--batch_size", type=int, default=4, help="Rows of the per-row parameter run")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    hp = T3Config()
+    speech_emb = torch.nn.Embedding(hp.speech_tokens_dict_size, hp.n_channels).eval()
+    pos_emb = LearnedPositionEmbeddings(hp.max_speech_tokens + 4, hp.n_channels).eval()
+    n_rows = 2 if args.cfg_weight > 0 else 1
+    logits_seq = make_logits(args.steps, n_rows, hp.speech_tokens_dict_size, args.logit_scale)
+
+    legacy_s, legacy_tokens = timed(lambda: run_legacy(logits_seq, speech_emb, pos_emb, hp, args), args.repeats)
+    fused_s, fused_tokens = timed(lambda: run_fused(logits_seq, speech_emb, pos_emb, hp, args), args.repeats)
+    agreement = (legacy_tokens == fused_tokens).float().mean().item()
+
+    print(f"{args.steps} steps, vocab {hp.speech_tokens_dict_size}, top_p {args.top_p}, min_p {args.min_p}, cfg {args.cfg_weight}")
+    print(f"{'legacy':>8}: {legacy_s / args.steps * 1e6:8.1f} us/step")
+    print(f"{'fused':>8}: {fused_s / args.steps * 1e6:8.1f} us/step ({legacy_s / fused_s:.2f}x)")
+    print(f"same tokens: {agreement:.1%}")
+
+    # one sampler for a batch of rows with their own parameters, vs a sampler per row
+    B = args.batch_size
+    batch_logits = make_logits(args.steps, n_rows * B, hp.speech_tokens_dict_size, args.logit_scale)
+    row_params = dict(
+        temperature=torch.linspace(0.6, 1.0, B).tolist(),
+        min_p=torch.linspace(0.0, 0.1, B).tolist(),
+        top_p=torch.linspace(0.8, 1.0, B).tolist(),
+    )
+    batched_s, _ = timed(lambda: run_fused(batch_logits, speech_emb, pos_emb, hp, args, batch_size=B, **row_params), args.repeats)
+
+    def per_row():
+        for b in range(B):
+            rows = [logits[b::B] for logits in batch_logits]
+            run_fused(rows, speech_emb, pos_emb, hp, args, **{k: v[b] for k, v in row_params.items()})
+
+    per_row_s, _ = timed(per_row, args.repeats)
+    print(f"{B} rows with per-row parameters: batched {batched_s / args.steps * 1e6:8.1f} us/step,"
+          f" one sampler per row {per_row_s / args.steps * 1e6:8.1f} us/step")
+
+    if agreement < 1.0:
+        sys.exit("the fused sampler samples different tokens")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+T3 speculative decoding: tokens/s and draft acceptance rate
+===========================================================
+
+Decodes with the regular sampler, then with `T3SpeculativeDecoder` using early-layer drafts of
+a few depths and the n-gram draft. Acceptance rates are only meaningful with real weights (`--ckpt_dir`):
+a randomly initialized model has no agreement between its early and final layers.
+
+Usage:
+    python benchmarks/bench_t3_speculative.py --ckpt_dir CKPT_DIR
+    python benchmarks/bench_t3_speculative.py --ckpt_dir CKPT_DIR --draft_layers 4 8 12 --num_draft_tokens 3
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bench_t3_decode import load_t3, dummy_inputs
+from bhavesh_ai_voice_cloner.models.t3.inference import T3PrefixCache, T3SpeculativeDecoder
+
+
+def run(t3, t3_cond, text_tokens, args, speculative=None, prefix_cache=None):
+    "(tokens/s, `T3SpeculativeStats` of the generation or None)"
+    torch.manual_seed(args.seed)
+    t0 = time.perf_counter()
+    session = t3.decode_engine.session(
+        t3_cond=t3_cond,
+        text_tokens=text_tokens,
+        max_new_tokens=args.max_new_tokens,
+        temperature=args.temperature,
+        cfg_weight=args.cfg_weight,
+        prefix_cache=prefix_cache,
+        speculative=speculative,
+    )
+    n_tokens = sum(tokens.size(1) for tokens in session)
+    return n_tokens / (time.perf_counter() - t0), session.speculative_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="T3 speculative decoding benchmark")
+    parser.add_argument("--ckpt_dir", type=str, default=None, help="Directory with t3_cfg.safetensors (default: random init)")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--text_len", type=int, default=64, help="Number of text tokens")
+    parser.add_argument("--max_new_tokens", type=int, default=100)
+    parser.add_argument("--cfg_weight", type=float, default=0.5)
+    parser.add_argument("--temperature", type=float, default=0.8)
+    parser.add_argument("--num_draft_tokens", type=int, default=4)
+    parser.add_argument("--draft_layers", type=int, nargs="+", default=[6, 10])
+    parser.add_argument("--ngram_size", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    t3 = load_t3(args.ckpt_dir, args.device)
+    t3_cond, text_tokens = dummy_inputs(t3, args.text_len, args.cfg_weight)
+    prefix_cache = T3PrefixCache()
+
+    with torch.inference_mode():
+        baseline, _ = run(t3, t3_cond, text_tokens, args, prefix_cache=prefix_cache)
+        print(f"{'regular':>12}: {baseline:6.2f} tokens/s")
+
+        drafts = [dict(draft="layers", draft_layers=n) for n in args.draft_layers]
+        drafts.append(dict(draft="ngram", ngram_size=args.ngram_size))
+        for kwargs in drafts:
+            speculative = T3SpeculativeDecoder(t3, num_draft_tokens=args.num_draft_tokens, **kwargs)
+            tokens_per_s, stats = run(t3, t3_cond, text_tokens, args, speculative=speculative, prefix_cache=prefix_cache)
+            name = f"layers {kwargs['draft_layers']}" if kwargs["draft"] == "layers" else f"{args.ngram_size}-gram"
+            print(
+                f"{name:>12}: {tokens_per_s:6.2f} tokens/s ({tokens_per_s / baseline:.2f}x)"
+                f" | acceptance {stats.acceptance_rate:.1%} of {stats.num_drafted} drafted"
+            )
+
+
+if __name__ == "__main__":
+    main()
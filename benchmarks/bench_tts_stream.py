@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Streaming TTS: time to first audio vs full synthesis
+====================================================
+
+Compares `BhaveshTTS.generate` with `BhaveshTTS.generate_stream` at a few chunk sizes. Needs real weights:
+a randomly initialized T3 never samples the stop token.
+
+Usage:
+    python benchmarks/bench_tts_stream.py --ckpt_dir CKPT_DIR --audio_prompt voice.wav
+    python benchmarks/bench_tts_stream.py --ckpt_dir CKPT_DIR --chunk_sizes 10 25 50 --save_dir out/
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torchaudio as ta
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from bhavesh_ai_voice_cloner.tts import BhaveshTTS
+
+DEFAULT_TEXT = (
+    "Streaming synthesis starts playing audio while the rest of the sentence is still being generated, "
+    "so listeners hear the first words almost right away."
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming TTS latency benchmark")
+    parser.add_argument("--ckpt_dir", type=str, required=True)
+    parser.add_argument("--audio_prompt", type=str, default=None, help="Reference voice (default: built-in voice)")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--text", type=str, default=DEFAULT_TEXT)
+    parser.add_argument("--chunk_sizes", type=int, nargs="+", default=[25, 50])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save_dir", type=str, default=None, help="Write the synthesized wavs here")
+    args = parser.parse_args()
+
+    tts = BhaveshTTS.from_local(args.ckpt_dir, args.device)
+    if args.audio_prompt:
+        tts.prepare_conditionals(args.audio_prompt)
+
+    torch.manual_seed(args.seed)
+    t0 = time.perf_counter()
+    wav = tts.generate(args.text)
+    total = time.perf_counter() - t0
+    print(f"{'generate':>14}: first audio {total:6.2f}s | total {total:6.2f}s | audio {wav.size(1) / tts.sr:5.2f}s")
+    outputs = {"full": wav}
+
+    for chunk_size in args.chunk_sizes:
+        torch.manual_seed(args.seed)
+        chunks = []
+        for chunk, metrics in tts.generate_stream(args.text, chunk_size=chunk_size):
+            chunks.append(chunk)
+        name = f"stream {chunk_size}"
+        print(
+            f"{name:>14}: first audio {metrics.first_chunk_latency:6.2f}s | total {metrics.total_time:6.2f}s"
+            f" | audio {metrics.audio_duration:5.2f}s | {metrics.chunk_count} chunks, RTF {metrics.rtf:.2f}"
+        )
+        outputs[f"stream_{chunk_size}"] = torch.cat(chunks, dim=1)
+
+    if args.save_dir:
+        save_dir = Path(args.save_dir)
+        save_dir.mkdir(parents=True, exist_ok=True)
+        for name, wav in outputs.items():
+            ta.save(str(save_dir / f"{name}.wav"), wav, tts.sr)
+        print(f"saved to {save_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+from typing import TYPE_CHECKING
+
 try:
     from importlib.metadata import version
 except ImportError:
@@ -10,5 +12,29 @@ except Exception:
     __version__ = "1.0.0"
 
 
-from .tts import BhaveshTTS
-from .vc import BhaveshVC
+if TYPE_CHECKING:
+    from .tts import BhaveshTTS
+    from .vc import BhaveshVC
+
+__all__ = ["BhaveshTTS", "BhaveshVC"]
+
+# imported on first access: `import bhavesh_ai_voice_cloner` (e.g. for `__version__`) does not import torch, and
+# `BhaveshVC` does not import the TTS models
+_LAZY_ATTRS = {
+    "BhaveshTTS": ".tts",
+    "BhaveshVC": ".vc",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+
+    value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRS))
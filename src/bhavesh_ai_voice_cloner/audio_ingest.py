@@ -0,0 +1,59 @@
+import logging
+from typing import Dict, Tuple
+
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
+
+from .models.utils import get_resampler
+
+
+logger = logging.getLogger(__name__)
+
+# bump when the decoding / resampling changes, it is part of the `ConditionalsCache` keys
+INGEST_VERSION = 1
+
+
+def decode_audio(fpath) -> Tuple[np.ndarray, int]:
+    """
+    Decode an audio file to a mono float32 waveform at its own sample rate. libsndfile (soundfile) reads WAV,
+    FLAC, OGG and MP3 directly; other formats go through `librosa.load` (audioread / ffmpeg).
+    """
+    try:
+        wav, sr = sf.read(fpath, dtype="float32", always_2d=True)
+        wav = wav.mean(axis=1) if wav.shape[1] > 1 else wav[:, 0]
+    except (sf.LibsndfileError, RuntimeError, TypeError):
+        wav, sr = librosa.load(fpath, sr=None, mono=True)
+    return np.ascontiguousarray(wav, dtype=np.float32), sr
+
+
+class AudioClip:
+    """
+    A clip decoded once, with a view at every sample rate a consumer asks for (`at`), resampled from the decoded
+    waveform on first use with cached `torchaudio` kernels and then shared, e.g. the 24 kHz S3Gen reference and
+    the 16 kHz view for the S3 tokenizer, CAMPPlus and the voice encoder.
+    """
+
+    def __init__(self, wav, sr: int):
+        wav = torch.as_tensor(wav, dtype=torch.float32)
+        self.sr = sr
+        self._views: Dict[int, torch.Tensor] = {sr: wav.view(-1)}
+
+    @classmethod
+    def load(cls, fpath) -> 'AudioClip':
+        return cls(*decode_audio(fpath))
+
+    def at(self, sr: int) -> torch.Tensor:
+        "The (L,) float32 waveform at `sr`, on CPU."
+        view = self._views.get(sr)
+        if view is None:
+            view = self._views[sr] = get_resampler(self.sr, sr, "cpu")(self._views[self.sr])
+        return view
+
+    def __len__(self):
+        return self._views[self.sr].size(0)
+
+    @property
+    def duration(self):
+        return len(self) / self.sr
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterable, Optional
+
+import torch
+
+from .model_hub import file_fingerprint, matches_fingerprint
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConditionalsCache:
+    """
+    Content-addressed cache of voice conditioning, so a reference clip that was seen before is not decoded,
+    resampled and embedded again. Entries are plain state dicts of tensors (e.g. `Conditionals.state_dict()`),
+    keyed with `audio_key`:
+        - memory: LRU of the `max_entries` most recently used entries, on the model's device.
+        - disk (optional): one `<key>.pt` file per entry in `cache_dir`, which survives restarts.
+    Embeddings depend on the model weights: `weight_fpaths` are the checkpoints they are computed with, whose
+    `weights_id` goes in the keys. Thread-safe.
+    """
+
+    WEIGHTS_FILENAME = "weights.json"
+
+    def __init__(self, cache_dir=None, max_entries=32, weight_fpaths: Iterable = ()):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.weight_fpaths = [Path(fpath) for fpath in weight_fpaths]
+        self._weights_id: Optional[str] = None
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def audio_key(wav_fpath, sr: int, exaggeration: Optional[float] = None, namespace="") -> str:
+        """
+        sha256 of the raw bytes of the audio file (not decoded) together with the target sample rate, the
+        exaggeration and a `namespace` for whatever else changes the result (e.g. the pipeline and its clip lengths).
+        """
+        h = hashlib.sha256()
+        with open(wav_fpath, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        exaggeration = "-" if exaggeration is None else f"{float(exaggeration):.6g}"
+        h.update(f"|{namespace}|{sr}|{exaggeration}".encode())
+        return h.hexdigest()
+
+    @property
+    def weights_id(self) -> str:
+        """
+        SHA-256 of the contents of `weight_fpaths`, for the `namespace` of `audio_key`, so that the disk tier never
+        serves the states of an older checkpoint. Computed on first use; the fingerprints are kept in `cache_dir`,
+        so a file is only hashed again when it changed (see `matches_fingerprint`). Empty without a `cache_dir`:
+        the memory tier lives no longer than the models.
+        """
+        if self.cache_dir is None or not self.weight_fpaths:
+            return ""
+        with self._lock:
+            if self._weights_id is None:
+                self._weights_id = self._compute_weights_id()
+            return self._weights_id
+
+    def _compute_weights_id(self):
+        weights_path = self.cache_dir / self.WEIGHTS_FILENAME
+        try:
+            fingerprints = json.loads(weights_path.read_text())
+        except (OSError, ValueError):
+            fingerprints = {}
+        h = hashlib.sha256()
+        changed = False
+        for fpath in self.weight_fpaths:
+            name = str(fpath.resolve())
+            if not (isinstance(fingerprints.get(name), dict) and matches_fingerprint(fpath, fingerprints[name])):
+                fingerprints[name] = file_fingerprint(fpath)
+                changed = True
+            h.update(f"{fpath.name}:{fingerprints[name]['sha256']}|".encode())
+        if changed:
+            try:
+                tmp_path = weights_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+                tmp_path.write_text(json.dumps(fingerprints, indent=2))
+                os.replace(tmp_path, weights_path)
+            except OSError as e:
+                logger.warning(f"could not record the checkpoint fingerprints in {weights_path}: {e}")
+        return h.hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / f"{key}.pt"
+
+    def get(self, key: str, map_location="cpu") -> Optional[dict]:
+        "The states of `key` from memory, else from disk (loaded to `map_location`), else None."
+        with self._lock:
+            states = self._entries.get(key)
+            if states is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return states
+
+        if self.cache_dir is not None and self._path(key).exists():
+            try:
+                states = torch.load(self._path(key), map_location=map_location, weights_only=True)
+            except Exception as e:
+                logger.warning(f"ignoring unreadable conditionals cache entry {self._path(key)}: {e}")
+            else:
+                with self._lock:
+                    self.disk_hits += 1
+                self._insert(key, states)
+                return states
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, states: dict):
+        self._insert(key, states)
+        if self.cache_dir is not None:
+            # write then rename, so that concurrent readers never see a partial file
+            tmp_path = self._path(key).with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            torch.save(states, tmp_path)
+            os.replace(tmp_path, self._path(key))
+
+    def _insert(self, key, states):
+        with self._lock:
+            self._entries[key] = states
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self, disk=False):
+        "Empty the memory tier, and the files of the disk tier too if `disk`."
+        with self._lock:
+            self._entries.clear()
+        if disk and self.cache_dir is not None:
+            for fpath in self.cache_dir.glob("*.pt"):
+                fpath.unlink(missing_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
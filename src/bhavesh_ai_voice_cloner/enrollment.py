@@ -0,0 +1,231 @@
+import argparse
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import librosa
+import numpy as np
+import torch
+
+from .models.s3tokenizer import S3_SR
+from .models.s3gen import S3GEN_SR
+from .models.t3.modules.cond_enc import T3Cond
+from .audio_ingest import AudioClip
+from .voice_bank import VoiceBank
+
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".mp3", ".ogg", ".m4a")
+
+
+def read_manifest(path) -> List[Tuple[str, Path]]:
+    """
+    The (voice_id, audio path) pairs to enroll from:
+        - a directory: every audio file below it, its voice ID being its relative path without extension
+          ("/" replaced by "__").
+        - a `.jsonl` file: one {"voice_id": ..., "path": ...} object per line.
+        - any other file: one "voice_id,path" (or tab-separated) line per voice.
+    Relative audio paths in a manifest are relative to the manifest.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return [
+            ("__".join(fpath.relative_to(path).with_suffix("").parts), fpath)
+            for fpath in sorted(path.rglob("*")) if fpath.suffix.lower() in AUDIO_EXTENSIONS
+        ]
+
+    items = []
+    for line in path.read_text().splitlines():
+        if not line.strip() or line.startswith("#"):
+            continue
+        if path.suffix == ".jsonl":
+            entry = json.loads(line)
+            voice_id, fpath = entry["voice_id"], entry["path"]
+        else:
+            voice_id, fpath = (s.strip() for s in line.split("\t" if "\t" in line else ",", 1))
+        items.append((voice_id, path.parent / fpath))
+    return items
+
+
+@dataclass
+class ReferenceClip:
+    "A decoded reference clip, cut the way `prepare_conditionals` does."
+    wav_24: torch.Tensor  # S3Gen reference, first `DEC_COND_LEN` samples at 24 kHz
+    wav_16: torch.Tensor  # the same at 16 kHz (the T3 prompt is its first `ENC_COND_LEN` samples)
+    ve_wav: Optional[np.ndarray] = None  # the whole clip at 16 kHz, trimmed for the voice encoder
+
+
+@dataclass
+class EnrollmentReport:
+    enrolled: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)  # already in the voice bank, or listed twice
+    failed: Dict[str, str] = field(default_factory=dict)  # voice ID -> error
+    seconds: float = 0.0
+
+
+class VoiceEnroller:
+    """
+    Enrolls many voices into a `VoiceBank`, with the same conditionals as `prepare_conditionals` (a `BhaveshTTS`)
+    or `set_target_voice` (a `BhaveshVC`, S3Gen part only) but in bulk:
+        - `num_workers` threads decode, resample and trim the clips ahead of the model.
+        - the mels, CAMPPlus x-vectors, S3 tokens and voice encoder embeddings of `batch_size` clips are computed
+          in padded batches, masked so that every voice gets the embeddings of its clip alone.
+        - voices are appended to the bank `append_every` at a time (one shard each at most).
+    """
+
+    def __init__(self, model, voice_bank: VoiceBank = None, batch_size=16, num_workers=4, append_every=256, exaggeration=0.5):
+        self.model = model
+        self.voice_bank = voice_bank if voice_bank is not None else model.voice_bank
+        assert self.voice_bank is not None, "no voice bank to enroll into"
+        self.with_t3 = hasattr(model, "t3")
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.append_every = append_every
+        self.exaggeration = exaggeration
+
+    def load_clip(self, fpath) -> ReferenceClip:
+        "Runs in the worker threads."
+        audio = AudioClip.load(fpath)
+        wav_16 = audio.at(S3_SR)
+        clip = ReferenceClip(
+            wav_24=audio.at(S3GEN_SR)[:self.model.DEC_COND_LEN],
+            wav_16=wav_16[:self.model.DEC_COND_LEN * S3_SR // S3GEN_SR],
+        )
+        if self.with_t3:
+            # as `VoiceEncoder.embeds_from_wavs`
+            clip.ve_wav = librosa.effects.trim(wav_16.numpy(), top_db=20)[0]
+        return clip
+
+    def embed(self, clips: List[ReferenceClip]) -> List[dict]:
+        "The `Conditionals.state_dict()` of every clip (just its 'gen' part for a `BhaveshVC`)."
+        model = self.model
+        ref_dicts = model.s3gen.embed_refs(
+            [clip.wav_24 for clip in clips], S3GEN_SR, device=model.device, ref_wavs_16=[clip.wav_16 for clip in clips],
+        )
+        if not self.with_t3:
+            return [dict(gen=ref_dict) for ref_dict in ref_dicts]
+
+        # Speech cond prompt tokens
+        prompt_tokens = [None] * len(clips)
+        if plen := model.t3.hp.speech_cond_prompt_len:
+            tokens, token_lens = model.s3gen.tokenizer.forward(
+                [clip.wav_16[:model.ENC_COND_LEN] for clip in clips], max_len=plen,
+            )
+            prompt_tokens = [tokens[i:i + 1, :n].to(model.device) for i, n in enumerate(token_lens.tolist())]
+
+        # Voice-encoder speaker embeddings
+        ve_embeds = torch.from_numpy(model.ve.embeds_from_wavs([clip.ve_wav for clip in clips], S3_SR, trim_top_db=None))
+
+        states = []
+        for i, ref_dict in enumerate(ref_dicts):
+            t3_cond = T3Cond(
+                speaker_emb=ve_embeds[i:i + 1],
+                cond_prompt_speech_tokens=prompt_tokens[i],
+                emotion_adv=self.exaggeration * torch.ones(1, 1, 1),
+            ).to(device=model.device)
+            states.append(dict(t3=dict(t3_cond.__dict__), gen=ref_dict))
+        return states
+
+    def enroll(self, items: Iterable[Tuple[str, Path]], overwrite=False) -> EnrollmentReport:
+        """
+        Enroll the (voice_id, audio path) pairs, e.g. from `read_manifest`. Voices already in the bank are
+        skipped unless `overwrite`, so an interrupted run can simply be started again. Clips that fail to
+        decode are reported, not raised.
+        """
+        report = EnrollmentReport()
+        t0 = time.perf_counter()
+        items = iter(items)
+        pending, enrolled, seen = deque(), {}, set()
+
+        def flush():
+            if enrolled:
+                self.voice_bank.append(enrolled, overwrite=overwrite)
+                report.enrolled.extend(enrolled)
+                logger.info(f"enrolled {len(report.enrolled)} voices in {time.perf_counter() - t0:.0f}s")
+                enrolled.clear()
+
+        with ThreadPoolExecutor(self.num_workers) as pool:
+            def submit(n):
+                # decode at most 2 batches ahead, to bound the memory held by decoded clips
+                while len(pending) < n and (item := next(items, None)) is not None:
+                    voice_id, fpath = item
+                    if voice_id in seen or (voice_id in self.voice_bank and not overwrite):
+                        report.skipped.append(voice_id)
+                        continue
+                    seen.add(voice_id)
+                    pending.append((voice_id, fpath, pool.submit(self.load_clip, fpath)))
+
+            submit(2 * self.batch_size)
+            while pending:
+                batch = []
+                while pending and len(batch) < self.batch_size:
+                    voice_id, fpath, future = pending.popleft()
+                    try:
+                        batch.append((voice_id, future.result()))
+                    except Exception as e:
+                        report.failed[voice_id] = f"{type(e).__name__}: {e}"
+                        logger.warning(f"cannot enroll {voice_id!r} from {fpath}: {report.failed[voice_id]}")
+                submit(2 * self.batch_size)
+                if not batch:
+                    continue
+
+                with torch.inference_mode():
+                    states = self.embed([clip for _, clip in batch])
+                enrolled.update((voice_id, voice_states) for (voice_id, _), voice_states in zip(batch, states))
+                if len(enrolled) >= self.append_every:
+                    flush()
+            flush()
+
+        report.seconds = time.perf_counter() - t0
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enroll voices into a voice bank in bulk")
+    parser.add_argument("input", type=str, help="Directory of reference clips, or manifest (.jsonl, or voice_id,path lines)")
+    parser.add_argument("--voice_bank", type=str, required=True, help="Voice bank directory (created if needed)")
+    parser.add_argument("--ckpt_dir", type=str, default=None, help="Local checkpoints (default: download)")
+    parser.add_argument("--model", choices=("tts", "vc"), default="tts", help="vc enrolls the S3Gen part only")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--append_every", type=int, default=256)
+    parser.add_argument("--exaggeration", type=float, default=0.5)
+    parser.add_argument("--overwrite", action="store_true", help="Re-enroll voices already in the bank")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    if args.model == "tts":
+        from .tts import BhaveshTTS as model_cls
+    else:
+        from .vc import BhaveshVC as model_cls
+    if args.ckpt_dir is None:
+        model = model_cls.from_pretrained(args.device)
+    else:
+        model = model_cls.from_local(args.ckpt_dir, args.device)
+
+    enroller = VoiceEnroller(
+        model,
+        VoiceBank(args.voice_bank),
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        append_every=args.append_every,
+        exaggeration=args.exaggeration,
+    )
+    report = enroller.enroll(read_manifest(args.input), overwrite=args.overwrite)
+    print(
+        f"enrolled {len(report.enrolled)}, skipped {len(report.skipped)} already enrolled, "
+        f"{len(report.failed)} failed, in {report.seconds:.1f}s"
+    )
+    for voice_id, error in report.failed.items():
+        print(f"  {voice_id}: {error}")
+
+
+if __name__ == "__main__":
+    main()
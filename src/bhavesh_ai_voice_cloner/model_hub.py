@@ -0,0 +1,168 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from huggingface_hub import HfApi, constants, snapshot_download, try_to_load_from_cache
+
+
+REPO_ID = "ResembleAI/chatterbox"
+
+# checkpoint files of each front-end
+MODEL_FILES = dict(
+    tts=["ve.safetensors", "t3_cfg.safetensors", "s3gen.safetensors", "tokenizer.json", "conds.pt"],
+    vc=["s3gen.safetensors", "conds.pt"],
+)
+
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# a directory of checkpoints used instead of the Hugging Face Hub, e.g. baked into an image by `prefetch`
+MODEL_DIR_ENV = "BHAVESH_MODEL_DIR"
+# resolve from `MODEL_DIR_ENV` / the Hugging Face cache only (as does `HF_HUB_OFFLINE=1`)
+OFFLINE_ENV = "BHAVESH_OFFLINE"
+
+
+def file_sha256(fpath, chunk_size=16 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_fingerprint(fpath) -> Dict[str, str]:
+    "Size, modification time and SHA-256 of `fpath`, recorded by the files derived from it, see `matches_fingerprint`."
+    stat = Path(fpath).stat()
+    return dict(size=str(stat.st_size), mtime_ns=str(stat.st_mtime_ns), sha256=file_sha256(fpath))
+
+
+def matches_fingerprint(fpath, fingerprint: Dict[str, str]) -> bool:
+    """
+    Whether `fpath` still has the content `fingerprint` (a `file_fingerprint`) was taken of. The file is only
+    hashed again when its modification time changed (e.g. a copy, or an updated file of the same size).
+    """
+    stat = Path(fpath).stat()
+    if fingerprint.get("size") != str(stat.st_size):
+        return False
+    if fingerprint.get("mtime_ns") == str(stat.st_mtime_ns):
+        return True
+    return fingerprint.get("sha256") == file_sha256(fpath)
+
+
+def write_manifest(model_dir, files: Iterable[str], repo_id=REPO_ID, revision=None) -> dict:
+    "Record the size and SHA-256 of `files` in `model_dir`, and the repo / commit they come from."
+    model_dir = Path(model_dir)
+    manifest = dict(
+        version=MANIFEST_VERSION,
+        repo_id=repo_id,
+        revision=revision,
+        files={
+            fname: dict(size=(model_dir / fname).stat().st_size, sha256=file_sha256(model_dir / fname))
+            for fname in sorted(set(files))
+        },
+    )
+    (model_dir / MANIFEST_FILENAME).write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def verify_manifest(model_dir, files: Iterable[str], checksums=False) -> Optional[dict]:
+    """
+    Check `files` in `model_dir` against its manifest: their sizes, and their SHA-256 if `checksums` (which
+    reads every file). Returns the manifest, None if there is none; raises a `ValueError` on mismatches.
+    """
+    model_dir = Path(model_dir)
+    if not (manifest_path := model_dir / MANIFEST_FILENAME).exists():
+        return None
+    manifest = json.loads(manifest_path.read_text())
+    assert manifest.get("version") == MANIFEST_VERSION, f"unsupported manifest version in {manifest_path}"
+    errors = []
+    for fname in files:
+        if (expected := manifest["files"].get(fname)) is None:
+            errors.append(f"{fname} is not in the manifest")
+        elif (size := (model_dir / fname).stat().st_size) != expected["size"]:
+            errors.append(f"{fname} has {size} bytes instead of {expected['size']}")
+        elif checksums and file_sha256(model_dir / fname) != expected["sha256"]:
+            errors.append(f"{fname} has the wrong SHA-256")
+    if errors:
+        raise ValueError(f"{model_dir} does not match its manifest: " + "; ".join(errors))
+    return manifest
+
+
+def is_offline() -> bool:
+    return constants.HF_HUB_OFFLINE or os.environ.get(OFFLINE_ENV, "").lower() in ("1", "true", "yes")
+
+
+def resolve_model_dir(
+    files: Iterable[str], repo_id=REPO_ID, revision=None, model_dir=None, offline=None, verify_checksums=False,
+) -> Path:
+    """
+    The local directory of the checkpoint `files`, without network calls whenever possible:
+        1. `model_dir` (or `$BHAVESH_MODEL_DIR`): must hold all the files; checked against its manifest if any.
+        2. the Hugging Face cache, if it holds all the files of `revision` (a commit hash pins them; a branch
+           resolves to the commit it pointed to when last downloaded).
+        3. unless `offline` (default: `$BHAVESH_OFFLINE` or `$HF_HUB_OFFLINE`), one download of the missing files.
+    """
+    files = list(files)
+    offline = is_offline() if offline is None else offline
+    if model_dir is None:
+        model_dir = os.environ.get(MODEL_DIR_ENV)
+
+    if model_dir is not None:
+        model_dir = Path(model_dir)
+        if missing := [fname for fname in files if not (model_dir / fname).exists()]:
+            raise FileNotFoundError(f"{model_dir} is missing {missing}")
+        verify_manifest(model_dir, files, checksums=verify_checksums)
+        return model_dir
+
+    cached = [try_to_load_from_cache(repo_id, fname, revision=revision) for fname in files]
+    if all(isinstance(fpath, str) for fpath in cached):
+        snapshot_dirs = {Path(fpath).parent for fpath in cached}
+        if len(snapshot_dirs) == 1:
+            return snapshot_dirs.pop()
+
+    if offline:
+        raise FileNotFoundError(
+            f"{repo_id}@{revision or 'main'} is not in the Hugging Face cache and downloads are disabled; "
+            f"prefetch it with `python -m bhavesh_ai_voice_cloner.model_hub` and set ${MODEL_DIR_ENV}"
+        )
+    return Path(snapshot_download(repo_id, revision=revision, allow_patterns=files))
+
+
+def prefetch(output_dir, files: Iterable[str], repo_id=REPO_ID, revision=None) -> dict:
+    "Download `files` of the commit `revision` resolves to into `output_dir` and write their manifest."
+    files = sorted(set(files))
+    commit = HfApi().model_info(repo_id, revision=revision).sha
+    snapshot_download(repo_id, revision=commit, allow_patterns=files, local_dir=output_dir)
+    return write_manifest(output_dir, files, repo_id=repo_id, revision=commit)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=f"Download the checkpoints into a directory with a manifest, for ${MODEL_DIR_ENV} (e.g. in an image)"
+    )
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument("--models", nargs="+", choices=list(MODEL_FILES), default=list(MODEL_FILES))
+    parser.add_argument("--repo_id", type=str, default=REPO_ID)
+    parser.add_argument("--revision", type=str, default=None, help="Branch, tag or commit (default: main)")
+    parser.add_argument("--verify", action="store_true", help="Only check the files of output_dir against its manifest")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    files = sorted({fname for model in args.models for fname in MODEL_FILES[model]})
+    if args.verify:
+        if verify_manifest(args.output_dir, files, checksums=True) is None:
+            raise SystemExit(f"no {MANIFEST_FILENAME} in {args.output_dir}")
+        print(f"{args.output_dir}: {len(files)} files match the manifest")
+        return
+
+    manifest = prefetch(args.output_dir, files, repo_id=args.repo_id, revision=args.revision)
+    size = sum(info["size"] for info in manifest["files"].values())
+    print(f"{args.repo_id}@{manifest['revision']}: {len(files)} files, {size / 1e9:.2f} GB in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import logging
+import threading
+import time
+from functools import partial
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, Hashable, Iterable, Tuple
+
+import torch
+from safetensors.torch import load_file
+
+from .models.utils import MappedSafetensors, init_empty_weights, materialize_meta_parameters
+
+if TYPE_CHECKING:
+    from .models.t3 import T3
+    from .models.s3gen import S3Gen
+    from .models.voice_encoder import VoiceEncoder
+
+
+logger = logging.getLogger(__name__)
+
+RegistryKey = Tuple[Hashable, ...]
+
+
+class _Entry:
+    def __init__(self):
+        self.lock = threading.Lock()  # held while loading, so that a model is loaded once
+        self.model = None
+        self.refs = 0
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded models, so that front-ends loading the same checkpoint on the same device
+    (e.g. `BhaveshTTS` and `BhaveshVC`, which both use S3Gen) share one instance.
+
+    `acquire` returns the model of a key, loading it on first use, and counts a reference; `release` drops it,
+    and the registry forgets the model when no reference is left. Thread-safe: a model is loaded once even
+    when requested concurrently, and models of different keys load in parallel.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[RegistryKey, _Entry] = {}
+
+    @staticmethod
+    def key(kind: str, ckpt_path, device, dtype=torch.float32, **options) -> RegistryKey:
+        "`options` are whatever else configures the loaded instance (e.g. the S3Gen estimator backend)."
+        return (kind, str(Path(ckpt_path).resolve()), str(torch.device(device)), str(dtype), *sorted(options.items()))
+
+    def acquire(self, key: RegistryKey, loader: Callable[[], torch.nn.Module]):
+        with self._lock:
+            entry = self._entries.setdefault(key, _Entry())
+            entry.refs += 1
+        try:
+            with entry.lock:
+                if entry.model is None:
+                    t0 = time.perf_counter()
+                    entry.model = loader()
+                    logger.info(f"loaded {key} in {time.perf_counter() - t0:.1f}s")
+        except BaseException:
+            self.release(key)
+            raise
+        return entry.model
+
+    def release(self, key: RegistryKey):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refs -= 1
+            if entry.refs <= 0:
+                del self._entries[key]
+
+    def release_all(self, keys: Iterable[RegistryKey]):
+        for key in keys:
+            self.release(key)
+
+    def refs(self, key: RegistryKey) -> int:
+        with self._lock:
+            entry = self._entries.get(key)
+            return 0 if entry is None else entry.refs
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+# used by `from_local` (share_models=True)
+MODEL_REGISTRY = ModelRegistry()
+
+
+def load_module(name, build: Callable[[], torch.nn.Module], fpath, device, strict=True, meta_init=True, convert_state=None):
+    """
+    Build a module and load its weights from the safetensors file `fpath`. With `meta_init`, the module is
+    built with its parameters on the meta device (`init_empty_weights`, no allocation nor random init) and they
+    are assigned the tensors of the memory-mapped file, without copies on CPU. Otherwise, the module is built and
+    initialized as usual and its parameters overwritten by `load_state_dict`. Logs the time of both steps.
+    """
+    t0 = time.perf_counter()
+    if meta_init:
+        with init_empty_weights():
+            module = build()
+    else:
+        module = build()
+    t1 = time.perf_counter()
+
+    if meta_init:
+        state = MappedSafetensors(fpath).state_dict()
+    else:
+        state = load_file(fpath)
+    if convert_state is not None:
+        state = convert_state(state)
+    if meta_init:
+        # `assign` keeps the dtypes of the checkpoint
+        expected = module.state_dict(keep_vars=True)
+        state = {
+            k: v.to(expected[k].dtype) if k in expected and v.dtype != expected[k].dtype else v
+            for k, v in state.items()
+        }
+        module.load_state_dict(state, strict=strict, assign=True)
+        if missing := materialize_meta_parameters(module, "cpu"):
+            logger.warning(f"{name}: {len(missing)} parameters not in {fpath} are randomly initialized: {missing}")
+    else:
+        module.load_state_dict(state, strict=strict)
+    module.to(device).eval()
+    t2 = time.perf_counter()
+    logger.info(f"{name}: built in {t1 - t0:.2f}s, weights loaded in {t2 - t1:.2f}s")
+    return module
+
+
+# the models are imported by their loader only, e.g. `BhaveshVC` does not import T3 (transformers)
+def load_ve(ckpt_dir, device, meta_init=True) -> "VoiceEncoder":
+    from .models.voice_encoder import VoiceEncoder
+
+    return load_module("ve", VoiceEncoder, Path(ckpt_dir) / "ve.safetensors", device, meta_init=meta_init)
+
+
+def _t3_state(state):
+    if "model" in state.keys():
+        state = state["model"][0]
+    return state
+
+
+def load_t3(ckpt_dir, device, meta_init=True, quantization=None) -> "T3":
+    """
+    `quantization="int8"` (CPU only) quantizes the linears of the decoding loop, see `models/t3/quantization.py`.
+    The quantized model is cached next to the checkpoint (t3_cfg.int8.safetensors), which later loads read instead.
+    """
+    from .models.t3 import T3
+
+    fpath = Path(ckpt_dir) / "t3_cfg.safetensors"
+    if quantization is None:
+        return load_module("t3", T3, fpath, device, meta_init=meta_init, convert_state=_t3_state)
+    return _load_quantized_t3(fpath, device, quantization)
+
+
+def _load_quantized_t3(fpath, device, quantization) -> "T3":
+    from .models.t3 import T3
+    from .models.t3.quantization import (
+        is_valid_quantized_checkpoint, load_quantized_t3_weights, quantize_t3, quantized_checkpoint_path, save_quantized_t3,
+    )
+
+    if torch.device(device).type != "cpu":
+        raise ValueError(f"{quantization} quantization of T3 runs on CPU only, not on {device}")
+    quantized_fpath = quantized_checkpoint_path(fpath, quantization)
+
+    if not is_valid_quantized_checkpoint(quantized_fpath, fpath, quantization):
+        t0 = time.perf_counter()
+        t3 = quantize_t3(load_module("t3", T3, fpath, device, convert_state=_t3_state), quantization)
+        try:
+            save_quantized_t3(t3, quantized_fpath, fpath, quantization)
+        except OSError as e:
+            logger.warning(f"could not cache the {quantization} T3 in {quantized_fpath}: {e}")
+        logger.info(f"t3: quantized to {quantization} in {time.perf_counter() - t0:.2f}s")
+        return t3
+
+    t0 = time.perf_counter()
+    with init_empty_weights():
+        t3 = T3()
+    load_quantized_t3_weights(t3, quantized_fpath)
+    if missing := materialize_meta_parameters(t3, "cpu"):
+        logger.warning(f"t3: {len(missing)} parameters not in {quantized_fpath} are randomly initialized: {missing}")
+    logger.info(f"t3: {quantization} weights loaded from {quantized_fpath} in {time.perf_counter() - t0:.2f}s")
+    return t3.eval()
+
+
+def load_s3gen(ckpt_dir, device, estimator_backend="torch", num_estimator_sessions=2, meta_init=True) -> "S3Gen":
+    from .models.s3gen import S3Gen
+
+    ckpt_dir = Path(ckpt_dir)
+    fpath = ckpt_dir / "s3gen.safetensors"
+    s3gen = load_module("s3gen", S3Gen, fpath, device, strict=False, meta_init=meta_init)
+    s3gen.set_estimator_backend(
+        estimator_backend, onnx_path=ckpt_dir / "s3gen_estimator.onnx", num_sessions=num_estimator_sessions,
+        source_fpath=fpath,
+    )
+    return s3gen
+
+
+def acquire_models(ckpt_dir, device, components: Dict[str, dict], share_models=True) -> Tuple[Dict[str, torch.nn.Module], list]:
+    """
+    Load the `components` ("t3", "s3gen", "ve") of the checkpoint in `ckpt_dir`, each with its loader options,
+    from `MODEL_REGISTRY` if `share_models`. Returns the models and the registry keys to release.
+    """
+    loaders = dict(t3=(load_t3, "t3_cfg.safetensors"), s3gen=(load_s3gen, "s3gen.safetensors"), ve=(load_ve, "ve.safetensors"))
+    models, keys = {}, []
+    for name, options in components.items():
+        loader, fname = loaders[name]
+        load = partial(loader, ckpt_dir, device, **options)
+        if not share_models:
+            models[name] = load()
+            continue
+        key = ModelRegistry.key(name, Path(ckpt_dir) / fname, device, **options)
+        models[name] = MODEL_REGISTRY.acquire(key, load)
+        keys.append(key)
+    return models, keys
@@ -7,5 +7,6 @@ __all__ = [
     "s3tokenizer",
     "voice_encoder",
     "tokenizers",
+    "spectral",
     "utils"
 ]
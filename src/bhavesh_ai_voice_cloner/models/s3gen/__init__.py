@@ -1,2 +1,4 @@
 from .s3gen import S3Token2Wav as S3Gen
 from .const import S3GEN_SR
+from .configs import CFM_SOLVER_PRESETS
+from .estimator_backends import ESTIMATOR_BACKENDS
@@ -8,3 +8,13 @@ CFM_PARAMS = AttrDict({
     "inference_cfg_rate": 0.7,
     "reg_loss_type": "l1"
 })
+
+# Named speed / quality trade-offs for the CFM decoder (`solver` and `n_timesteps` of `S3Gen.inference`).
+# Every step runs the estimator on the CFG pair, Heun and midpoint steps run it twice.
+CFM_SOLVER_PRESETS = {
+    "quality": AttrDict({"solver": "euler", "n_timesteps": 10}),  # reference
+    # dpm++2m takes 3 of its steps at first order (see `ConditionalCFM.solve_dpm_multistep`): 3 second order steps
+    "balanced": AttrDict({"solver": "dpm++2m", "n_timesteps": 6}),
+    # a single second order step
+    "fast": AttrDict({"solver": "dpm++2m", "n_timesteps": 4}),
+}
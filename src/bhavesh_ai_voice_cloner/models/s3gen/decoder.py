@@ -97,6 +97,44 @@ class CausalConv1d(torch.nn.Conv1d):
         return x
 
 
+class MidBlockFeatureCache:
+    """
+    Reuse of the deep `mid_blocks` features of `ConditionalDecoder` across ODE steps (DeepCache-style).
+
+    On a full evaluation the residual that the cached mid blocks add to their input is stored; on the other
+    evaluations, that residual is added to the fresh input of those blocks, so only the down / up blocks (and
+    the first `num_shallow_blocks` mid blocks) run. One instance covers one ODE solve.
+
+    Args:
+        schedule: an int N to run the full network on every N-th estimator call (2 = alternate calls), or
+            the explicit call indices to run in full. The first call is always full.
+        num_shallow_blocks: number of leading mid blocks that are always recomputed.
+    """
+
+    def __init__(self, schedule=2, num_shallow_blocks=0):
+        self.schedule = schedule
+        self.num_shallow_blocks = num_shallow_blocks
+        self.call_idx = 0
+        self.residual = None
+        self.num_full = 0
+        self.num_reused = 0
+        # relative change of the cached residual between consecutive full calls: how stale reused features get
+        self.residual_drift = []
+
+    def should_compute(self):
+        if self.residual is None:
+            return True
+        if isinstance(self.schedule, int):
+            return self.call_idx % self.schedule == 0
+        return self.call_idx in self.schedule
+
+    def update(self, residual):
+        if self.residual is not None and self.residual.shape == residual.shape:
+            drift = (residual - self.residual).norm() / residual.norm().clamp(min=1e-8)
+            self.residual_drift.append(drift.item())
+        self.residual = residual
+
+
 class ConditionalDecoder(nn.Module):
     def __init__(
         self,
@@ -230,7 +268,7 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None):
+    def forward(self, x, mask, mu, t, spks=None, cond=None, feature_cache: MidBlockFeatureCache = None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -239,6 +277,7 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            feature_cache (MidBlockFeatureCache, optional): reuse deep mid block features across calls.
 
         Raises:
             ValueError: _description_
@@ -247,71 +286,138 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
+        context = self.prepare_context(mask, mu, spks, cond)
+        return self.forward_prepared(x, t, context, feature_cache=feature_cache)
 
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
-
-        x = pack([x, mu], "b * t")[0]
-
+    def prepare_context(self, mask, mu, spks=None, cond=None, timesteps=()) -> "DecoderContext":
+        """
+        Everything about a call that does not depend on `x` or `t`, computed once per ODE solve: the packed
+        `mu` / `spks` / `cond` channels, the mask and attention bias of every resolution and the time
+        embeddings of the known `timesteps` (floats, e.g. the solver's schedule).
+        """
+        cond_channels = [mu]
         if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
+            cond_channels.append(repeat(spks, "b c -> b c t", t=mu.shape[-1]))
         if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+            cond_channels.append(cond)
+        n_x = self.in_channels - sum(c.size(1) for c in cond_channels)
+        x_slot = torch.empty(mu.size(0), n_x, mu.size(2), device=mu.device, dtype=mu.dtype)
+        packed = torch.cat([x_slot] + cond_channels, dim=1)
 
-        hiddens = []
         masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
-            x = resnet(x, mask_down, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
+        for _ in self.down_blocks:
+            masks.append(masks[-1][:, :, ::2])
+        masks = masks[:-1]
+        attn_biases = []
+        for m in masks:
+            # attn_mask = torch.matmul(m.transpose(1, 2).contiguous(), m)
+            attn_mask = add_optional_chunk_mask(m.transpose(1, 2), m.bool(), False, False, 0, self.static_chunk_size, -1)
+            attn_biases.append(mask_to_bias(attn_mask == 1, mu.dtype))
+
+        context = DecoderContext(packed, n_x, masks, attn_biases)
+        if len(timesteps) > 0:
+            t = torch.tensor(list(timesteps), device=mu.device, dtype=mu.dtype)
+            embs = self.time_mlp(self.time_embeddings(t).to(t.dtype))
+            context.time_table = {k: emb.expand(mu.size(0), -1) for k, emb in zip(timesteps, embs)}
+        return context
+
+    def forward_prepared(self, x, t, context: "DecoderContext", feature_cache: MidBlockFeatureCache = None):
+        """
+        `forward` with the step-invariant work done by `prepare_context`.
+
+        Args:
+            x (torch.Tensor): shape (batch_size or 1, n_feats, time)
+            t (torch.Tensor or float): shape (batch_size), or a float that is the same for every row
+        """
+        t = self.time_embedding(t, context)
+        x = context.pack(x)
+
+        hiddens = []
+        for level, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
+            mask_down = context.masks[level]
+            x = self._block_forward(resnet, transformer_blocks, x, mask_down, context.attn_biases[level], t)
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
-
-        for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+
+        mask_mid, bias_mid = context.masks[-1], context.attn_biases[-1]
+        if feature_cache is None:
+            x = self._mid_blocks_forward(self.mid_blocks, x, mask_mid, bias_mid, t)
+        else:
+            n_shallow = feature_cache.num_shallow_blocks
+            x = self._mid_blocks_forward(self.mid_blocks[:n_shallow], x, mask_mid, bias_mid, t)
+            if feature_cache.should_compute():
+                x_deep = self._mid_blocks_forward(self.mid_blocks[n_shallow:], x, mask_mid, bias_mid, t)
+                feature_cache.update(x_deep - x)
+                feature_cache.num_full += 1
+                x = x_deep
+            else:
+                x = x + feature_cache.residual
+                feature_cache.num_reused += 1
+            feature_cache.call_idx += 1
+
+        for level, (resnet, transformer_blocks, upsample) in zip(reversed(range(len(context.masks))), self.up_blocks):
+            mask_up = context.masks[level]
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
-            x = resnet(x, mask_up, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
+            x = self._block_forward(resnet, transformer_blocks, x, mask_up, context.attn_biases[level], t)
             x = upsample(x * mask_up)
         x = self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
-        return output * mask
+        return output * context.masks[0]
+
+    def time_embedding(self, t, context: "DecoderContext" = None):
+        "(batch_size, time_embed_dim) embedding of `t`, looked up in the table of `context` for a float `t`."
+        if not torch.is_tensor(t):
+            emb = context.time_table.get(t) if context is not None else None
+            if emb is not None:
+                return emb
+            t = torch.full((context.batch_size,), t, device=context.device, dtype=context.dtype)
+        return self.time_mlp(self.time_embeddings(t).to(t.dtype))
+
+    def _mid_blocks_forward(self, mid_blocks, x, mask_mid, attn_bias, t):
+        for resnet, transformer_blocks in mid_blocks:
+            x = self._block_forward(resnet, transformer_blocks, x, mask_mid, attn_bias, t)
+        return x
+
+    def _block_forward(self, resnet, transformer_blocks, x, mask, attn_bias, t):
+        x = resnet(x, mask, t)
+        x = rearrange(x, "b c t -> b t c").contiguous()
+        for transformer_block in transformer_blocks:
+            x = transformer_block(
+                hidden_states=x,
+                attention_mask=attn_bias,
+                timestep=t,
+            )
+        return rearrange(x, "b t c -> b c t").contiguous()
+
+
+class DecoderContext:
+    """
+    Step-invariant inputs of `ConditionalDecoder` for one ODE solve, see `ConditionalDecoder.prepare_context`.
+    `packed` holds the conditioning channels after the first `n_x` (the noisy sample `x`), which `pack`
+    writes in place, so a context serves one call at a time.
+    """
+
+    def __init__(self, packed, n_x, masks, attn_biases, time_table=None):
+        self.packed = packed
+        self.n_x = n_x
+        self.masks = masks
+        self.attn_biases = attn_biases
+        self.time_table = time_table or {}
+
+    @property
+    def batch_size(self):
+        return self.packed.size(0)
+
+    @property
+    def device(self):
+        return self.packed.device
+
+    @property
+    def dtype(self):
+        return self.packed.dtype
+
+    def pack(self, x):
+        "[x, mu, spks, cond] along channels, `x` being broadcast over the batch."
+        self.packed[:, :self.n_x] = x
+        return self.packed
@@ -0,0 +1,188 @@
+# Copyright (c) 2025 Bhavesh AI
+# MIT License
+"""
+Runtimes for the CFM estimator (`ConditionalDecoder`) other than eager PyTorch. A backend is called like the
+estimator on the (conditional, unconditional) batch of 2 and returns its output as a tensor.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+from pathlib import Path
+
+import torch
+
+from ...model_hub import file_fingerprint, matches_fingerprint
+
+
+logger = logging.getLogger(__name__)
+
+# selectable with `S3Gen.set_estimator_backend` / `from_local(estimator_backend=...)`
+ESTIMATOR_BACKENDS = ("torch", "onnxruntime")
+ESTIMATOR_INPUT_NAMES = ("x", "mask", "mu", "t", "spks", "cond")
+ESTIMATOR_OUTPUT_NAME = "estimator_out"
+# bumped when `export_estimator_onnx` exports a different graph
+ONNX_EXPORT_VERSION = 1
+
+
+class EstimatorBackend:
+    "Interface of a non-PyTorch estimator, see `ConditionalCFM.set_estimator_backend`."
+
+    def __call__(self, x, mask, mu, t, spks, cond) -> torch.Tensor:
+        """
+        Args:
+            x, mu, cond: (2, 80, T)
+            mask: (2, 1, T)
+            t: (2,)
+            spks: (2, 80)
+        Returns:
+            (2, 80, T) vector field
+        """
+        raise NotImplementedError
+
+
+class TensorRTEstimator(EstimatorBackend):
+    "A TensorRT execution context of the estimator. The engine is not re-entrant, calls are serialized."
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+
+    def __call__(self, x, mask, mu, t, spks, cond):
+        with self.lock:
+            self.engine.set_input_shape('x', (2, 80, x.size(2)))
+            self.engine.set_input_shape('mask', (2, 1, x.size(2)))
+            self.engine.set_input_shape('mu', (2, 80, x.size(2)))
+            self.engine.set_input_shape('t', (2,))
+            self.engine.set_input_shape('spks', (2, 80))
+            self.engine.set_input_shape('cond', (2, 80, x.size(2)))
+            # run trt engine
+            self.engine.execute_v2([x.contiguous().data_ptr(),
+                                    mask.contiguous().data_ptr(),
+                                    mu.contiguous().data_ptr(),
+                                    t.contiguous().data_ptr(),
+                                    spks.contiguous().data_ptr(),
+                                    cond.contiguous().data_ptr(),
+                                    x.data_ptr()])
+        return x
+
+
+class OnnxRuntimeEstimator(EstimatorBackend):
+    """
+    The estimator exported with `export_estimator_onnx`, run by ONNX Runtime with full graph optimizations.
+
+    Each call takes an `InferenceSession` from a pool of `num_sessions`, so that many concurrent requests run
+    side by side rather than queue on one session. Every session has its own intra-op thread pool of
+    `intra_op_num_threads` threads (0 = ONNX Runtime's default); size both to the cores available.
+    """
+
+    def __init__(self, onnx_path, num_sessions=2, intra_op_num_threads=0, providers=("CPUExecutionProvider",)):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_num_threads
+        self.onnx_path = Path(onnx_path)
+        self.num_sessions = num_sessions
+        self._sessions = queue.LifoQueue()
+        for _ in range(num_sessions):
+            self._sessions.put(ort.InferenceSession(str(onnx_path), sess_options=options, providers=list(providers)))
+
+    def __call__(self, x, mask, mu, t, spks, cond):
+        feeds = {
+            name: tensor.detach().float().cpu().numpy()
+            for name, tensor in zip(ESTIMATOR_INPUT_NAMES, (x, mask, mu, t, spks, cond))
+        }
+        session = self._sessions.get()
+        try:
+            out = session.run([ESTIMATOR_OUTPUT_NAME], feeds)[0]
+        finally:
+            self._sessions.put(session)
+        return torch.from_numpy(out).to(device=x.device, dtype=x.dtype)
+
+
+def onnx_metadata_path(onnx_path) -> Path:
+    "The JSON file next to an exported estimator, recording what it was exported from, e.g. s3gen_estimator.onnx.json."
+    onnx_path = Path(onnx_path)
+    return onnx_path.with_name(f"{onnx_path.name}.json")
+
+
+def _export_metadata(source_fpath, opset_version, seq_len) -> dict:
+    "The export settings, and the fingerprint of the weights file the estimator was loaded from (if any)."
+    metadata = dict(version=ONNX_EXPORT_VERSION, opset_version=opset_version, seq_len=seq_len, source=None)
+    if source_fpath is not None:
+        metadata.update(source=Path(source_fpath).name, **{f"source_{k}": v for k, v in file_fingerprint(source_fpath).items()})
+    return metadata
+
+
+def is_valid_estimator_onnx(onnx_path, source_fpath=None, opset_version=17, seq_len=256) -> bool:
+    """
+    Whether `onnx_path` exists and was exported with these settings from the current content of `source_fpath`
+    (see `matches_fingerprint`). Without a `source_fpath`, the caller vouches for the weights.
+    """
+    metadata_path = onnx_metadata_path(onnx_path)
+    if not (Path(onnx_path).exists() and metadata_path.exists()):
+        return False
+    try:
+        metadata = json.loads(metadata_path.read_text())
+    except (OSError, ValueError):
+        return False
+    expected = dict(
+        version=ONNX_EXPORT_VERSION, opset_version=opset_version, seq_len=seq_len,
+        source=None if source_fpath is None else Path(source_fpath).name,
+    )
+    if any(metadata.get(key) != value for key, value in expected.items()):
+        return False
+    if source_fpath is None:
+        return True
+    fingerprint = {key[len("source_"):]: value for key, value in metadata.items() if key.startswith("source_")}
+    return matches_fingerprint(source_fpath, fingerprint)
+
+
+@torch.no_grad()
+def export_estimator_onnx(estimator: torch.nn.Module, onnx_path, opset_version=17, seq_len=256, source_fpath=None):
+    """
+    Export `estimator` (a `ConditionalDecoder`) to `onnx_path` for the CFG batch of 2, with a dynamic time axis.
+    `seq_len` is only the length of the example inputs used for tracing. The settings and the fingerprint of
+    `source_fpath`, the weights file of the estimator, are written to `onnx_metadata_path`, see `is_valid_estimator_onnx`.
+    Both files are written atomically, so that concurrent loaders never read a partial file.
+    """
+    onnx_path = Path(onnx_path)
+    onnx_path.parent.mkdir(parents=True, exist_ok=True)
+    param = next(estimator.parameters())
+    device, dtype = param.device, param.dtype
+    dummy_inputs = (
+        torch.randn(2, 80, seq_len, device=device, dtype=dtype),
+        torch.ones(2, 1, seq_len, device=device, dtype=dtype),
+        torch.randn(2, 80, seq_len, device=device, dtype=dtype),
+        torch.rand(2, device=device, dtype=dtype),
+        torch.randn(2, 80, device=device, dtype=dtype),
+        torch.randn(2, 80, seq_len, device=device, dtype=dtype),
+    )
+    time_axis = {2: "seq_len"}
+    tmp_path = onnx_path.with_name(f".{onnx_path.name}.{os.getpid()}.tmp")
+    was_training = estimator.training
+    estimator.eval()
+    try:
+        torch.onnx.export(
+            estimator,
+            dummy_inputs,
+            str(tmp_path),
+            export_params=True,
+            opset_version=opset_version,
+            do_constant_folding=True,
+            input_names=list(ESTIMATOR_INPUT_NAMES),
+            output_names=[ESTIMATOR_OUTPUT_NAME],
+            dynamic_axes={"x": time_axis, "mask": time_axis, "mu": time_axis, "cond": time_axis, ESTIMATOR_OUTPUT_NAME: time_axis},
+            dynamo=False,
+        )
+    finally:
+        estimator.train(was_training)
+    os.replace(tmp_path, onnx_path)
+    metadata_path = onnx_metadata_path(onnx_path)
+    tmp_path = metadata_path.with_name(f".{metadata_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(_export_metadata(source_fpath, opset_version, seq_len), indent=2))
+    os.replace(tmp_path, metadata_path)
+    logger.info(f"exported the CFM estimator to {onnx_path}")
+    return onnx_path
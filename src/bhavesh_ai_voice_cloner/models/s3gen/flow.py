@@ -242,7 +242,10 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  finalize):
+                  finalize,
+                  n_timesteps=10,
+                  solver=None,
+                  z=None):
         if self.fp16 is True:
             prompt_feat = prompt_feat.half()
             embedding = embedding.half()
@@ -275,7 +278,9 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10
+            n_timesteps=n_timesteps,
+            solver=solver,
+            z=z,
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -11,11 +11,30 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import threading
+import math
 import torch
 import torch.nn.functional as F
 from .matcha.flow_matching import BASECFM
-from .configs import CFM_PARAMS
+from .configs import CFM_PARAMS, CFM_SOLVER_PRESETS
+from .decoder import MidBlockFeatureCache
+from .estimator_backends import EstimatorBackend, TensorRTEstimator
+
+
+CFM_SOLVERS = ("euler", "heun", "midpoint", "dpm++2m")
+
+
+def resolve_cfm_solver(solver=None, n_timesteps=None, default_solver="euler", default_n_timesteps=10):
+    """
+    Turn a solver or preset name (see `CFM_SOLVER_PRESETS`) and an optional step count into
+    `(solver, n_timesteps)`. An explicit `n_timesteps` overrides the preset's.
+    """
+    solver = solver or default_solver
+    if solver in CFM_SOLVER_PRESETS:
+        preset = CFM_SOLVER_PRESETS[solver]
+        solver, n_timesteps = preset.solver, n_timesteps or preset.n_timesteps
+    if solver not in CFM_SOLVERS:
+        raise ValueError(f"unknown CFM solver {solver!r}, expected one of {CFM_SOLVERS + tuple(CFM_SOLVER_PRESETS)}")
+    return solver, n_timesteps or default_n_timesteps
 
 
 class ConditionalCFM(BASECFM):
@@ -32,10 +51,42 @@ class ConditionalCFM(BASECFM):
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
-        self.lock = threading.Lock()
+        # runs the estimator instead of `estimator` when set, see `set_estimator_backend`
+        self.estimator_backend: EstimatorBackend = None
+        # opt-in `MidBlockFeatureCache` kwargs, a fresh cache is used for every solve (see `set_feature_cache`)
+        self.feature_cache_kwargs = None
+        self.last_feature_cache = None
+
+    def set_feature_cache(self, schedule=2, num_shallow_blocks=0):
+        """
+        Reuse the deep mid block features of the estimator across ODE steps, running the full network only on
+        the calls picked by `schedule` (see `MidBlockFeatureCache`). `schedule=None` turns it off.
+        The cache of the latest solve is kept in `last_feature_cache` for its statistics.
+        """
+        if schedule is None:
+            self.feature_cache_kwargs = None
+        else:
+            self.feature_cache_kwargs = dict(schedule=schedule, num_shallow_blocks=num_shallow_blocks)
+
+    def set_estimator_backend(self, backend: EstimatorBackend = None):
+        """
+        Run the estimator with `backend` (e.g. `OnnxRuntimeEstimator`), or with the eager `estimator` module
+        for None. The PyTorch-only optimizations (`prepare_context`, the feature cache) are skipped by backends.
+        """
+        self.estimator_backend = backend
+
+    @property
+    def uses_torch_estimator(self):
+        return self.estimator_backend is None and isinstance(self.estimator, torch.nn.Module)
+
+    def _new_feature_cache(self):
+        if self.feature_cache_kwargs is None or not self.uses_torch_estimator:
+            return None
+        self.last_feature_cache = MidBlockFeatureCache(**self.feature_cache_kwargs)
+        return self.last_feature_cache
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2), solver=None):
         """Forward diffusion
 
         Args:
@@ -48,6 +99,7 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): one of `CFM_SOLVERS`. Defaults to `cfm_params.solver`.
 
         Returns:
             sample: generated mel-spectrogram
@@ -67,7 +119,20 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver), flow_cache
+
+    def solve(self, x, t_span, mu, mask, spks, cond, solver=None):
+        "Integrate from noise `x` along `t_span` with the named ODE solver (see `CFM_SOLVERS`)."
+        solver = solver or self.solver
+        if solver == "euler":
+            return self.solve_euler(x, t_span, mu, mask, spks, cond)
+        elif solver == "heun":
+            return self.solve_heun(x, t_span, mu, mask, spks, cond)
+        elif solver == "midpoint":
+            return self.solve_midpoint(x, t_span, mu, mask, spks, cond)
+        elif solver == "dpm++2m":
+            return self.solve_dpm_multistep(x, t_span, mu, mask, spks, cond)
+        raise ValueError(f"unknown CFM solver {solver!r}, expected one of {CFM_SOLVERS}")
 
     def solve_euler(self, x, t_span, mu, mask, spks, cond):
         """
@@ -84,13 +149,76 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
+        ts = t_span.tolist()
+        estimator_inputs = self._cfg_estimator_inputs(x, mask, mu, spks, cond, timesteps=ts[:-1])
+        feature_cache = self._new_feature_cache()
+        for t, t_next in zip(ts[:-1], ts[1:]):
+            x = x + (t_next - t) * self._velocity(x, t, estimator_inputs, feature_cache)
+
+        return x.float()
+
+    def solve_heun(self, x, t_span, mu, mask, spks, cond):
+        "Heun's method (explicit trapezoid): second order, two estimator calls per step. Same args as `solve_euler`."
+        ts = t_span.tolist()
+        estimator_inputs = self._cfg_estimator_inputs(x, mask, mu, spks, cond, timesteps=ts)
+        feature_cache = self._new_feature_cache()
+        for t, t_next in zip(ts[:-1], ts[1:]):
+            dt = t_next - t
+            dphi_dt = self._velocity(x, t, estimator_inputs, feature_cache)
+            dphi_dt_next = self._velocity(x + dt * dphi_dt, t_next, estimator_inputs, feature_cache)
+            x = x + 0.5 * dt * (dphi_dt + dphi_dt_next)
 
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+        return x.float()
 
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond):
+        "Explicit midpoint method: second order, two estimator calls per step. Same args as `solve_euler`."
+        ts = t_span.tolist()
+        midpoints = [t + 0.5 * (t_next - t) for t, t_next in zip(ts[:-1], ts[1:])]
+        estimator_inputs = self._cfg_estimator_inputs(x, mask, mu, spks, cond, timesteps=ts[:-1] + midpoints)
+        feature_cache = self._new_feature_cache()
+        for t, t_next, t_mid in zip(ts[:-1], ts[1:], midpoints):
+            dt = t_next - t
+            dphi_dt = self._velocity(x, t, estimator_inputs, feature_cache)
+            x = x + dt * self._velocity(x + 0.5 * dt * dphi_dt, t_mid, estimator_inputs, feature_cache)
+
+        return x.float()
+
+    def solve_dpm_multistep(self, x, t_span, mu, mask, spks, cond):
+        """
+        DPM-Solver++(2M) for the flow matching path x_t = t * x_1 + (1 - t) * x_0: second order multistep in the
+        data prediction x_1 = x_t + (1 - t) * v, reusing the previous step's prediction, so one estimator call per
+        step. It reduces to Euler on the first step (no previous prediction), the second when the schedule starts
+        at t=0 (the log-SNR of the previous step is -inf) and the last (that of t=1 is +inf): with the default
+        cosine schedule, n >= 3 steps take n - 3 second order ones. Same args as `solve_euler`.
+        """
+        ts = t_span.tolist()
+        estimator_inputs = self._cfg_estimator_inputs(x, mask, mu, spks, cond, timesteps=ts[:-1])
+        feature_cache = self._new_feature_cache()
+        lambda_ = lambda t: math.log(t) - math.log1p(-t)  # log-SNR, log(alpha / sigma)
+
+        x1_prev, t_prev = None, None
+        for t, t_next in zip(ts[:-1], ts[1:]):
+            dphi_dt = self._velocity(x, t, estimator_inputs, feature_cache)
+            x1 = x + (1 - t) * dphi_dt
+            if x1_prev is None or t_prev <= 0 or t_next >= 1:
+                x = x + (t_next - t) * dphi_dt
+            else:
+                h = lambda_(t_next) - lambda_(t)
+                r = (lambda_(t) - lambda_(t_prev)) / h
+                x1_hat = (1 + 0.5 / r) * x1 - (0.5 / r) * x1_prev
+                sigma_ratio = (1 - t_next) / (1 - t)
+                x = sigma_ratio * x + (t_next - t * sigma_ratio) * x1_hat
+            x1_prev, t_prev = x1, t
+
+        return x.float()
+
+    def _cfg_estimator_inputs(self, x, mask, mu, spks, cond, timesteps=()):
+        """
+        Estimator inputs for Classifier-Free Guidance (introduced in VoiceBox): a (conditional, unconditional)
+        batch of 2. Only `x` and `t` change between steps, see `_velocity`. An estimator with `prepare_context`
+        (`ConditionalDecoder`) also gets the step-invariant part of its work, including the time embeddings of
+        `timesteps`, done here once.
+        """
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
         x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
         mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
@@ -98,50 +226,36 @@ class ConditionalCFM(BASECFM):
         t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
         spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
         cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
+        mask_in[:] = mask
+        mu_in[0] = mu
+        spks_in[0] = spks
+        cond_in[0] = cond
+        context = None
+        if self.uses_torch_estimator and hasattr(self.estimator, "prepare_context"):
+            context = self.estimator.prepare_context(mask_in, mu_in, spks_in, cond_in, timesteps=timesteps)
+        return x_in, mask_in, mu_in, t_in, spks_in, cond_in, context
+
+    def _velocity(self, x, t, estimator_inputs, feature_cache=None):
+        "Guided vector field dphi/dt at (x, t), `t` being a float."
+        x_in, mask_in, mu_in, t_in, spks_in, cond_in, context = estimator_inputs
+        if context is not None:
+            dphi_dt = self.estimator.forward_prepared(x, t, context, feature_cache=feature_cache)
+        else:
             x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
-
-        return sol[-1].float()
-
-    def forward_estimator(self, x, mask, mu, t, spks, cond):
-        if isinstance(self.estimator, torch.nn.Module):
+            t_in[:] = t
+            dphi_dt = self.forward_estimator(x_in, mask_in, mu_in, t_in, spks_in, cond_in, feature_cache=feature_cache)
+        dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+        return (1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt
+
+    def forward_estimator(self, x, mask, mu, t, spks, cond, feature_cache=None):
+        if self.uses_torch_estimator:
+            if feature_cache is not None:
+                return self.estimator.forward(x, mask, mu, t, spks, cond, feature_cache=feature_cache)
             return self.estimator.forward(x, mask, mu, t, spks, cond)
-        else:
-            with self.lock:
-                self.estimator.set_input_shape('x', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                self.estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('t', (2,))
-                self.estimator.set_input_shape('spks', (2, 80))
-                self.estimator.set_input_shape('cond', (2, 80, x.size(2)))
-                # run trt engine
-                self.estimator.execute_v2([x.contiguous().data_ptr(),
-                                           mask.contiguous().data_ptr(),
-                                           mu.contiguous().data_ptr(),
-                                           t.contiguous().data_ptr(),
-                                           spks.contiguous().data_ptr(),
-                                           cond.contiguous().data_ptr(),
-                                           x.data_ptr()])
-            return x
+        if self.estimator_backend is None:
+            # a bare TensorRT engine assigned to `estimator`
+            self.estimator_backend = TensorRTEstimator(self.estimator)
+        return self.estimator_backend(x, mask, mu, t, spks, cond)
 
     def compute_loss(self, x1, mask, mu, spks=None, cond=None):
         """Computes diffusion loss
@@ -191,7 +305,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, solver=None, z=None):
         """Forward diffusion
 
         Args:
@@ -204,15 +318,24 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): one of `CFM_SOLVERS`. Defaults to `cfm_params.solver`.
+            z (torch.Tensor, optional): starting noise, e.g. from `noise_at`. Defaults to the first frames of `rand_noise`.
+                shape: (batch_size, n_feats, mel_timesteps)
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        if z is None:
+            z = self.rand_noise[:, :, :mu.size(2)]
+        z = z.to(mu.device).to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver), None
+
+    def noise_at(self, positions):
+        "The fixed noise of the mel frames at `positions` (LongTensor, wrapping around), as (1, 80, len(positions))."
+        return self.rand_noise[:, :, positions % self.rand_noise.size(2)]
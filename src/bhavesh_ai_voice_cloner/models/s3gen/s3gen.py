@@ -16,20 +16,21 @@ import logging
 
 import numpy as np
 import torch
-import torchaudio as ta
-from functools import lru_cache
 from typing import Optional
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
+from ..utils import get_resampler
 from .const import S3GEN_SR
 from .flow import CausalMaskedDiffWithXvec
 from .xvector import CAMPPlus
-from .utils.mel import mel_spectrogram
+from .utils.mel import mel_spectrogram, mel_spectrogram_batch
 from .f0_predictor import ConvRNNF0Predictor
 from .hifigan import HiFTGenerator
 from .transformer.upsample_encoder import UpsampleConformerEncoder
-from .flow_matching import CausalConditionalCFM
+from .flow_matching import CausalConditionalCFM, resolve_cfm_solver
 from .decoder import ConditionalDecoder
+from .estimator_backends import ESTIMATOR_BACKENDS, OnnxRuntimeEstimator, export_estimator_onnx, is_valid_estimator_onnx
+from .streaming import S3GenStreamSession
 from .configs import CFM_PARAMS
 
 
@@ -38,12 +39,6 @@ def drop_invalid_tokens(x):
     return x[x < SPEECH_VOCAB_SIZE]
 
 
-# TODO: global resampler cache
-@lru_cache(100)
-def get_resampler(src_sr, dst_sr, device):
-    return ta.transforms.Resample(src_sr, dst_sr).to(device)
-
-
 class S3Token2Mel(torch.nn.Module):
     """
     CosyVoice2's CFM decoder maps S3 speech tokens to mel-spectrograms.
@@ -104,57 +99,104 @@ class S3Token2Mel(torch.nn.Module):
         params = self.tokenizer.parameters()
         return next(params).device
 
+    def set_flow_feature_cache(self, schedule=2, num_shallow_blocks=0):
+        """
+        Opt-in reuse of the deep estimator features across flow ODE steps, see `MidBlockFeatureCache`.
+        `schedule=None` turns it off. Only used by the eager "torch" estimator backend.
+        """
+        self.flow.decoder.set_feature_cache(schedule=schedule, num_shallow_blocks=num_shallow_blocks)
+
+    def set_estimator_backend(self, backend="torch", onnx_path=None, num_sessions=2, intra_op_num_threads=0, source_fpath=None):
+        """
+        Pick the runtime of the flow decoder's estimator:
+            "torch": eager PyTorch (default).
+            "onnxruntime": ONNX Runtime on CPU with a pool of `num_sessions` sessions, see `OnnxRuntimeEstimator`.
+                The estimator is exported to `onnx_path` first unless that file was exported from the current
+                content of `source_fpath`, the weights file S3Gen was loaded from (see `is_valid_estimator_onnx`).
+        """
+        cfm = self.flow.decoder
+        if backend == "torch":
+            cfm.set_estimator_backend(None)
+        elif backend == "onnxruntime":
+            assert onnx_path is not None, "onnxruntime needs an onnx_path"
+            if not is_valid_estimator_onnx(onnx_path, source_fpath):
+                export_estimator_onnx(cfm.estimator, onnx_path, source_fpath=source_fpath)
+            cfm.set_estimator_backend(
+                OnnxRuntimeEstimator(onnx_path, num_sessions=num_sessions, intra_op_num_threads=intra_op_num_threads)
+            )
+        else:
+            raise ValueError(f"unknown estimator backend {backend!r}, expected one of {ESTIMATOR_BACKENDS}")
+
     def embed_ref(
         self,
         ref_wav: torch.Tensor,
         ref_sr: int,
         device="auto",
         ref_fade_out=True,
+        ref_wav_16: Optional[torch.Tensor] = None,
     ):
-        device = self.device if device == "auto" else device
+        """
+        `ref_wav_16`: the same clip at 16 kHz if the caller has it already (e.g. `AudioClip.at(S3_SR)`), so
+        that it is not resampled again.
+        """
         if isinstance(ref_wav, np.ndarray):
             ref_wav = torch.from_numpy(ref_wav).float()
+        if len(ref_wav.shape) == 2:
+            assert ref_wav.size(0) == 1, "use `embed_refs` for many reference clips"
+        ref_wavs_16 = None if ref_wav_16 is None else [torch.as_tensor(ref_wav_16).view(-1)]
+        return self.embed_refs([ref_wav.view(-1)], ref_sr, device=device, ref_wavs_16=ref_wavs_16)[0]
 
-        if ref_wav.device != device:
-            ref_wav = ref_wav.to(device)
-
-        if len(ref_wav.shape) == 1:
-            ref_wav = ref_wav.unsqueeze(0)  # (B, L)
+    @torch.no_grad()
+    def embed_refs(self, ref_wavs, ref_sr: int, device="auto", ref_wavs_16=None):
+        """
+        `embed_ref` of many reference clips (1-D, of any lengths) at once: the mels, CAMPPlus x-vectors and
+        S3 tokens are computed in padded batches, masked so that every `ref_dict` is that of its clip alone.
+        `ref_wavs_16` are the same clips at 16 kHz, if available.
 
-        if ref_wav.size(1) > 10 * ref_sr:
+        Returns:
+            a list with the `ref_dict` of each clip
+        """
+        device = self.device if device == "auto" else device
+        ref_wavs = [torch.from_numpy(w).float() if isinstance(w, np.ndarray) else w for w in ref_wavs]
+        ref_wavs = [w.to(device) for w in ref_wavs]
+        if any(w.size(-1) > 10 * ref_sr for w in ref_wavs):
             print("WARNING: cosydec received ref longer than 10s")
 
-        ref_wav_24 = ref_wav
+        ref_wavs_24 = ref_wavs
         if ref_sr != S3GEN_SR:
-            ref_wav_24 = get_resampler(ref_sr, S3GEN_SR, device)(ref_wav)
-
-        ref_mels_24 = self.mel_extractor(ref_wav_24).transpose(1, 2).to(device)
-        ref_mels_24_len = None
+            ref_wavs_24 = [get_resampler(ref_sr, S3GEN_SR, device)(w) for w in ref_wavs]
+        ref_mels_24, ref_mels_24_lens = mel_spectrogram_batch(ref_wavs_24)  # (B, 80, T)
 
         # Resample to 16kHz
-        ref_wav_16 = get_resampler(ref_sr, S3_SR, device)(ref_wav).to(device)
+        if ref_wavs_16 is None:
+            ref_wavs_16 = [get_resampler(ref_sr, S3_SR, device)(w) for w in ref_wavs]
+        else:
+            ref_wavs_16 = [torch.as_tensor(w).float().to(device) for w in ref_wavs_16]
 
         # Speaker embedding
-        ref_x_vector = self.speaker_encoder.inference(ref_wav_16)
+        ref_x_vectors = self.speaker_encoder.inference(ref_wavs_16)
 
         # Tokenize 16khz reference
-        ref_speech_tokens, ref_speech_token_lens = self.tokenizer(ref_wav_16)
-
-        # Make sure mel_len = 2 * stoken_len (happens when the input is not padded to multiple of 40ms)
-        if ref_mels_24.shape[1] != 2 * ref_speech_tokens.shape[1]:
-            logging.warning(
-                "Reference mel length is not equal to 2 * reference token length.\n"
-            )
-            ref_speech_tokens = ref_speech_tokens[:, :ref_mels_24.shape[1] // 2]
-            ref_speech_token_lens[0] = ref_speech_tokens.shape[1]
-
-        return dict(
-            prompt_token=ref_speech_tokens.to(device),
-            prompt_token_len=ref_speech_token_lens,
-            prompt_feat=ref_mels_24,
-            prompt_feat_len=ref_mels_24_len,
-            embedding=ref_x_vector,
-        )
+        ref_speech_tokens, ref_speech_token_lens = self.tokenizer(ref_wavs_16)
+
+        ref_dicts = []
+        for i, mel_len in enumerate(ref_mels_24_lens.tolist()):
+            ref_mels = ref_mels_24[i:i + 1, :, :mel_len].transpose(1, 2)
+            token_len = ref_speech_token_lens[i].item()
+            # Make sure mel_len = 2 * stoken_len (happens when the input is not padded to multiple of 40ms)
+            if mel_len != 2 * token_len:
+                logging.warning(
+                    "Reference mel length is not equal to 2 * reference token length.\n"
+                )
+                token_len = min(token_len, mel_len // 2)
+            ref_dicts.append(dict(
+                prompt_token=ref_speech_tokens[i:i + 1, :token_len].to(device),
+                prompt_token_len=torch.LongTensor([token_len]).to(ref_speech_token_lens.device),
+                prompt_feat=ref_mels.contiguous(),
+                prompt_feat_len=None,
+                embedding=ref_x_vectors[i:i + 1],
+            ))
+        return ref_dicts
 
     def forward(
         self,
@@ -165,6 +207,8 @@ class S3Token2Mel(torch.nn.Module):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        n_timesteps: Optional[int] = None,
+        solver: Optional[str] = None,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -181,6 +225,8 @@ class S3Token2Mel(torch.nn.Module):
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `n_timesteps`, `solver`: CFM ODE steps and solver ("euler", "heun", "midpoint", "dpm++2m"), or a preset
+          name ("quality", "balanced", "fast", see `CFM_SOLVER_PRESETS`). Defaults to 10 Euler steps.
         """
         assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
 
@@ -200,10 +246,13 @@ class S3Token2Mel(torch.nn.Module):
         # assert speech_tokens.shape[0] == 1, "only batch size of one allowed for now"
         speech_token_lens = torch.LongTensor([speech_tokens.size(1)]).to(self.device)
 
+        solver, n_timesteps = resolve_cfm_solver(solver, n_timesteps)
         output_mels, _ = self.flow.inference(
             token=speech_tokens,
             token_len=speech_token_lens,
             finalize=finalize,
+            n_timesteps=n_timesteps,
+            solver=solver,
             **ref_dict,
         )
         return output_mels
@@ -235,6 +284,13 @@ class S3Token2Wav(S3Token2Mel):
         trim_fade[n_trim:] = (torch.cos(torch.linspace(torch.pi, 0, n_trim)) + 1) / 2
         self.register_buffer("trim_fade", trim_fade, persistent=False) # (buffers get automatic device casting)
 
+        # streaming: the last mel frames of a chunk are synthesized again with the next one, reusing the HiFT
+        # source excitation, and the two renderings of that audio are cross-faded
+        self.stream_mel_cache_len = 8
+        self.stream_source_cache_len = self.stream_mel_cache_len * S3GEN_SR // 50  # 480 samples per mel frame
+        stream_window = torch.hamming_window(2 * self.stream_source_cache_len, periodic=False)
+        self.register_buffer("stream_window", stream_window, persistent=False)
+
     def forward(
         self,
         speech_tokens,
@@ -243,9 +299,14 @@ class S3Token2Wav(S3Token2Mel):
         ref_sr: Optional[int],
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
-        finalize: bool = False
+        finalize: bool = False,
+        n_timesteps: Optional[int] = None,
+        solver: Optional[str] = None,
     ):
-        output_mels = super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        output_mels = super().forward(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
+            n_timesteps=n_timesteps, solver=solver,
+        )
 
         # TODO jrm: ignoring the speed control (mel interpolation) and the HiFTGAN caching mechanisms for now.
         hift_cache_source = torch.zeros(1, 1, 0).to(self.device)
@@ -268,8 +329,13 @@ class S3Token2Wav(S3Token2Mel):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        n_timesteps: Optional[int] = None,
+        solver: Optional[str] = None,
     ):
-        return super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        return super().forward(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
+            n_timesteps=n_timesteps, solver=solver,
+        )
 
     @torch.inference_mode()
     def hift_inference(self, speech_feat, cache_source: torch.Tensor = None):
@@ -288,11 +354,25 @@ class S3Token2Wav(S3Token2Mel):
         ref_dict: Optional[dict] = None,
         cache_source: torch.Tensor = None, # NOTE: this arg is for streaming, it can probably be removed here
         finalize: bool = True,
+        n_timesteps: Optional[int] = None,
+        solver: Optional[str] = None,
     ):
-        output_mels = self.flow_inference(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        output_mels = self.flow_inference(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
+            n_timesteps=n_timesteps, solver=solver,
+        )
         output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
 
         # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    def stream_session(self, ref_dict: dict, chunk_size=25, context_tokens=10, n_timesteps=None, solver=None):
+        """
+        Start streaming synthesis of one utterance, see `S3GenStreamSession`: audio comes out every
+        `chunk_size` tokens, the flow looking back at `context_tokens` tokens of the previous chunks.
+        """
+        return S3GenStreamSession(
+            self, ref_dict, chunk_size=chunk_size, context_tokens=context_tokens, n_timesteps=n_timesteps, solver=solver,
+        )
@@ -0,0 +1,151 @@
+# Copyright (c) 2025 Bhavesh AI
+# MIT License
+from typing import Optional
+
+import numpy as np
+import torch
+
+from .flow_matching import resolve_cfm_solver
+
+
+def fade_in_out(fade_in_wav, fade_out_wav, window):
+    "Cross-fade the start of `fade_in_wav` with the end of `fade_out_wav` (both (B, L)), `window` has 2x overlap length."
+    overlap = window.size(0) // 2
+    fade_in_wav = fade_in_wav.clone()
+    fade_in_wav[..., :overlap] = fade_in_wav[..., :overlap] * window[:overlap] + fade_out_wav[..., -overlap:] * window[overlap:]
+    return fade_in_wav
+
+
+class S3GenStreamSession:
+    """
+    Incremental token-to-waveform synthesis for one utterance: `push` speech tokens as they are sampled, get
+    24 kHz audio back, and `flush` at the end. Create it with `S3Gen.stream_session`.
+
+    Every chunk costs the same, whatever has been synthesized before. The flow runs on the reference prompt,
+    the last `context_tokens` tokens already turned into audio and the new tokens only:
+        - flow overlap: the mels of the context tokens are fed to the decoder as more prompt (conditioning), and
+          every mel frame uses the fixed noise of its position in the utterance, so a chunk continues the
+          previous one.
+        - the mels of the last `pre_lookahead_len` tokens wait for the next chunk, as they need the tokens after them.
+        - vocoder overlap: the last `stream_mel_cache_len` mel frames and their HiFT source excitation are fed
+          again with the next chunk; the audio of those frames is held back and cross-faded with it.
+    """
+
+    def __init__(
+        self,
+        s3gen,
+        ref_dict: dict,
+        chunk_size=25,
+        context_tokens=10,
+        n_timesteps: Optional[int] = None,
+        solver: Optional[str] = None,
+    ):
+        self.s3gen = s3gen
+        self.flow = s3gen.flow
+        self.device = s3gen.device
+        ref_dict = {
+            k: (torch.from_numpy(v) if isinstance(v, np.ndarray) else v) for k, v in ref_dict.items()
+        }
+        ref_dict = {k: (v.to(self.device) if torch.is_tensor(v) else v) for k, v in ref_dict.items()}
+        self.prompt_token = ref_dict["prompt_token"]
+        # 2 mel frames per token, so that the context mels line up with their tokens
+        self.prompt_feat = ref_dict["prompt_feat"][:, :self.flow.token_mel_ratio * self.prompt_token.size(1)]
+        self.embedding = ref_dict["embedding"]
+
+        self.lookahead = self.flow.pre_lookahead_len
+        self.min_chunk_tokens = -(-s3gen.stream_mel_cache_len // self.flow.token_mel_ratio)
+        self.chunk_size = max(chunk_size, self.min_chunk_tokens)
+        self.context_tokens = context_tokens
+        self.solver, self.n_timesteps = resolve_cfm_solver(solver, n_timesteps)
+
+        self.speech_tokens = torch.zeros(1, 0, dtype=torch.long, device=self.device)
+        self.token_offset = 0  # number of tokens whose mels were vocoded
+        self.context_mels = torch.zeros(1, self.flow.output_size, 0, device=self.device)
+        self.hift_cache: Optional[dict] = None
+        self.finished = False
+
+    @property
+    def num_pending_tokens(self):
+        return self.speech_tokens.size(1) - self.token_offset
+
+    @torch.inference_mode()
+    def push(self, speech_tokens) -> torch.Tensor:
+        """
+        Add new speech tokens, (n,) or (1, n). Returns the (1, L) audio that became ready, empty until
+        `chunk_size` tokens (plus the lookahead) are pending.
+        """
+        assert not self.finished, "session already flushed"
+        speech_tokens = speech_tokens.to(self.device).view(1, -1)
+        self.speech_tokens = torch.cat([self.speech_tokens, speech_tokens], dim=1)
+        if self.num_pending_tokens < self.chunk_size + self.lookahead:
+            return torch.zeros(1, 0, device=self.device)
+        return self._synthesize(finalize=False)
+
+    @torch.inference_mode()
+    def flush(self) -> torch.Tensor:
+        "Synthesize the remaining tokens, including the held-back audio. Ends the session."
+        assert not self.finished, "session already flushed"
+        self.finished = True
+        if self.num_pending_tokens == 0:
+            if self.hift_cache is None:
+                return torch.zeros(1, 0, device=self.device)
+            return self.hift_cache["speech"]
+        return self._synthesize(finalize=True)
+
+    def _synthesize(self, finalize):
+        ratio = self.flow.token_mel_ratio
+        end = self.speech_tokens.size(1) if finalize else self.speech_tokens.size(1) - self.lookahead
+        start = max(0, self.token_offset - self.context_tokens)
+        n_context = self.token_offset - start
+
+        # flow: the context tokens extend the prompt, their mels the prompt features
+        context_mels = self.context_mels[:, :, self.context_mels.size(2) - n_context * ratio:]
+        prompt_token = torch.cat([self.prompt_token, self.speech_tokens[:, start:self.token_offset]], dim=1)
+        prompt_feat = torch.cat([self.prompt_feat, context_mels.transpose(1, 2).to(self.prompt_feat.dtype)], dim=1)
+        token = self.speech_tokens[:, self.token_offset:]
+        n_prompt = self.prompt_feat.size(1)
+        positions = torch.cat([
+            torch.arange(n_prompt),
+            torch.arange(n_prompt + start * ratio, n_prompt + end * ratio),
+        ])
+        mels, _ = self.flow.inference(
+            token=token,
+            token_len=torch.LongTensor([token.size(1)]).to(self.device),
+            prompt_token=prompt_token,
+            prompt_token_len=torch.LongTensor([prompt_token.size(1)]).to(self.device),
+            prompt_feat=prompt_feat,
+            prompt_feat_len=None,
+            embedding=self.embedding,
+            finalize=finalize,
+            n_timesteps=self.n_timesteps,
+            solver=self.solver,
+            z=self.flow.decoder.noise_at(positions),
+        )
+        self.token_offset = end
+        context_mels = torch.cat([self.context_mels, mels], dim=2)
+        self.context_mels = context_mels[:, :, max(0, context_mels.size(2) - self.context_tokens * ratio):]
+
+        # vocoder, with the mel / source overlap of the previous chunk
+        s3gen = self.s3gen
+        if self.hift_cache is not None:
+            mels = torch.cat([self.hift_cache["mel"], mels], dim=2)
+            cache_source = self.hift_cache["source"]
+        else:
+            cache_source = torch.zeros(1, 1, 0, device=self.device)
+        wavs, sources = s3gen.hift_inference(mels, cache_source)
+        if self.hift_cache is not None:
+            wavs = fade_in_out(wavs, self.hift_cache["speech"], s3gen.stream_window)
+        else:
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            wavs[:, :len(s3gen.trim_fade)] *= s3gen.trim_fade
+
+        if finalize:
+            self.hift_cache = None
+            return wavs
+        n_held = s3gen.stream_source_cache_len
+        self.hift_cache = dict(
+            mel=mels[:, :, -s3gen.stream_mel_cache_len:],
+            source=sources[:, :, -n_held:],
+            speech=wavs[:, -n_held:],
+        )
+        return wavs[:, :-n_held]
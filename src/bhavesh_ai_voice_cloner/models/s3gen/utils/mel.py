@@ -1,8 +1,9 @@
 """mel-spectrogram extraction in Matcha-TTS"""
-from librosa.filters import mel as librosa_mel_fn
 import torch
 import numpy as np
 
+from ...spectral import get_spectral_frontend
+
 
 # NOTE: they decalred these global vars
 mel_basis = {}
@@ -42,13 +43,10 @@ def mel_spectrogram(y, n_fft=1920, num_mels=80, sampling_rate=24000, hop_size=48
     if len(y.shape) == 1:
         y = y[None, ]
 
-    if torch.min(y) < -1.0:
-        print("min value is ", torch.min(y))
-    if torch.max(y) > 1.0:
-        print("max value is ", torch.max(y))
-
     global mel_basis, hann_window  # pylint: disable=global-statement,global-variable-not-assigned
     if f"{str(fmax)}_{str(y.device)}" not in mel_basis:
+        from librosa.filters import mel as librosa_mel_fn  # deferred, imports scipy.signal and numba
+
         mel = librosa_mel_fn(sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax)
         mel_basis[str(fmax) + "_" + str(y.device)] = torch.from_numpy(mel).float().to(y.device)
         hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
@@ -79,3 +77,14 @@ def mel_spectrogram(y, n_fft=1920, num_mels=80, sampling_rate=24000, hop_size=48
     spec = spectral_normalize_torch(spec)
 
     return spec
+
+
+def mel_spectrogram_batch(wavs):
+    """
+    `mel_spectrogram` (default settings) of many 1-D waveforms of different lengths in one padded batch, see
+    `SpectralFrontend.s3gen_mel`.
+
+    Returns:
+        (B, num_mels, T_max) mels and the (B,) numbers of frames
+    """
+    return get_spectral_frontend(wavs[0].device).s3gen_mel(wavs)
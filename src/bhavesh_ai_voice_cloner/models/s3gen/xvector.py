@@ -9,7 +9,8 @@ from collections import OrderedDict
 import torch
 import torch.nn.functional as F
 import torch.utils.checkpoint as cp
-import torchaudio.compliance.kaldi as Kaldi
+
+from ..spectral import get_spectral_frontend
 
 
 def pad_list(xs, pad_value):
@@ -43,19 +44,13 @@ def pad_list(xs, pad_value):
 
 
 def extract_feature(audio):
-    features = []
-    feature_times = []
-    feature_lengths = []
-    for au in audio:
-        feature = Kaldi.fbank(au.unsqueeze(0), num_mel_bins=80)
-        feature = feature - feature.mean(dim=0, keepdim=True)
-        features.append(feature)
-        feature_times.append(au.shape[0])
-        feature_lengths.append(feature.shape[0])
-    # padding for batch inference
-    features_padded = pad_list(features, pad_value=0)
-    # features = torch.cat(features)
-    return features_padded, feature_lengths, feature_times
+    # mean-normalized Kaldi fbank of every utterance, computed in one padded batch (0 on padding)
+    features, feature_lengths = get_spectral_frontend(audio[0].device).kaldi_fbank(list(audio))
+    mask = (torch.arange(features.size(1), device=features.device) < feature_lengths.to(features.device)[:, None])[..., None]
+    mean = (features * mask).sum(dim=1, keepdim=True) / feature_lengths.to(features.device)[:, None, None]
+    features_padded = (features - mean).masked_fill(~mask, 0.0)
+    feature_times = [au.shape[0] for au in audio]
+    return features_padded, feature_lengths.tolist(), feature_times
 
 
 class BasicResBlock(torch.nn.Module):
@@ -83,8 +78,13 @@ class BasicResBlock(torch.nn.Module):
                 torch.nn.BatchNorm2d(self.expansion * planes),
             )
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
+        # `mask` (B, 1, 1, T) zeroes the padding of a batch before every convolution over time
+        if mask is not None:
+            x = x * mask
         out = F.relu(self.bn1(self.conv1(x)))
+        if mask is not None:
+            out = out * mask
         out = self.bn2(self.conv2(out))
         out += self.shortcut(x)
         out = F.relu(out)
@@ -115,12 +115,19 @@ class FCM(torch.nn.Module):
             self.in_planes = planes * block.expansion
         return torch.nn.Sequential(*layers)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         x = x.unsqueeze(1)
-        out = F.relu(self.bn1(self.conv1(x)))
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = F.relu(self.bn2(self.conv2(out)))
+        if mask is None:
+            out = F.relu(self.bn1(self.conv1(x)))
+            out = self.layer1(out)
+            out = self.layer2(out)
+            out = F.relu(self.bn2(self.conv2(out)))
+        else:
+            mask = mask.unsqueeze(1)  # (B, 1, T) -> (B, 1, 1, T)
+            out = F.relu(self.bn1(self.conv1(x * mask)))
+            for block in (*self.layer1, *self.layer2):
+                out = block(out, mask)
+            out = F.relu(self.bn2(self.conv2(out * mask)))
 
         shape = out.shape
         out = out.reshape(shape[0], shape[1] * shape[2], shape[3])
@@ -143,9 +150,16 @@ def get_nonlinear(config_str, channels):
     return nonlinear
 
 
-def statistics_pooling(x, dim=-1, keepdim=False, unbiased=True, eps=1e-2):
-    mean = x.mean(dim=dim)
-    std = x.std(dim=dim, unbiased=unbiased)
+def statistics_pooling(x, dim=-1, keepdim=False, unbiased=True, eps=1e-2, mask=None):
+    if mask is None:
+        mean = x.mean(dim=dim)
+        std = x.std(dim=dim, unbiased=unbiased)
+    else:
+        # statistics of the frames where `mask` is 1 only
+        n = mask.sum(dim=dim)
+        mean = (x * mask).sum(dim=dim) / n
+        var = ((x - mean.unsqueeze(dim)) ** 2 * mask).sum(dim=dim) / (n - 1 if unbiased else n)
+        std = var.sqrt()
     stats = torch.cat([mean, std], dim=-1)
     if keepdim:
         stats = stats.unsqueeze(dim=dim)
@@ -153,8 +167,8 @@ def statistics_pooling(x, dim=-1, keepdim=False, unbiased=True, eps=1e-2):
 
 
 class StatsPool(torch.nn.Module):
-    def forward(self, x):
-        return statistics_pooling(x)
+    def forward(self, x, mask=None):
+        return statistics_pooling(x, mask=mask)
 
 
 class TDNNLayer(torch.nn.Module):
@@ -211,17 +225,27 @@ class CAMLayer(torch.nn.Module):
         self.linear2 = torch.nn.Conv1d(bn_channels // reduction, out_channels, 1)
         self.sigmoid = torch.nn.Sigmoid()
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
+        if mask is None:
+            context = x.mean(-1, keepdim=True) + self.seg_pooling(x)
+        else:
+            x = x * mask
+            context = x.sum(-1, keepdim=True) / mask.sum(-1, keepdim=True) + self.seg_pooling(x, mask=mask)
         y = self.linear_local(x)
-        context = x.mean(-1, keepdim=True) + self.seg_pooling(x)
         context = self.relu(self.linear1(context))
         m = self.sigmoid(self.linear2(context))
         return y * m
 
-    def seg_pooling(self, x, seg_len=100, stype="avg"):
-        if stype == "avg":
+    def seg_pooling(self, x, seg_len=100, stype="avg", mask=None):
+        if stype == "avg" and mask is not None:
+            # average of the unmasked frames of each segment (`x` is already masked)
+            seg = F.avg_pool1d(x, kernel_size=seg_len, stride=seg_len, ceil_mode=True)
+            seg = seg / F.avg_pool1d(mask, kernel_size=seg_len, stride=seg_len, ceil_mode=True).clamp(min=1e-6)
+        elif stype == "avg":
             seg = F.avg_pool1d(x, kernel_size=seg_len, stride=seg_len, ceil_mode=True)
         elif stype == "max":
+            if mask is not None:
+                x = x.masked_fill(mask == 0, -torch.inf)
             seg = F.max_pool1d(x, kernel_size=seg_len, stride=seg_len, ceil_mode=True)
         else:
             raise ValueError("Wrong segment pooling type.")
@@ -266,12 +290,12 @@ class CAMDenseTDNNLayer(torch.nn.Module):
     def bn_function(self, x):
         return self.linear1(self.nonlinear1(x))
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         if self.training and self.memory_efficient:
             x = cp.checkpoint(self.bn_function, x)
         else:
             x = self.bn_function(x)
-        x = self.cam_layer(self.nonlinear2(x))
+        x = self.cam_layer(self.nonlinear2(x), mask)
         return x
 
 
@@ -304,9 +328,9 @@ class CAMDenseTDNNBlock(torch.nn.ModuleList):
             )
             self.add_module("tdnnd%d" % (i + 1), layer)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         for layer in self:
-            x = torch.cat([x, layer(x)], dim=1)
+            x = torch.cat([x, layer(x, mask)], dim=1)
         return x
 
 
@@ -414,15 +438,34 @@ class CAMPPlus(torch.nn.Module):
                 if m.bias is not None:
                     torch.nn.init.zeros_(m.bias)
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
+        """
+        `lengths` (B,): numbers of valid frames of a padded batch. The padding is then masked everywhere it
+        would leak into the valid frames (convolutions over time, CAM context, statistics pooling), so that
+        every embedding is that of its utterance alone.
+        """
         x = x.permute(0, 2, 1)  # (B,T,F) => (B,F,T)
-        x = self.head(x)
-        x = self.xvector(x)
+        if lengths is None:
+            x = self.head(x)
+            x = self.xvector(x)
+        else:
+            mask = (torch.arange(x.size(2), device=x.device) < lengths.to(x.device)[:, None]).unsqueeze(1).to(x.dtype)
+            x = self.head(x, mask)
+            for module in self.xvector:
+                if isinstance(module, TDNNLayer):
+                    x = module(x * mask)
+                    mask = mask[..., ::module.linear.stride[0]]
+                elif isinstance(module, (CAMDenseTDNNBlock, StatsPool)):
+                    x = module(x, mask)
+                else:
+                    x = module(x)
         if self.output_level == "frame":
             x = x.transpose(1, 2)
         return x
 
     def inference(self, audio_list):
         speech, speech_lengths, speech_times = extract_feature(audio_list)
-        results = self.forward(speech.to(torch.float32))
+        # utterances of different lengths are padded to a batch: mask the padding
+        lengths = torch.LongTensor(speech_lengths) if len(set(speech_lengths)) > 1 else None
+        results = self.forward(speech.to(torch.float32), lengths)
         return results
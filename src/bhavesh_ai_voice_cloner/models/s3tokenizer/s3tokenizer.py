@@ -4,12 +4,13 @@ import numpy as np
 import librosa
 import torch
 import torch.nn.functional as F
-from s3tokenizer.utils import padding
 from s3tokenizer.model_v2 import (
     S3TokenizerV2,
     ModelConfig,
 )
 
+from ..spectral import get_spectral_frontend
+
 
 # Sampling rate of the inputs to S3TokenizerV2
 S3_SR = 16_000
@@ -96,7 +97,7 @@ class S3Tokenizer(S3TokenizerV2):
     ) -> Tuple[torch.Tensor, torch.LongTensor]:
         """
         NOTE: mel-spec has a hop size of 160 points (100 frame/sec).
-        FIXME: this class inherits `nn.Module` but doesn't accept `torch.Tensor` and handles a list of wavs one by one, which is unexpected.
+        The wavs may have different lengths: their mels are computed and quantized in one padded batch.
 
         Args
         ----
@@ -105,15 +106,11 @@ class S3Tokenizer(S3TokenizerV2):
         NOTE: please pad the waveform if longer sequence is needed.
         """
         processed_wavs = self._prepare_audio(wavs)
-        mels, mel_lens = [], []
-        for wav in processed_wavs:
-            wav = wav.to(self.device)
-            mel = self.log_mel_spectrogram(wav)  # [B=1, F, T]
-            if max_len is not None:
-                mel = mel[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
-            mels.append(mel.squeeze(0))
-
-        mels, mel_lens = padding(mels)
+        mels, mel_lens = self.log_mel_spectrogram_batch([wav.view(-1) for wav in processed_wavs])
+        if max_len is not None:
+            # num_mel_frames = 4 * num_tokens
+            mels, mel_lens = mels[..., :max_len * 4], mel_lens.clamp(max=max_len * 4)
+
         if accelerator is None:
             tokenizer = self
         else:
@@ -166,3 +163,13 @@ class S3Tokenizer(S3TokenizerV2):
         log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
         log_spec = (log_spec + 4.0) / 4.0
         return log_spec
+
+    def log_mel_spectrogram_batch(self, wavs: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.LongTensor]:
+        """
+        `log_mel_spectrogram` of many 1-D 16 kHz waveforms of different lengths in one padded batch, see
+        `SpectralFrontend.s3_log_mel`.
+
+        Returns:
+            (B, 128, T_max) log-mels (0 on padding) and the (B,) numbers of frames
+        """
+        return get_spectral_frontend(self.device).s3_log_mel(wavs)
@@ -0,0 +1,150 @@
+# Copyright (c) 2025 Bhavesh AI
+# MIT License
+"""
+One torch frontend for the spectral features of every model: the S3 tokenizer log-mel, the S3Gen mel, the
+CAMPPlus Kaldi fbank and the voice encoder mel. All of them run on padded batches of 1-D waveforms of different
+lengths, on the device of the frontend, and return the (B,) numbers of valid frames along with the features.
+"""
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import librosa
+import torch
+import torch.nn.functional as F
+import torchaudio.compliance.kaldi as Kaldi
+
+
+# NOTE: no imports from the model packages, which all use this module
+
+# S3Gen mel (CosyVoice's matcha `mel_spectrogram`), 24 kHz
+S3GEN_SR = 24_000
+S3GEN_N_FFT = 1920
+S3GEN_HOP = 480
+S3GEN_N_MELS = 80
+S3GEN_FMAX = 8000
+# S3 tokenizer log-mel and voice encoder mel: one STFT, 16 kHz
+S3_SR = 16_000
+S3_HOP = 160
+S3_N_FFT = 400
+S3_N_MELS = 128
+# Kaldi fbank of CAMPPlus (`torchaudio.compliance.kaldi.fbank` defaults, 80 bins), 16 kHz
+FBANK_WIN = 400
+FBANK_HOP = 160
+FBANK_N_FFT = 512
+FBANK_N_MELS = 80
+FBANK_PREEMPHASIS = 0.97
+
+Spec = Tuple[torch.Tensor, torch.LongTensor]
+
+
+def _pad_batch(wavs: List[torch.Tensor], device, pad=0, mode="reflect") -> Tuple[torch.Tensor, List[int]]:
+    "`pad` samples on both sides of every waveform on its own, then zero-pad them to a batch."
+    wavs = [torch.as_tensor(wav).to(device).float().view(-1) for wav in wavs]
+    lengths = [wav.size(0) for wav in wavs]
+    if pad:
+        wavs = [F.pad(wav.view(1, 1, -1), (pad, pad), mode=mode).view(-1) for wav in wavs]
+    return torch.nn.utils.rnn.pad_sequence(wavs, batch_first=True), lengths
+
+
+def _length_mask(lens: torch.LongTensor, max_len: int, device) -> torch.Tensor:
+    "(B, 1, T) True on valid frames"
+    return (torch.arange(max_len, device=device) < lens.to(device)[:, None]).unsqueeze(1)
+
+
+class SpectralFrontend(torch.nn.Module):
+    """
+    The filterbanks and windows are (non-persistent) buffers built once; use `get_spectral_frontend(device)`
+    for the instance shared by all the models on a device.
+
+    The 16 kHz `power_spectrogram` is the STFT of both the S3 tokenizer and the voice encoder: compute it once
+    and pass it as `spec` to `s3_log_mel` and `ve_mel` when both are needed for the same audio. The Kaldi
+    fbank frames differently (no centering, per-frame DC removal and pre-emphasis, povey window, 512-point FFT)
+    and has its own STFT, as does the 24 kHz S3Gen mel.
+    """
+
+    def __init__(self, ve_hp=None):
+        super().__init__()
+        if ve_hp is None:
+            from .voice_encoder.config import VoiceEncConfig
+            ve_hp = VoiceEncConfig()
+        self.ve_hp = ve_hp
+        assert ve_hp.sample_rate == S3_SR and (ve_hp.n_fft, ve_hp.hop_size, ve_hp.win_size) == (S3_N_FFT, S3_HOP, S3_N_FFT)
+        assert ve_hp.preemphasis == 0 and ve_hp.mel_power == 2.0 and ve_hp.mel_type == "amp" and not ve_hp.normalized_mels
+
+        def buffer(name, value):
+            self.register_buffer(name, torch.as_tensor(value, dtype=torch.float32), persistent=False)
+
+        buffer("s3_window", torch.hann_window(S3_N_FFT))
+        buffer("s3_mel_filters", librosa.filters.mel(sr=S3_SR, n_fft=S3_N_FFT, n_mels=S3_N_MELS))
+        buffer("ve_mel_filters", librosa.filters.mel(
+            sr=S3_SR, n_fft=S3_N_FFT, n_mels=ve_hp.num_mels, fmin=ve_hp.fmin, fmax=ve_hp.fmax,
+        ))
+        buffer("s3gen_window", torch.hann_window(S3GEN_N_FFT))
+        buffer("s3gen_mel_filters", librosa.filters.mel(
+            sr=S3GEN_SR, n_fft=S3GEN_N_FFT, n_mels=S3GEN_N_MELS, fmin=0, fmax=S3GEN_FMAX,
+        ))
+        buffer("fbank_window", torch.hann_window(FBANK_WIN, periodic=False).pow(0.85))  # povey
+        fbank_mel_banks, _ = Kaldi.get_mel_banks(FBANK_N_MELS, FBANK_N_FFT, float(S3_SR), 20.0, 0.0, 100.0, -500.0, 1.0)
+        buffer("fbank_mel_banks", F.pad(fbank_mel_banks, (0, 1)))
+
+    @property
+    def device(self):
+        return self.s3_window.device
+
+    def power_spectrogram(self, wavs: List[torch.Tensor]) -> Spec:
+        "16 kHz centered power STFT (hann 400, hop 160) as in `torch.stft(center=True)` / `librosa.stft`: (B, 201, T)."
+        y, lengths = _pad_batch(wavs, self.device, pad=S3_N_FFT // 2)
+        stft = torch.stft(y, S3_N_FFT, S3_HOP, window=self.s3_window, center=False, return_complex=True)
+        return stft.real.pow(2) + stft.imag.pow(2), torch.LongTensor([1 + n // S3_HOP for n in lengths])
+
+    def s3_log_mel(self, wavs: Optional[List[torch.Tensor]] = None, spec: Optional[Spec] = None) -> Spec:
+        "S3 tokenizer log-mel, clamped to 8 (log10) below the max of each waveform: (B, 128, T), 0 on padding."
+        power, lens = spec if spec is not None else self.power_spectrogram(wavs)
+        lens = lens - 1  # `S3Tokenizer.log_mel_spectrogram` drops the last frame
+        power = power[..., :lens.max()]
+        log_spec = torch.clamp(self.s3_mel_filters @ power, min=1e-10).log10()
+        mask = _length_mask(lens, log_spec.size(2), self.device)
+        log_max = log_spec.masked_fill(~mask, -torch.inf).amax(dim=(1, 2), keepdim=True)
+        log_spec = torch.maximum(log_spec, log_max - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        return log_spec.masked_fill(~mask, 0.0), lens
+
+    def ve_mel(self, wavs: Optional[List[torch.Tensor]] = None, spec: Optional[Spec] = None) -> Spec:
+        "Voice encoder mel, as `voice_encoder.melspec.melspectrogram`: (B, 40, T) linear mel power, 0 on padding."
+        power, lens = spec if spec is not None else self.power_spectrogram(wavs)
+        mel = self.ve_mel_filters @ power
+        return mel.masked_fill(~_length_mask(lens, mel.size(2), self.device), 0.0), lens
+
+    def s3gen_mel(self, wavs: List[torch.Tensor]) -> Spec:
+        "S3Gen log mel at 24 kHz, as `s3gen.utils.mel.mel_spectrogram`: (B, 80, T)."
+        pad = (S3GEN_N_FFT - S3GEN_HOP) // 2
+        y, lengths = _pad_batch(wavs, self.device, pad=pad)
+        stft = torch.stft(
+            y, S3GEN_N_FFT, S3GEN_HOP, window=self.s3gen_window, center=False, onesided=True, return_complex=True,
+        )
+        spec = torch.sqrt(stft.real.pow(2) + stft.imag.pow(2) + 1e-9)  # faster than on `view_as_real`, same values
+        mel = torch.log(torch.clamp(self.s3gen_mel_filters @ spec, min=1e-5))
+        return mel, torch.LongTensor([(n + 2 * pad - S3GEN_N_FFT) // S3GEN_HOP + 1 for n in lengths])
+
+    def kaldi_fbank(self, wavs: List[torch.Tensor]) -> Spec:
+        "80-bin log Kaldi fbank at 16 kHz, as `torchaudio.compliance.kaldi.fbank` (no dither): (B, T, 80)."
+        y, lengths = _pad_batch(wavs, self.device)
+        if y.size(1) < FBANK_WIN:
+            y = F.pad(y, (0, FBANK_WIN - y.size(1)))
+        frames = y.unfold(1, FBANK_WIN, FBANK_HOP)  # (B, T, 400), snip_edges
+        frames = frames - frames.mean(dim=2, keepdim=True)
+        frames = frames - FBANK_PREEMPHASIS * F.pad(frames, (1, 0), mode="replicate")[..., :-1]
+        frames = F.pad(frames * self.fbank_window, (0, FBANK_N_FFT - FBANK_WIN))
+        power = torch.fft.rfft(frames).abs().pow(2)
+        fbank = torch.clamp(power @ self.fbank_mel_banks.T, min=torch.finfo(torch.float32).eps).log()
+        return fbank, torch.LongTensor([max(0, 1 + (n - FBANK_WIN) // FBANK_HOP) for n in lengths])
+
+
+def get_spectral_frontend(device) -> SpectralFrontend:
+    "The `SpectralFrontend` shared by every model on `device`."
+    return _spectral_frontend(str(torch.device(device)))
+
+
+@lru_cache(None)
+def _spectral_frontend(device: str) -> SpectralFrontend:
+    return SpectralFrontend().to(device)
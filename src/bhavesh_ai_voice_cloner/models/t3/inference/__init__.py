@@ -4,7 +4,27 @@
 
 from .t3_hf_backend import T3HuggingfaceBackend
 from .alignment_stream_analyzer import *
+from .cfg_schedule import T3CFGSchedule
+from .decode_engine import T3DecodeEngine, T3DecodeSession
+from .continuous_batching import T3BatchEngine, T3GenerationRequest
+from .kv_cache import T3StaticCache, T3QuantizedCache, T3KVCachePool
+from .prefix_cache import T3CondPrefix, T3PrefixCache
+from .sampler import T3Sampler
+from .speculative import T3SpeculativeDecoder, T3SpeculativeStats
 
 __all__ = [
-    'T3HuggingfaceBackend'
+    'T3HuggingfaceBackend',
+    'T3CFGSchedule',
+    'T3DecodeEngine',
+    'T3DecodeSession',
+    'T3BatchEngine',
+    'T3GenerationRequest',
+    'T3StaticCache',
+    'T3QuantizedCache',
+    'T3KVCachePool',
+    'T3CondPrefix',
+    'T3PrefixCache',
+    'T3Sampler',
+    'T3SpeculativeDecoder',
+    'T3SpeculativeStats',
 ]
@@ -2,6 +2,9 @@
 # Author: John Meade, Jeremy Hsu
 # MIT License
 import logging
+import threading
+import weakref
+from contextlib import contextmanager
 import torch
 from dataclasses import dataclass
 from types import MethodType
@@ -26,6 +29,68 @@ class AlignmentAnalysisResult:
     position: int
 
 
+class _AttentionSpy:
+    """
+    Patches one attention layer for all the analyzers using it, so that concurrent generations can each run their
+    own: the forward passes made by a thread while an analyzer `watch`es output the attention weights into that
+    analyzer, the others are left untouched.
+
+    Using `output_attentions=True` is incompatible with optimized attention kernels, so using it for all layers
+    slows things down too much; we apply it to just one layer by intercepting its kwargs (credit: jrm).
+    """
+
+    _lock = threading.Lock()
+    _spies: "weakref.WeakKeyDictionary[torch.nn.Module, _AttentionSpy]" = weakref.WeakKeyDictionary()
+
+    def __init__(self, target_layer):
+        self.target_layer = target_layer
+        self.local = threading.local()
+        self.users = 0
+
+        spy = self
+        original_forward = target_layer.forward
+
+        def patched_forward(self, *args, **kwargs):
+            analyzer = getattr(spy.local, "analyzer", None)
+            if analyzer is None:
+                return original_forward(*args, **kwargs)
+            kwargs['output_attentions'] = True
+            # With SDPA the model drops the causal mask for unpadded prefills (it relies on `is_causal`), but the
+            # eager fallback taken by this layer needs an explicit one.
+            hidden_states = args[0] if args else kwargs["hidden_states"]
+            cache_position = kwargs.get("cache_position")
+            if kwargs.get("attention_mask") is None and hidden_states.size(1) > 1 and cache_position is not None:
+                kv_len = int(cache_position[-1]) + 1
+                future = torch.arange(kv_len, device=hidden_states.device) > cache_position[:, None]
+                causal_mask = torch.zeros(future.shape, dtype=hidden_states.dtype, device=hidden_states.device)
+                causal_mask.masked_fill_(future, torch.finfo(hidden_states.dtype).min)
+                kwargs["attention_mask"] = causal_mask[None, None]
+            output = original_forward(*args, **kwargs)
+            # See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
+            # `attn_weights` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
+            step_attention = output[1].cpu() # (B, 16, N, N)
+            analyzer.last_aligned_attn = step_attention[0].mean(0) # (N, N)
+            return output
+
+        target_layer.forward = MethodType(patched_forward, target_layer)
+
+    @classmethod
+    def acquire(cls, target_layer) -> "_AttentionSpy":
+        with cls._lock:
+            spy = cls._spies.get(target_layer)
+            if spy is None:
+                spy = cls._spies[target_layer] = cls(target_layer)
+            spy.users += 1
+        return spy
+
+    def release(self):
+        with self._lock:
+            self.users -= 1
+            if self.users == 0:
+                del self.target_layer.forward  # drop the instance attribute, back to the class method
+                del self._spies[self.target_layer]
+
+
 class AlignmentStreamAnalyzer:
     def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0):
         """
@@ -50,41 +115,25 @@ class AlignmentStreamAnalyzer:
         self.complete = False
         self.completed_at = None
 
-        # Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        # using it for all layers slows things down too much. We can apply it to just one layer
-        # by intercepting the kwargs and adding a forward hook (credit: jrm)
+        # attention of the last forward pass run under `watch`, see `_AttentionSpy`
         self.last_aligned_attn = None
-        self._add_attention_spy(tfmr, alignment_layer_idx)
-
-    def _add_attention_spy(self, tfmr, alignment_layer_idx):
-        """
-        Adds a forward hook to a specific attention layer to collect outputs.
-        Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        using it for all layers slows things down too much.
-        (credit: jrm)
-        """
-
-        def attention_forward_hook(module, input, output):
-            """
-            See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
-            NOTE:
-            - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
-            - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
-            """
-            step_attention = output[1].cpu() # (B, 16, N, N)
-            self.last_aligned_attn = step_attention[0].mean(0) # (N, N)
-
-        target_layer = tfmr.layers[alignment_layer_idx].self_attn
-        hook_handle = target_layer.register_forward_hook(attention_forward_hook)
-
-        # Backup original forward
-        original_forward = target_layer.forward
-        def patched_forward(self, *args, **kwargs):
-            kwargs['output_attentions'] = True
-            return original_forward(*args, **kwargs)
-
-        # TODO: how to unpatch it?
-        target_layer.forward = MethodType(patched_forward, target_layer)
+        self._spy = _AttentionSpy.acquire(tfmr.layers[alignment_layer_idx].self_attn)
+
+    @contextmanager
+    def watch(self):
+        "Collect the attention of the forward passes run in the context by the calling thread, for `step`."
+        previous = getattr(self._spy.local, "analyzer", None)
+        self._spy.local.analyzer = self
+        try:
+            yield
+        finally:
+            self._spy.local.analyzer = previous
+
+    def close(self):
+        "Stop spying on the attention layer (restored once no analyzer uses it)."
+        if self._spy is not None:
+            self._spy.release()
+            self._spy = None
 
     def step(self, logits):
         """
@@ -95,7 +144,9 @@ class AlignmentStreamAnalyzer:
         i, j = self.text_tokens_slice
         if self.curr_frame_pos == 0:
             # first chunk has conditioning info, text tokens, and BOS token
-            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
+            # (the conditioning rows are missing when their KV states were cached)
+            q_start = aligned_attn.size(1) - aligned_attn.size(0)
+            A_chunk = aligned_attn[j - q_start:, i:j].clone().cpu() # (T, S)
         else:
             # subsequent chunks have 1 frame due to KV-caching
             A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
@@ -0,0 +1,54 @@
+# Copyright (c) 2025 Bhavesh AI
+# MIT License
+from dataclasses import dataclass
+from typing import Optional, Union
+
+
+CFG_SCHEDULES = ("constant", "linear", "cutoff", "alignment")
+
+
+@dataclass(frozen=True)
+class T3CFGSchedule:
+    """
+    How the CFG weight evolves over the sampled speech tokens of a generation:
+        "constant": `cfg_weight` for every token.
+        "linear": decays linearly from `cfg_weight` to 0 over the first `num_tokens` tokens.
+        "cutoff": `cfg_weight` for the first `num_tokens` tokens, then 0.
+        "alignment": `cfg_weight` until the text-speech alignment reaches the end of the text, then 0 (turns on
+            the alignment analysis).
+    Once the weight is 0 it stays 0: the unconditional row is dropped from the batch and the KV cache, and the
+    rest of the generation decodes one row per step, about half the compute.
+
+    Also given as a string: "constant", "alignment", "linear:<num_tokens>" or "cutoff:<num_tokens>".
+    """
+
+    mode: str = "constant"
+    num_tokens: Optional[int] = None
+
+    def __post_init__(self):
+        assert self.mode in CFG_SCHEDULES, f"unknown CFG schedule {self.mode!r}, expected one of {CFG_SCHEDULES}"
+        if self.mode in ("linear", "cutoff"):
+            assert self.num_tokens is not None and self.num_tokens >= 0, f"the {self.mode!r} CFG schedule needs num_tokens >= 0"
+
+    @classmethod
+    def parse(cls, schedule: Union[str, "T3CFGSchedule", None]) -> "T3CFGSchedule":
+        if schedule is None:
+            return cls()
+        if isinstance(schedule, cls):
+            return schedule
+        mode, _, num_tokens = schedule.partition(":")
+        return cls(mode, int(num_tokens) if num_tokens else None)
+
+    @property
+    def needs_alignment(self) -> bool:
+        return self.mode == "alignment"
+
+    def weight(self, cfg_weight: float, step: int, text_complete=False) -> float:
+        "The CFG weight of the speech token sampled at `step` (from 0); `text_complete` comes from the alignment analyzer."
+        if self.mode == "linear":
+            return cfg_weight * max(0.0, 1.0 - step / max(self.num_tokens, 1))
+        if self.mode == "cutoff":
+            return cfg_weight if step < self.num_tokens else 0.0
+        if self.mode == "alignment":
+            return 0.0 if text_complete else cfg_weight
+        return cfg_weight
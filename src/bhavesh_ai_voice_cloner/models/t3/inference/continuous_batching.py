@@ -0,0 +1,389 @@
+# Copyright (c) 2025 Bhavesh AI
+# MIT License
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from transformers import DynamicCache
+
+from ..modules.cond_enc import T3Cond
+from .prefix_cache import T3PrefixCache
+from .sampler import T3Sampler
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class T3GenerationRequest:
+    """
+    One text -> speech-token job for `T3BatchEngine`.
+        * `text_tokens` is a single sequence (1D or (1, T)) that already has start / stop text tokens
+        * `t3_cond` is the (batch 1) conditioning for the target voice
+    """
+    t3_cond: T3Cond
+    text_tokens: Tensor
+    max_new_tokens: Optional[int] = None
+    temperature: float = 0.8
+    min_p: float = 0.05
+    top_p: float = 1.0
+    repetition_penalty: float = 1.2
+    cfg_weight: float = 0.5
+
+
+class _T3Sequence:
+    """
+    Per-request decode state: generated ids, speech position and EOS status.
+    A sequence owns one row of the engine's batch, or two consecutive rows (cond, uncond) when using CFG.
+    """
+
+    def __init__(self, request: T3GenerationRequest, future: Future, max_new_tokens: int, vocab_size: int, start_token: int, stop_token: int, device):
+        self.request = request
+        self.future = future
+        self.max_new_tokens = max_new_tokens
+        self.stop_token = stop_token
+        self.n_rows = 2 if request.cfg_weight > 0 else 1
+
+        self.next_logits = None  # (n_rows, vocab) logits for the next token
+        self.finished = False
+
+        self.tokens = torch.full((1, 1 + max_new_tokens), start_token, dtype=torch.long, device=device)
+        self.n_generated = 0
+        # the sampling parameters of this sequence, merged into the engine's batched sampler when it joins
+        self.sampler = T3Sampler(
+            vocab_size,
+            0,
+            start_token,
+            temperature=request.temperature,
+            min_p=request.min_p,
+            top_p=request.top_p,
+            repetition_penalty=request.repetition_penalty,
+            cfg_weight=request.cfg_weight,
+            device=device,
+        )
+
+    @property
+    def last_token(self):
+        return self.tokens[:, self.n_generated:self.n_generated + 1]
+
+    def append(self, next_token: Tensor):
+        "Record the sampled (1,) token."
+        self.tokens[0, 1 + self.n_generated] = next_token[0]
+        self.n_generated += 1
+        self.next_logits = None
+        if next_token.item() == self.stop_token or self.n_generated >= self.max_new_tokens:
+            self.finished = True
+
+    def result(self):
+        return self.tokens[:, 1:1 + self.n_generated].clone()  # (1, num_tokens)
+
+
+class T3BatchEngine:
+    """
+    Continuous batching for T3 decoding. Concurrent requests share one batched forward pass per token;
+    new requests join between steps (after a separate prefill) and finished ones are retired right away,
+    so the batch never waits for its longest member.
+
+    Rows of different lengths are kept in a single left-padded KV cache with a padding mask, and each row
+    carries its own RoPE position, so every sequence decodes exactly as it would on its own.
+
+    Usage, either synchronous:
+        engine = T3BatchEngine(t3)
+        speech_tokens = engine.generate([T3GenerationRequest(...), ...])
+    (thread-safe, concurrent callers take turns stepping the shared batch), or as a background worker shared by
+    many threads:
+        engine.start()
+        future = engine.submit(T3GenerationRequest(...))
+        speech_tokens = future.result()
+    """
+
+    def __init__(self, t3, max_batch_size=8, prefix_cache: Optional[T3PrefixCache]=None):
+        """
+        :param t3: a loaded `T3` model
+        :param max_batch_size: maximum number of concurrent sequences (a CFG sequence takes two rows)
+        :param prefix_cache: optional per-voice conditioning states, so requests only prefill their text
+        """
+        self.t3 = t3
+        self.hp = t3.hp
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.backend = t3.decode_engine.backend
+
+        self._lock = threading.Lock()
+        # held by `step`, so that callers of `generate` without a worker never step the batch concurrently
+        self._step_lock = threading.Lock()
+        self._pending = deque()
+        self._active: List[_T3Sequence] = []
+
+        # batched decode state, rows are ordered as `self._active`
+        self._sampler: Optional[T3Sampler] = None  # one row per active sequence
+        self._cache: Optional[DynamicCache] = None
+        self._attention_mask: Optional[Tensor] = None  # (R, L) 1 for real tokens, 0 for left padding
+        self._row_lens: Optional[Tensor] = None  # (R,) number of real tokens, ie the next RoPE position
+
+        self._worker = None
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+
+    @property
+    def device(self):
+        return self.t3.device
+
+    @property
+    def num_active(self):
+        return len(self._active)
+
+    def submit(self, request: T3GenerationRequest) -> Future:
+        "Queue a request; it joins the running batch at the next step. Thread-safe."
+        future = Future()
+        with self._lock:
+            self._pending.append((request, future))
+        self._wakeup.set()
+        return future
+
+    def has_unfinished(self):
+        with self._lock:
+            return len(self._pending) > 0 or len(self._active) > 0
+
+    def generate(self, requests: List[T3GenerationRequest]) -> List[Tensor]:
+        """
+        Run a list of requests to completion. Returns the predicted speech tokens (1, num_tokens) of each
+        request, in order, including the stop token if one was sampled.
+        """
+        futures = [self.submit(request) for request in requests]
+        if self._worker is None:
+            while not all(f.done() for f in futures):
+                self.step()
+        return [f.result() for f in futures]
+
+    def start(self):
+        "Drive `step` from a background thread until `stop` is called."
+        if self._worker is not None:
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._serve, name="T3BatchEngine", daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        if self._worker is None:
+            return
+        self._stop.set()
+        self._wakeup.set()
+        self._worker.join()
+        self._worker = None
+
+    def _serve(self):
+        while not self._stop.is_set():
+            if not self.has_unfinished():
+                self._wakeup.wait(timeout=0.1)
+                self._wakeup.clear()
+                continue
+            try:
+                self.step()
+            except Exception as e:
+                logger.exception("T3BatchEngine step failed, dropping the active batch")
+                with self._step_lock:
+                    for seq in self._active:
+                        if not seq.future.done():
+                            seq.future.set_exception(e)
+                    self._active = []
+                    self._reset_batch()
+
+    def step(self):
+        """
+        One engine iteration: admit pending requests, sample one token for every active sequence, retire
+        finished sequences and run a single batched forward pass for the rest. Thread-safe.
+        """
+        with self._step_lock:
+            self._step()
+
+    @torch.inference_mode()
+    def _step(self):
+        self._admit()
+        if len(self._active) == 0:
+            return
+
+        next_tokens = self._sample()
+        keep_seqs, keep_rows = [], []
+        row = 0
+        for i, seq in enumerate(self._active):
+            seq.append(next_tokens[i])
+            if seq.finished:
+                seq.future.set_result(seq.result())
+            else:
+                keep_seqs.append(i)
+                keep_rows.extend(range(row, row + seq.n_rows))
+            row += seq.n_rows
+
+        if len(keep_seqs) < len(self._active):
+            self._active = [self._active[i] for i in keep_seqs]
+            self._retire_rows(keep_seqs, keep_rows)
+        if len(self._active) == 0:
+            return
+
+        self._decode()
+
+    def _admit(self):
+        while len(self._active) < self.max_batch_size:
+            with self._lock:
+                if len(self._pending) == 0:
+                    return
+                request, future = self._pending.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                seq, cache, length = self._prefill(request, future)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            self._join(cache, seq.n_rows, length)
+            self._sampler = seq.sampler if self._sampler is None else T3Sampler.cat([self._sampler, seq.sampler])
+            seq.sampler = None
+            self._active.append(seq)
+
+    def _prefill(self, request: T3GenerationRequest, future: Future):
+        device = self.device
+        text_tokens = torch.atleast_2d(request.text_tokens).to(dtype=torch.long, device=device)
+        assert text_tokens.size(0) == 1, "one text sequence per request"
+        if request.cfg_weight > 0:
+            text_tokens = text_tokens.expand(2, -1)  # Need two seqs for CFG
+
+        past = DynamicCache()
+        cond_prefix = None
+        if self.prefix_cache is not None:
+            cond_prefix = self.prefix_cache.get_or_build(self.t3, request.t3_cond)
+            cond_prefix.load_into(past, text_tokens.size(0))
+
+        inputs_embeds, _ = self.t3.prepare_inference_embeds(
+            t3_cond=request.t3_cond,
+            text_tokens=text_tokens,
+            cfg_weight=request.cfg_weight,
+            cond_prefix=cond_prefix,
+        )
+        output = self.backend(
+            inputs_embeds=inputs_embeds,
+            past_key_values=past,
+            use_cache=True,
+            output_attentions=False,
+            output_hidden_states=False,
+            return_dict=True,
+            num_logits_to_keep=1,
+        )
+
+        seq = _T3Sequence(
+            request,
+            future,
+            max_new_tokens=request.max_new_tokens or self.hp.max_speech_tokens,
+            vocab_size=self.hp.speech_tokens_dict_size,
+            start_token=self.hp.start_speech_token,
+            stop_token=self.hp.stop_speech_token,
+            device=device,
+        )
+        seq.next_logits = output.logits[:, -1, :]
+        return seq, output.past_key_values, output.past_key_values.get_seq_length()
+
+    def _join(self, cache: DynamicCache, n_rows: int, length: int):
+        "Append the rows of a freshly prefilled sequence to the batch, left-padding whichever side is shorter."
+        device = self.device
+        new_mask = torch.ones(n_rows, length, dtype=torch.long, device=device)
+        new_lens = torch.full((n_rows,), length, dtype=torch.long, device=device)
+        if self._cache is None:
+            self._cache, self._attention_mask, self._row_lens = cache, new_mask, new_lens
+            return
+
+        cur_len = self._attention_mask.size(1)
+        total = max(cur_len, length)
+        pad_cur, pad_new = total - cur_len, total - length
+
+        merged = DynamicCache()
+        for layer_idx in range(len(self._cache)):
+            k_cur, v_cur = self._cache[layer_idx]
+            k_new, v_new = cache[layer_idx]
+            merged.key_cache.append(torch.cat([F.pad(k_cur, (0, 0, pad_cur, 0)), F.pad(k_new, (0, 0, pad_new, 0))]))
+            merged.value_cache.append(torch.cat([F.pad(v_cur, (0, 0, pad_cur, 0)), F.pad(v_new, (0, 0, pad_new, 0))]))
+        merged._seen_tokens = total
+
+        self._cache = merged
+        self._attention_mask = torch.cat([F.pad(self._attention_mask, (pad_cur, 0)), F.pad(new_mask, (pad_new, 0))])
+        self._row_lens = torch.cat([self._row_lens, new_lens])
+
+    def _sample(self) -> Tensor:
+        """
+        Sample the next token of every active sequence in one pass: CFG with the weight of each sequence (the
+        sequences without CFG pair their row with itself), then the sampling recipe of `T3.inference` with the
+        parameters of each sequence. Returns (num_active, 1).
+        """
+        logits = torch.cat([seq.next_logits for seq in self._active])  # (R, vocab)
+        if self._sampler._use_cfg:
+            cond_rows, uncond_rows = [], []
+            row = 0
+            for seq in self._active:
+                cond_rows.append(row)
+                uncond_rows.append(row + seq.n_rows - 1)
+                row += seq.n_rows
+            logits = logits[torch.tensor(cond_rows + uncond_rows, device=logits.device)]
+        next_tokens = torch.multinomial(self._sampler.probs(logits), num_samples=1)
+        self._sampler.count(next_tokens)
+        return next_tokens
+
+    def _retire_rows(self, keep_seqs: List[int], keep_rows: List[int]):
+        if len(keep_rows) == 0:
+            self._reset_batch()
+            return
+
+        self._sampler.select_rows(torch.tensor(keep_seqs, dtype=torch.long, device=self.device))
+        keep = torch.tensor(keep_rows, dtype=torch.long, device=self.device)
+        self._cache.batch_select_indices(keep)
+        self._attention_mask = self._attention_mask[keep]
+        self._row_lens = self._row_lens[keep]
+
+        # drop padding columns that no remaining row needs
+        n_pad = int((self._attention_mask.sum(dim=0) == 0).int().cumprod(dim=0).sum())
+        if n_pad > 0:
+            for layer_idx in range(len(self._cache)):
+                self._cache.key_cache[layer_idx] = self._cache.key_cache[layer_idx][..., n_pad:, :]
+                self._cache.value_cache[layer_idx] = self._cache.value_cache[layer_idx][..., n_pad:, :]
+            self._cache._seen_tokens -= n_pad
+            self._attention_mask = self._attention_mask[:, n_pad:]
+
+    def _reset_batch(self):
+        self._sampler = None
+        self._cache = None
+        self._attention_mask = None
+        self._row_lens = None
+
+    def _decode(self):
+        "Feed the last sampled token of every active sequence through the model in one batch."
+        pos_table = self.t3.speech_pos_emb.emb.weight
+        embeds = []
+        for seq in self._active:
+            token_embed = self.t3.speech_emb(seq.last_token) + pos_table[seq.n_generated]
+            embeds.append(token_embed.expand(seq.n_rows, -1, -1))
+        inputs_embeds = torch.cat(embeds)  # (R, 1, dim)
+
+        self._attention_mask = F.pad(self._attention_mask, (0, 1), value=1)
+        output = self.backend(
+            inputs_embeds=inputs_embeds,
+            past_key_values=self._cache,
+            attention_mask=self._attention_mask,
+            position_ids=self._row_lens[:, None],
+            use_cache=True,
+            output_attentions=False,
+            output_hidden_states=False,
+            return_dict=True,
+            num_logits_to_keep=1,
+        )
+        self._cache = output.past_key_values
+        self._row_lens = self._row_lens + 1
+
+        logits = output.logits[:, -1, :]  # (R, vocab)
+        row = 0
+        for seq in self._active:
+            seq.next_logits = logits[row:row + seq.n_rows]
+            row += seq.n_rows
@@ -0,0 +1,249 @@
+# Copyright (c) 2025 Bhavesh AI
+# MIT License
+import logging
+from contextlib import nullcontext
+from typing import Optional
+
+import torch
+from torch import Tensor
+from tqdm import tqdm
+from transformers import DynamicCache
+
+from ..modules.cond_enc import T3Cond
+from .t3_hf_backend import T3HuggingfaceBackend
+from .alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .cfg_schedule import T3CFGSchedule
+from .kv_cache import QUANTIZED_KV_CACHES, T3KVCachePool, new_static_cache
+from .prefix_cache import T3PrefixCache
+from .sampler import T3Sampler
+from .speculative import T3SpeculativeDecoder, T3SpeculativeStats
+
+
+logger = logging.getLogger(__name__)
+
+
+class T3DecodeEngine:
+    """
+    The decoding machinery of a `T3`, built once with the model: the HF backend running its Llama with the speech
+    embedding and head. It holds no per-request state, which all lives in the `T3DecodeSession` of each request,
+    so that threads can decode concurrently with one engine (one session each).
+
+    Usage:
+        for tokens in t3.decode_engine.session(t3_cond=t3_cond, text_tokens=text_tokens, ...):
+            ...
+    """
+
+    def __init__(self, t3):
+        self.t3 = t3
+        self.hp = t3.hp
+        self.backend = T3HuggingfaceBackend(
+            config=t3.cfg,
+            llama=t3.tfmr,
+            speech_enc=t3.speech_emb,
+            speech_head=t3.speech_head,
+        )
+
+    def session(self, **kwargs) -> "T3DecodeSession":
+        "A new generation, see `T3DecodeSession` (and `T3.inference_stream`) for the arguments."
+        return T3DecodeSession(self, **kwargs)
+
+
+class T3DecodeSession:
+    """
+    The state of one generation: its KV cache, sampler (with the sampled tokens) and alignment analyzer.
+    Iterating decodes, yielding the sampled speech tokens as (1, n) tensors (the last one ends with the stop token
+    if it was sampled); the KV cache goes back to its pool when the iteration ends. Iterate once, in one thread at
+    a time.
+    """
+
+    def __init__(
+        self,
+        engine: T3DecodeEngine,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        initial_speech_tokens: Optional[Tensor]=None,
+        max_new_tokens=None,
+        stop_on_eos=True,
+        temperature=0.8,
+        min_p=0.05,
+        top_p=1.00,
+        repetition_penalty=1.2,
+        cfg_weight=0,
+        cfg_schedule="constant",
+        alignment_analysis=False,
+        kv_cache="dynamic",
+        kv_cache_pool: Optional[T3KVCachePool]=None,
+        prefix_cache: Optional[T3PrefixCache]=None,
+        speculative: Optional[T3SpeculativeDecoder]=None,
+    ):
+        assert not (speculative is not None and alignment_analysis), "alignment analysis needs one token per step"
+        cfg_schedule = T3CFGSchedule.parse(cfg_schedule)
+        assert speculative is None or cfg_schedule.mode == "constant", "speculative decoding needs a constant CFG weight"
+        assert kv_cache in ("dynamic", "static", *QUANTIZED_KV_CACHES), f"unknown kv_cache {kv_cache!r}"
+        t3 = engine.t3
+        self.engine = engine
+        self.t3_cond = t3_cond
+        self.text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=t3.device)
+        self.initial_speech_tokens = initial_speech_tokens
+        self.max_new_tokens = max_new_tokens or engine.hp.max_speech_tokens
+        self.stop_on_eos = stop_on_eos
+        self.temperature = temperature
+        self.min_p = min_p
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.cfg_weight = cfg_weight
+        self.cfg_schedule = cfg_schedule
+        self.alignment_analysis = alignment_analysis or cfg_schedule.needs_alignment
+        self.kv_cache = kv_cache
+        self.kv_cache_pool = kv_cache_pool
+        self.prefix_cache = prefix_cache
+        self.speculative = speculative
+
+        self.past = None
+        self.alignment_stream_analyzer: Optional[AlignmentStreamAnalyzer] = None
+        self.sampler: Optional[T3Sampler] = None
+        # drafted / accepted tokens of this generation, with `speculative`
+        self.speculative_stats = T3SpeculativeStats() if speculative is not None else None
+        # the step at which the CFG schedule dropped the unconditional row, if it did
+        self.uncond_dropped_at: Optional[int] = None
+
+    @property
+    def generated_ids(self) -> Optional[Tensor]:
+        "The BOS token and the sampled tokens."
+        return self.sampler.generated_ids if self.sampler is not None else None
+
+    def _new_cache(self, batch_size, max_cache_len, device, dtype):
+        if self.kv_cache_pool is not None:
+            return self.kv_cache_pool.acquire(batch_size, max_cache_len, device=device, dtype=dtype)
+        if self.kv_cache != "dynamic":
+            return new_static_cache(self.engine.t3.cfg, batch_size, max_cache_len, device=device, dtype=dtype, kv_cache=self.kv_cache)
+        return DynamicCache()
+
+    def _forward(self, inputs_embeds):
+        "Run the backbone on the new embeddings, updating the KV cache. Returns the (B, vocab) next-token logits."
+        analyzer = self.alignment_stream_analyzer
+        with analyzer.watch() if analyzer is not None else nullcontext():
+            output = self.engine.backend(
+                inputs_embeds=inputs_embeds,
+                past_key_values=self.past,
+                use_cache=True,
+                output_attentions=False,
+                output_hidden_states=False,
+                return_dict=True,
+                num_logits_to_keep=1,
+            )
+        logits = output.logits[:, -1, :]
+        if analyzer is not None:
+            # NOTE: the hallucination handler may modify the logits to force an EOS token
+            logits = analyzer.step(logits)
+        return logits
+
+    def _drop_uncond_rows(self, logits):
+        "CFG is off for good: keep the conditional rows only, in the KV cache and the logits."
+        keep = torch.arange(logits.size(0) // 2, device=logits.device)
+        self.past.batch_select_indices(keep)
+        return logits[keep]
+
+    def close(self):
+        if self.alignment_stream_analyzer is not None:
+            self.alignment_stream_analyzer.close()
+            self.alignment_stream_analyzer = None
+        if self.kv_cache_pool is not None and self.past is not None:
+            self.kv_cache_pool.release(self.past)
+        self.past = None
+
+    @torch.inference_mode()
+    def __iter__(self):
+        t3, hp = self.engine.t3, self.engine.hp
+        cfg_weight = self.cfg_weight
+        text_tokens = self.text_tokens
+
+        # Default initial speech to a single start-of-speech token
+        initial_speech_tokens = self.initial_speech_tokens
+        if initial_speech_tokens is None:
+            initial_speech_tokens = hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+
+        # Prepare custom input embeds
+        cond_prefix = self.prefix_cache.get_or_build(t3, self.t3_cond) if self.prefix_cache is not None else None
+        inputs_embeds, len_cond = t3.prepare_inference_embeds(
+            t3_cond=self.t3_cond,
+            text_tokens=text_tokens,
+            initial_speech_tokens=initial_speech_tokens,
+            cfg_weight=cfg_weight,
+            cond_prefix=cond_prefix,
+        )
+
+        try:
+            if self.alignment_analysis:
+                self.alignment_stream_analyzer = AlignmentStreamAnalyzer(
+                    t3.tfmr,
+                    None,
+                    text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
+                    alignment_layer_idx=9,
+                    eos_idx=hp.stop_speech_token,
+                )
+
+            device = inputs_embeds.device
+
+            # room for the prefill and every sampled token but the last, which is never fed back
+            max_cache_len = (len_cond if cond_prefix is not None else 0) + inputs_embeds.size(1) + self.max_new_tokens
+            self.past = self._new_cache(inputs_embeds.size(0), max_cache_len, device, inputs_embeds.dtype)
+            if cond_prefix is not None:
+                cond_prefix.load_into(self.past, inputs_embeds.size(0))
+
+            # ---- Initial Forward Pass (kv_cache is empty, or only holds the conditioning) ----
+            logits = self._forward(inputs_embeds)
+
+            if self.speculative is not None:
+                yield from self.speculative.decode_stream(
+                    logits,
+                    self.past,
+                    max_new_tokens=self.max_new_tokens,
+                    temperature=self.temperature,
+                    min_p=self.min_p,
+                    top_p=self.top_p,
+                    repetition_penalty=self.repetition_penalty,
+                    cfg_weight=cfg_weight,
+                    stop_on_eos=self.stop_on_eos,
+                    stats=self.speculative_stats,
+                )
+                return
+
+            # ---- Generation Loop using kv_cache ----
+            self.sampler = T3Sampler(
+                hp.speech_tokens_dict_size,
+                self.max_new_tokens,
+                hp.start_speech_token,
+                temperature=self.temperature,
+                min_p=self.min_p,
+                top_p=self.top_p,
+                repetition_penalty=self.repetition_penalty,
+                cfg_weight=cfg_weight,
+                device=device,
+            )
+            pos_table = t3.speech_pos_emb.emb.weight  # (max_speech_len, dim) position embeddings
+            n_rows = inputs_embeds.size(0)
+            analyzer = self.alignment_stream_analyzer
+            for i in tqdm(range(self.max_new_tokens), desc="Sampling", dynamic_ncols=True):
+                if n_rows > 1:
+                    weight = self.cfg_schedule.weight(cfg_weight, i, analyzer is not None and analyzer.complete)
+                    if weight <= 0.0:
+                        logits = self._drop_uncond_rows(logits)
+                        n_rows = logits.size(0)
+                        self.uncond_dropped_at = i
+                    self.sampler.set_cfg_weight(weight)
+
+                # CFG, temperature, repetition penalty, min_p and top_p, then sample the next token
+                next_token = self.sampler.sample(logits)  # shape: (1, 1)
+                yield next_token
+
+                # Check for EOS token.
+                if next_token.view(-1) == hp.stop_speech_token:
+                    break
+
+                # Embed the new token (the same for the CFG pair) and feed it with the cached past.
+                next_token_embed = t3.speech_emb(next_token) + pos_table[i + 1]
+                logits = self._forward(next_token_embed.expand(n_rows, -1, -1))
+        finally:
+            self.close()
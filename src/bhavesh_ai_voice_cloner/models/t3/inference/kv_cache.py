@@ -0,0 +1,292 @@
+# Copyright (c) 2025 Bhavesh AI
+# MIT License
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from torch import Tensor
+from transformers import Cache, LlamaConfig
+
+
+class T3StaticCache(Cache):
+    """
+    KV cache with preallocated fixed-capacity buffers, one (B, H, capacity, D) key and value buffer per layer.
+
+    New states are copied in place at the current length and the attention layers get views of the filled
+    prefix, so decoding neither reallocates nor copies the cache as it grows (unlike `DynamicCache`, which
+    concatenates every layer on every step), and attention only spans the tokens seen so far.
+
+    NOTE: this is deliberately not a `transformers.StaticCache`: llama masks a `StaticCache` up to its full
+    capacity every step, which is much slower on CPU for the short-to-medium lengths TTS uses.
+    """
+
+    kv_cache = "static"
+    # per-layer buffers with one row per sequence, and scratch tensors of the same batch size
+    _batch_buffers = ("key_cache", "value_cache")
+    _batch_scratch = ()
+
+    def __init__(self, config: LlamaConfig, batch_size: int, max_cache_len: int, device=None, dtype=torch.float32):
+        super().__init__()
+        self.batch_size = batch_size
+        self.full_batch_size = batch_size
+        self._full_buffers = None  # the buffers of all the rows, while `batch_select_indices` views a part of them
+        self.max_cache_len = max_cache_len
+        self.num_layers = config.num_hidden_layers
+        self.device = torch.device(device) if device is not None else torch.device("cpu")
+        self.dtype = dtype
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        shape = (batch_size, config.num_key_value_heads, max_cache_len, head_dim)
+
+        # NOTE: buffers are left uninitialized, only `[:, :, :_seen_tokens]` is ever read
+        self.key_cache = [torch.empty(shape, device=device, dtype=dtype) for _ in range(self.num_layers)]
+        self.value_cache = [torch.empty(shape, device=device, dtype=dtype) for _ in range(self.num_layers)]
+        self._seen_tokens = 0
+
+    def __len__(self):
+        # number of layers holding states, for `past_key_values` truthiness / length checks
+        return self.num_layers if self._seen_tokens > 0 else 0
+
+    def __getitem__(self, layer_idx: int) -> Tuple[Tensor, Tensor]:
+        return (
+            self.key_cache[layer_idx][:, :, :self._seen_tokens],
+            self.value_cache[layer_idx][:, :, :self._seen_tokens],
+        )
+
+    def update(
+        self,
+        key_states: Tensor,
+        value_states: Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[Tensor, Tensor]:
+        n_new = key_states.shape[-2]
+        if layer_idx == 0:
+            if self._seen_tokens + n_new > self.max_cache_len:
+                raise ValueError(f"T3StaticCache is full ({self.max_cache_len} tokens)")
+            self._seen_tokens += n_new
+
+        end = self._seen_tokens
+        self.key_cache[layer_idx][:, :, end - n_new:end].copy_(key_states)
+        self.value_cache[layer_idx][:, :, end - n_new:end].copy_(value_states)
+        return self[layer_idx]
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self._seen_tokens
+
+    def get_max_cache_shape(self) -> Optional[int]:
+        return self.max_cache_len
+
+    def get_max_length(self) -> Optional[int]:
+        return self.max_cache_len
+
+    def crop(self, max_length: int):
+        "Forget everything after the first `max_length` tokens (negative values drop that many tokens)."
+        if max_length < 0:
+            max_length = self._seen_tokens + max_length
+        self._seen_tokens = min(self._seen_tokens, max_length)
+
+    def reset(self):
+        "Empty the cache, back to its full batch size."
+        self._seen_tokens = 0
+        if self._full_buffers is not None:
+            for name, value in self._full_buffers.items():
+                setattr(self, name, value)
+            self._full_buffers = None
+            self.batch_size = self.full_batch_size
+
+    def batch_select_indices(self, indices: Tensor):
+        """
+        Only keep the rows `indices` of the batch (e.g. the conditional row once CFG is off). They are moved to the
+        front of the buffers (nothing to move when they are the first rows), which are then used through views of
+        their first rows: no allocation, and `reset` gets the full buffers back.
+        """
+        n = len(indices)
+        indices = indices.to(self.device)
+        if self._full_buffers is None:
+            self._full_buffers = {name: list(getattr(self, name)) for name in self._batch_buffers}
+            self._full_buffers.update({name: getattr(self, name) for name in self._batch_scratch})
+        move = not torch.equal(indices, torch.arange(n, device=self.device))
+        for name in self._batch_buffers:
+            buffers = getattr(self, name)
+            for i, buffer in enumerate(buffers):
+                if move:
+                    buffer[:n, :, :self._seen_tokens].copy_(buffer[indices, :, :self._seen_tokens])
+                buffers[i] = buffer[:n]
+        for name in self._batch_scratch:
+            setattr(self, name, getattr(self, name)[:n])
+        self.batch_size = n
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.key_cache + self.value_cache)
+
+
+# storage formats of `T3QuantizedCache`
+QUANTIZED_KV_CACHES = ("fp16", "int8")
+
+
+class T3QuantizedCache(T3StaticCache):
+    """
+    `T3StaticCache` storing the states in a compact format, to fit more concurrent streams in memory:
+        "fp16": half precision, half the memory of fp32.
+        "int8": symmetric int8 with one scale per token and head (absmax of its head_dim values), about 3.8x
+            less memory than fp32.
+    The attention layers get the states dequantized into a scratch buffer of one layer, shared by all the
+    layers (each layer is done with it when the next one updates the cache), so a step dequantizes every
+    layer's prefix once.
+    """
+
+    _batch_buffers = ("key_cache", "value_cache", "key_scales", "value_scales")
+    _batch_scratch = ("_key_out", "_value_out")
+
+    def __init__(self, config: LlamaConfig, batch_size: int, max_cache_len: int, device=None, dtype=torch.float32, kv_cache="int8"):
+        assert kv_cache in QUANTIZED_KV_CACHES, f"unknown kv_cache {kv_cache!r}, expected one of {QUANTIZED_KV_CACHES}"
+        Cache.__init__(self)
+        self.kv_cache = kv_cache
+        self.batch_size = batch_size
+        self.full_batch_size = batch_size
+        self._full_buffers = None
+        self.max_cache_len = max_cache_len
+        self.num_layers = config.num_hidden_layers
+        self.device = torch.device(device) if device is not None else torch.device("cpu")
+        self.dtype = dtype
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        shape = (batch_size, config.num_key_value_heads, max_cache_len, head_dim)
+        storage_dtype = torch.int8 if kv_cache == "int8" else torch.float16
+
+        # NOTE: buffers are left uninitialized, only `[:, :, :_seen_tokens]` is ever read
+        self.key_cache = [torch.empty(shape, device=device, dtype=storage_dtype) for _ in range(self.num_layers)]
+        self.value_cache = [torch.empty(shape, device=device, dtype=storage_dtype) for _ in range(self.num_layers)]
+        self.key_scales, self.value_scales = [], []
+        if kv_cache == "int8":
+            scale_shape = shape[:-1] + (1,)
+            self.key_scales = [torch.empty(scale_shape, device=device, dtype=dtype) for _ in range(self.num_layers)]
+            self.value_scales = [torch.empty(scale_shape, device=device, dtype=dtype) for _ in range(self.num_layers)]
+        self._key_out = torch.empty(shape, device=device, dtype=dtype)
+        self._value_out = torch.empty(shape, device=device, dtype=dtype)
+        self._seen_tokens = 0
+
+    def _store(self, states: Tensor, buffers, scales, layer_idx, start, end):
+        if self.kv_cache == "int8":
+            scale = states.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / 127
+            scales[layer_idx][:, :, start:end].copy_(scale)
+            states = torch.round(states / scale).clamp_(-127, 127)
+        buffers[layer_idx][:, :, start:end].copy_(states)
+
+    def _load(self, buffers, scales, out: Tensor, layer_idx) -> Tensor:
+        n = self._seen_tokens
+        out = out[:, :, :n]
+        if self.kv_cache == "int8":
+            torch.mul(buffers[layer_idx][:, :, :n], scales[layer_idx][:, :, :n], out=out)
+        else:
+            out.copy_(buffers[layer_idx][:, :, :n])
+        return out
+
+    def __getitem__(self, layer_idx: int) -> Tuple[Tensor, Tensor]:
+        "The dequantized states of a layer, valid until the next layer is read or updated."
+        return (
+            self._load(self.key_cache, self.key_scales, self._key_out, layer_idx),
+            self._load(self.value_cache, self.value_scales, self._value_out, layer_idx),
+        )
+
+    def update(
+        self,
+        key_states: Tensor,
+        value_states: Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[Tensor, Tensor]:
+        n_new = key_states.shape[-2]
+        if layer_idx == 0:
+            if self._seen_tokens + n_new > self.max_cache_len:
+                raise ValueError(f"T3QuantizedCache is full ({self.max_cache_len} tokens)")
+            self._seen_tokens += n_new
+
+        end = self._seen_tokens
+        self._store(key_states, self.key_cache, self.key_scales, layer_idx, end - n_new, end)
+        self._store(value_states, self.value_cache, self.value_scales, layer_idx, end - n_new, end)
+        return self[layer_idx]
+
+    @property
+    def nbytes(self):
+        "Memory of the stored states and scales (not counting the scratch buffers, see `scratch_nbytes`)."
+        tensors = self.key_cache + self.value_cache + self.key_scales + self.value_scales
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    @property
+    def scratch_nbytes(self):
+        return sum(t.numel() * t.element_size() for t in (self._key_out, self._value_out))
+
+
+def new_static_cache(config: LlamaConfig, batch_size: int, max_cache_len: int, device=None, dtype=torch.float32, kv_cache="static") -> T3StaticCache:
+    "A `T3StaticCache` (`kv_cache='static'`) or a `T3QuantizedCache` (`kv_cache` in `QUANTIZED_KV_CACHES`)."
+    if kv_cache == "static":
+        return T3StaticCache(config, batch_size, max_cache_len, device=device, dtype=dtype)
+    return T3QuantizedCache(config, batch_size, max_cache_len, device=device, dtype=dtype, kv_cache=kv_cache)
+
+
+class T3KVCachePool:
+    """
+    Reuses `T3StaticCache` buffers across requests. Capacities are rounded up to a multiple of `bucket_size`
+    tokens, and a released cache is handed to the next request with the same batch size whose budget fits in
+    the same bucket, so steady-state serving does no large KV allocations at all. Thread-safe.
+    The idle caches hold at most `max_bytes`: past it, the least recently released ones are freed.
+    `kv_cache` picks the storage: "static" (full precision) or one of `QUANTIZED_KV_CACHES`.
+    """
+
+    def __init__(self, config: LlamaConfig, bucket_size: int = 256, max_bytes: int = 1 << 30, kv_cache="static"):
+        assert kv_cache == "static" or kv_cache in QUANTIZED_KV_CACHES, f"unknown kv_cache {kv_cache!r}"
+        self.config = config
+        self.kv_cache = kv_cache
+        self.bucket_size = bucket_size
+        self.max_bytes = max_bytes
+        self._free: List[Tuple[tuple, T3StaticCache]] = []  # (key, cache), least recently released first
+        self._free_nbytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(cache: T3StaticCache) -> tuple:
+        return (cache.batch_size, cache.max_cache_len, cache.device, cache.dtype)
+
+    @staticmethod
+    def _nbytes(cache: T3StaticCache) -> int:
+        return cache.nbytes + getattr(cache, "scratch_nbytes", 0)
+
+    @property
+    def nbytes(self) -> int:
+        "Memory held by the idle caches."
+        return self._free_nbytes
+
+    def bucket_len(self, max_cache_len: int) -> int:
+        return -(-max_cache_len // self.bucket_size) * self.bucket_size
+
+    def acquire(self, batch_size: int, max_cache_len: int, device=None, dtype=torch.float32) -> T3StaticCache:
+        "Get an empty cache holding at least `max_cache_len` tokens."
+        device = torch.device(device) if device is not None else torch.device("cpu")
+        key = (batch_size, self.bucket_len(max_cache_len), device, dtype)
+        with self._lock:
+            for i in reversed(range(len(self._free))):
+                if self._free[i][0] == key:
+                    _, cache = self._free.pop(i)
+                    self._free_nbytes -= self._nbytes(cache)
+                    cache.reset()
+                    return cache
+        return new_static_cache(self.config, batch_size, key[1], device=device, dtype=dtype, kv_cache=self.kv_cache)
+
+    def release(self, cache: T3StaticCache):
+        "Give a cache back to the pool once its request is done."
+        cache.reset()  # back to its full batch, if `batch_select_indices` dropped rows
+        nbytes = self._nbytes(cache)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._free.append((self._key(cache), cache))
+            self._free_nbytes += nbytes
+            while self._free_nbytes > self.max_bytes:
+                _, evicted = self._free.pop(0)
+                self._free_nbytes -= self._nbytes(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+            self._free_nbytes = 0
@@ -0,0 +1,93 @@
+# Copyright (c) 2025 Bhavesh AI
+# MIT License
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import torch
+from torch import Tensor
+from transformers import Cache, DynamicCache
+
+from ..modules.cond_enc import T3Cond
+
+
+@dataclass
+class T3CondPrefix:
+    """
+    The conditioning block of one voice, already run through the backbone: its embeddings and the
+    per-layer keys / values of those positions. Conditioning comes first and attention is causal, so
+    these states do not depend on the text and can be shared by every request (and both CFG rows).
+    """
+    cond_emb: Tensor  # (1, len_cond, dim)
+    keys: List[Tensor]  # per layer (1, H, len_cond, D)
+    values: List[Tensor]
+
+    def __len__(self):
+        return self.cond_emb.size(1)
+
+    def load_into(self, past_key_values: Cache, batch_size: int):
+        "Write the prefix states into an empty cache, for `batch_size` rows."
+        assert past_key_values.get_seq_length() == 0, "cache must be empty"
+        for layer_idx, (k, v) in enumerate(zip(self.keys, self.values)):
+            past_key_values.update(k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1), layer_idx)
+
+
+class T3PrefixCache:
+    """
+    LRU cache of `T3CondPrefix`, keyed by voice (speaker embedding and speech prompt) and exaggeration.
+    With it, a request only prefills its text and BOS tokens; the Perceiver and the backbone run over the
+    conditioning block once per voice. Thread-safe.
+    """
+
+    def __init__(self, max_voices=8):
+        self.max_voices = max_voices
+        self._entries: "OrderedDict[Tuple[str, float], T3CondPrefix]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def voice_key(t3_cond: T3Cond) -> Tuple[str, float]:
+        h = hashlib.sha1()
+        for t in (t3_cond.speaker_emb, t3_cond.cond_prompt_speech_tokens, t3_cond.clap_emb):
+            if t is not None:
+                h.update(t.detach().cpu().numpy().tobytes())
+        if t3_cond.cond_prompt_speech_tokens is None and t3_cond.cond_prompt_speech_emb is not None:
+            h.update(t3_cond.cond_prompt_speech_emb.detach().float().cpu().numpy().tobytes())
+        exaggeration = t3_cond.emotion_adv
+        if torch.is_tensor(exaggeration):
+            exaggeration = exaggeration.view(-1)[0].item()
+        return h.hexdigest(), round(float(exaggeration), 6)
+
+    def get_or_build(self, t3, t3_cond: T3Cond) -> T3CondPrefix:
+        "Look up the prefix of this voice, running the conditioning through `t3` on a miss."
+        assert t3_cond.speaker_emb.size(0) == 1, "one voice at a time"
+        key = self.voice_key(t3_cond)
+        with self._lock:
+            prefix = self._entries.get(key)
+            if prefix is not None:
+                self._entries.move_to_end(key)
+                return prefix
+
+        prefix = self.build(t3, t3_cond)
+        with self._lock:
+            self._entries[key] = prefix
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_voices:
+                self._entries.popitem(last=False)
+        return prefix
+
+    @staticmethod
+    @torch.inference_mode()
+    def build(t3, t3_cond: T3Cond) -> T3CondPrefix:
+        cond_emb = t3.prepare_conditioning(t3_cond)  # (1, len_cond, dim)
+        past = DynamicCache()
+        t3.tfmr(inputs_embeds=cond_emb, past_key_values=past, use_cache=True, return_dict=True)
+        return T3CondPrefix(cond_emb=cond_emb, keys=list(past.key_cache), values=list(past.value_cache))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
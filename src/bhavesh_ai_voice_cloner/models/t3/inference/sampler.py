@@ -0,0 +1,181 @@
+# Copyright (c) 2025 Bhavesh AI
+# MIT License
+from typing import List, Sequence, Union
+
+import torch
+from torch import Tensor
+
+
+RowParam = Union[float, Sequence[float], Tensor]
+
+
+def _row_param(value: RowParam, batch_size: int, device) -> Tensor:
+    "A scalar or per-row sampling parameter as a (B, 1) float tensor."
+    value = torch.as_tensor(value, dtype=torch.float32, device=device).reshape(-1, 1)
+    assert value.size(0) in (1, batch_size), f"expected 1 or {batch_size} values, got {value.size(0)}"
+    return value.expand(batch_size, 1).contiguous()
+
+
+class T3Sampler:
+    """
+    The T3 sampling recipe (CFG, temperature, repetition penalty, min_p, top_p, in this order) in one pass over
+    the logits, with the state of the generation kept in preallocated tensors:
+        * the sampled tokens are written to a (B, 1 + max_new_tokens) buffer that starts with BOS, instead of
+          a `torch.cat` per step
+        * the repetition penalty applies to the tokens whose running count is positive, the counts being
+          updated with a scatter per step, instead of gathering over all the generated ids
+        * min_p compares logits to `max + log(min_p)` (no softmax nor sort) and top_p only sorts when a row
+          has `top_p < 1`; the steps that are no-ops for every row (temperature 1, penalty 1, min_p 0, top_p 1)
+          are skipped
+    Sampling parameters are scalars or per-row sequences / tensors. Same distributions as the HF logits
+    processors `T3.inference` used before (`RepetitionPenaltyLogitsProcessor`, `MinPLogitsWarper`,
+    `TopPLogitsWarper`), up to rounding at the min_p threshold.
+
+    With a `cfg_weight > 0` on any row, the logits hold B conditional rows followed by their B unconditional
+    rows (rows without CFG may repeat their conditional logits there, their weight being 0).
+
+    Rows of different samplers can be merged (`cat`) and dropped (`select_rows`) to follow a changing batch;
+    the token buffer is then only meaningful if every row has the same tokens count, so such callers keep the
+    sampled tokens themselves (`max_new_tokens=0`) and record them with `count`.
+    """
+
+    def __init__(
+        self,
+        vocab_size: int,
+        max_new_tokens: int,
+        start_token: int,
+        batch_size=1,
+        temperature: RowParam=0.8,
+        min_p: RowParam=0.05,
+        top_p: RowParam=1.0,
+        repetition_penalty: RowParam=1.2,
+        cfg_weight: RowParam=0.0,
+        device=None,
+    ):
+        self.vocab_size = vocab_size
+        self.max_new_tokens = max_new_tokens
+        self.batch_size = batch_size
+
+        # parameters as (B, 1) tensors; the no-op checks are done once here, not per step
+        self.temperature = _row_param(temperature, batch_size, device)
+        self.set_cfg_weight(cfg_weight)
+        self.repetition_penalty = _row_param(repetition_penalty, batch_size, device)
+        min_p = _row_param(min_p, batch_size, device)
+        self.log_min_p = min_p.log()  # -inf when min_p is 0: nothing is removed
+        top_p = _row_param(top_p, batch_size, device)
+        self.top_p_threshold = 1 - top_p
+        self._use_temperature = bool((self.temperature != 1.0).any())
+        self._use_repetition_penalty = bool((self.repetition_penalty != 1.0).any())
+        self._use_min_p = bool((min_p > 0).any())
+        self._use_top_p = bool((top_p < 1.0).any())
+
+        self.tokens = torch.full((batch_size, 1 + max_new_tokens), start_token, dtype=torch.long, device=device)
+        self.token_counts = torch.zeros(batch_size, vocab_size, dtype=torch.int32, device=device)
+        self.token_counts[:, start_token] = 1
+        self._ones = torch.ones(batch_size, 1 + max_new_tokens, dtype=torch.int32, device=device)
+        self._logits = torch.empty(batch_size, vocab_size, device=device)
+        self.n_generated = 0
+
+    def set_cfg_weight(self, cfg_weight: RowParam):
+        "Change the CFG weight of the next steps (a scalar or per-row values)."
+        self.cfg_weight = _row_param(cfg_weight, self.batch_size, self.temperature.device)
+        self._use_cfg = bool((self.cfg_weight > 0).any())
+
+    _ROW_TENSORS = ("cfg_weight", "temperature", "repetition_penalty", "log_min_p", "top_p_threshold", "tokens", "token_counts", "_ones", "_logits")
+
+    @classmethod
+    def cat(cls, samplers: List["T3Sampler"]) -> "T3Sampler":
+        "One sampler with the rows of all `samplers`, in order (same vocab and buffer sizes)."
+        first = samplers[0]
+        merged = cls.__new__(cls)
+        merged.__dict__.update(first.__dict__)
+        for name in cls._ROW_TENSORS:
+            setattr(merged, name, torch.cat([getattr(sampler, name) for sampler in samplers]))
+        merged.batch_size = sum(sampler.batch_size for sampler in samplers)
+        for flag in ("_use_cfg", "_use_temperature", "_use_repetition_penalty", "_use_min_p", "_use_top_p"):
+            setattr(merged, flag, any(getattr(sampler, flag) for sampler in samplers))
+        return merged
+
+    def select_rows(self, indices: Tensor):
+        "Keep the rows `indices` only."
+        for name in self._ROW_TENSORS:
+            setattr(self, name, getattr(self, name)[indices])
+        self.batch_size = len(indices)
+        self._use_cfg = bool((self.cfg_weight > 0).any())
+        self._use_temperature = bool((self.temperature != 1.0).any())
+        self._use_repetition_penalty = bool((self.repetition_penalty != 1.0).any())
+        self._use_min_p = bool((self.log_min_p > -float("inf")).any())
+        self._use_top_p = bool((self.top_p_threshold > 0.0).any())
+
+    @property
+    def generated_ids(self) -> Tensor:
+        "(B, 1 + n_generated) BOS and the sampled tokens, a view of the buffer."
+        return self.tokens[:, :1 + self.n_generated]
+
+    def process(self, logits: Tensor) -> Tensor:
+        "The (B, vocab) processed logits of the next token for (B, vocab) logits, or (2B, vocab) with CFG."
+        B = self.batch_size
+        out = self._logits
+        if out.dtype != logits.dtype:
+            out = self._logits = torch.empty_like(self._logits, dtype=logits.dtype)
+
+        if self._use_cfg:
+            logits_cond, logits_uncond = logits[:B], logits[B:2 * B]
+            torch.sub(logits_cond, logits_uncond, out=out)
+            out.mul_(self.cfg_weight).add_(logits_cond)
+        else:
+            out.copy_(logits)
+
+        if self._use_temperature:
+            out.div_(self.temperature)
+
+        if self._use_repetition_penalty:
+            penalty = self.repetition_penalty
+            penalized = torch.where(out < 0, out * penalty, out / penalty)
+            out = torch.where(self.token_counts > 0, penalized, out)
+
+        if self._use_min_p:
+            # probs < min_p * max(probs)  <=>  logits < max(logits) + log(min_p); the top token always stays
+            threshold = out.amax(dim=-1, keepdim=True) + self.log_min_p
+            out = out.masked_fill(out < threshold, -float("inf"))
+
+        if self._use_top_p:
+            # drop the least likely tokens whose cumulative probability is <= 1 - top_p, keeping at least one
+            sorted_logits, sorted_indices = torch.sort(out, descending=False)
+            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            sorted_to_remove = cumulative_probs <= self.top_p_threshold
+            sorted_to_remove[:, -1] = False
+            to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+            out = out.masked_fill(to_remove, -float("inf"))
+        return out
+
+    def probs(self, logits: Tensor) -> Tensor:
+        "(B, vocab) next-token distribution."
+        return torch.softmax(self.process(logits), dim=-1)
+
+    def sample(self, logits: Tensor) -> Tensor:
+        "Sample and record the next token of every row. Returns (B, 1)."
+        next_token = torch.multinomial(self.probs(logits), num_samples=1)
+        self.append(next_token)
+        return next_token
+
+    def append(self, tokens: Tensor):
+        "Record (B, n) tokens, e.g. accepted draft tokens."
+        tokens = tokens.view(self.batch_size, -1)
+        n = tokens.size(1)
+        assert self.n_generated + n <= self.max_new_tokens, "more tokens than max_new_tokens"
+        self.tokens[:, 1 + self.n_generated:1 + self.n_generated + n] = tokens
+        self.count(tokens)
+        self.n_generated += n
+
+    def count(self, tokens: Tensor):
+        "Add (B, n) tokens to the counts of the repetition penalty, without recording them in the token buffer."
+        self.token_counts.scatter_add_(1, tokens.view(self.batch_size, -1), self._ones[:, :tokens.numel() // self.batch_size])
+
+    def truncate(self, n_generated: int):
+        "Forget the tokens after the first `n_generated` ones, e.g. rejected draft tokens."
+        if n_generated >= self.n_generated:
+            return
+        dropped = self.tokens[:, 1 + n_generated:1 + self.n_generated]
+        self.token_counts.scatter_add_(1, dropped, -self._ones[:, :dropped.size(1)])
+        self.n_generated = n_generated
@@ -0,0 +1,224 @@
+# Copyright (c) 2025 Bhavesh AI
+# MIT License
+import logging
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+import torch
+from torch import Tensor
+from transformers import Cache
+
+from .sampler import T3Sampler
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class T3SpeculativeStats:
+    "Draft tokens proposed and accepted by the full model, over the generations it is passed to."
+    num_drafted: int = 0
+    num_accepted: int = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.num_accepted / max(self.num_drafted, 1)
+
+
+class T3SpeculativeDecoder:
+    """
+    Speculative decoding for T3. A cheap draft proposes up to `num_draft_tokens` speech tokens, the full
+    model scores all of them in a single forward pass, and standard rejection sampling keeps a prefix of
+    the draft plus one token from the full model. The sampled tokens follow exactly the distribution of
+    the regular sampler (CFG, temperature, repetition penalty, min_p, top_p); only the number of full
+    forward passes changes.
+
+    Drafts:
+        "layers": self-speculative, the first `draft_layers` layers of the backbone followed by the final
+            norm and `speech_head`. Their KV states are the full model's own, so the draft writes straight
+            into the shared cache, which is rolled back before verification.
+        "ngram": no model at all, continues the most recent earlier occurrence of the last `ngram_size`
+            tokens. Free to run, useful for repetitive / long-form output.
+
+    The decoder holds no per-call state, so one instance serves concurrent generations; acceptance counts go
+    to the `stats` passed to each call.
+    """
+
+    def __init__(self, t3, draft="layers", num_draft_tokens=4, draft_layers=8, ngram_size=3):
+        assert draft in ("layers", "ngram"), f"unknown draft {draft!r}"
+        assert 0 < draft_layers < t3.cfg.num_hidden_layers
+        self.t3 = t3
+        self.hp = t3.hp
+        self.draft = draft
+        self.num_draft_tokens = num_draft_tokens
+        self.draft_layers = draft_layers
+        self.ngram_size = ngram_size
+        self.backend = t3.decode_engine.backend
+
+    def decode(self, logits: Tensor, past_key_values: Cache, **kwargs) -> Tensor:
+        """
+        Continue a prefilled sequence, see `decode_stream`. Returns (1, T) predicted speech tokens, ending
+        with the stop token if one was sampled.
+        """
+        return torch.cat(list(self.decode_stream(logits, past_key_values, **kwargs)), dim=1)
+
+    @torch.inference_mode()
+    def decode_stream(
+        self,
+        logits: Tensor,
+        past_key_values: Cache,
+        *,
+        max_new_tokens: int,
+        temperature=0.8,
+        min_p=0.05,
+        top_p=1.0,
+        repetition_penalty=1.2,
+        cfg_weight=0.0,
+        stop_on_eos=True,
+        stats: Optional[T3SpeculativeStats]=None,
+    ) -> Iterator[Tensor]:
+        """
+        Continue a prefilled sequence, yielding the new speech tokens of every draft-and-verify round as (1, n).
+
+        :param logits: (n_rows, vocab) next-token logits of the prefill, with the (cond, uncond) rows for CFG
+        :param past_key_values: the prefill KV cache, extended in place
+        :param stats: counts the drafted and accepted tokens of this call
+        """
+        stats = stats if stats is not None else T3SpeculativeStats()
+        sampler = T3Sampler(
+            self.hp.speech_tokens_dict_size,
+            max_new_tokens,
+            self.hp.start_speech_token,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            device=logits.device,
+        )
+        stop_token = self.hp.stop_speech_token if stop_on_eos else -1
+        n_rows = logits.size(0)
+        device = logits.device
+
+        token = sampler.sample(logits)[0]  # (1,)
+        yield token[None]
+
+        while sampler.n_generated < max_new_tokens and token.item() != stop_token:
+            n_predicted = sampler.n_generated
+            past_len = past_key_values.get_seq_length()
+
+            # the last token is fed back along with the draft, so each round yields at most k + 1 tokens
+            k = min(self.num_draft_tokens, max_new_tokens - n_predicted - 1)
+            if self.draft == "layers":
+                draft_tokens, draft_probs = self._draft_layers(sampler, token, past_key_values, k, n_rows, stop_token)
+                past_key_values.crop(past_len)
+                sampler.truncate(n_predicted)
+            else:
+                draft_tokens, draft_probs = self._draft_ngram(sampler.generated_ids, k), None
+
+            # verify: score the last token and the whole draft with the full model
+            tokens = torch.cat([token] + draft_tokens)  # (1 + n_draft,)
+            inputs_embeds = self._embed(tokens, n_predicted, n_rows)
+            output = self.backend(
+                inputs_embeds=inputs_embeds,
+                past_key_values=past_key_values,
+                use_cache=True,
+                output_attentions=False,
+                output_hidden_states=False,
+                return_dict=True,
+                num_logits_to_keep=tokens.size(0),
+            )
+            verify_logits = output.logits  # (n_rows, 1 + n_draft, vocab)
+
+            n_accepted, token = 0, None
+            for j, draft_token in enumerate(draft_tokens):
+                p = sampler.probs(verify_logits[:, j])[0]
+                q = draft_probs[j] if draft_probs is not None else None
+                q_token = q[draft_token] if q is not None else 1.0
+                if torch.rand((), device=device) * q_token < p[draft_token]:
+                    n_accepted += 1
+                    sampler.append(draft_token[None])
+                    if draft_token.item() == stop_token:
+                        break
+                else:
+                    # resample from the part of p that the draft under-covers
+                    if q is None:
+                        residual = p.clone()
+                        residual[draft_token] = 0
+                    else:
+                        residual = (p - q).clamp(min=0)
+                    if residual.sum() <= 0:
+                        residual = p
+                    token = torch.multinomial(residual / residual.sum(), num_samples=1)
+                    break
+
+            stats.num_drafted += len(draft_tokens)
+            stats.num_accepted += n_accepted
+
+            if token is None:
+                if sampler.generated_ids[0, -1].item() == stop_token:
+                    yield sampler.generated_ids[:, -n_accepted:].clone()
+                    break
+                # the whole draft was accepted, the last position gives one more token for free
+                token = sampler.sample(verify_logits[:, n_accepted])[0]
+            else:
+                sampler.append(token[None])
+            yield sampler.generated_ids[:, -(n_accepted + 1):].clone()
+
+            # keep the states of the fed-back token and the accepted draft
+            past_key_values.crop(past_len + 1 + n_accepted)
+
+    def _embed(self, tokens: Tensor, n_predicted: int, n_rows: int) -> Tensor:
+        "(n_rows, T, dim) input embeddings of predicted speech tokens, the first being token number `n_predicted`."
+        pos_embeds = self.t3.speech_pos_emb.emb.weight[n_predicted:n_predicted + tokens.size(0)]
+        embeds = self.t3.speech_emb(tokens)[None] + pos_embeds
+        return embeds.expand(n_rows, -1, -1)
+
+    def _draft_layers(self, sampler: T3Sampler, token, past_key_values, k, n_rows, stop_token) -> Tuple[List[Tensor], List[Tensor]]:
+        "Draft up to `k` tokens, recorded in `sampler` (for the repetition penalty): truncate it afterwards."
+        draft_tokens, draft_probs = [], []
+        n_predicted = sampler.n_generated
+        for j in range(k):
+            inputs_embeds = self._embed(token, n_predicted + j, n_rows)
+            q = sampler.probs(self._draft_forward(inputs_embeds, past_key_values))[0]
+            token = torch.multinomial(q, num_samples=1)
+            draft_tokens.append(token)
+            draft_probs.append(q)
+            sampler.append(token[None])
+            if token.item() == stop_token:
+                break
+        return draft_tokens, draft_probs
+
+    def _draft_forward(self, inputs_embeds: Tensor, past_key_values: Cache) -> Tensor:
+        "One token through the first `draft_layers` layers, the final norm and the speech head."
+        tfmr = self.t3.tfmr
+        past_len = past_key_values.get_seq_length()
+        cache_position = torch.arange(past_len, past_len + inputs_embeds.size(1), device=inputs_embeds.device)
+        position_ids = cache_position[None]
+        hidden_states = inputs_embeds
+        position_embeddings = tfmr.rotary_emb(hidden_states, position_ids)
+        for decoder_layer in tfmr.layers[:self.draft_layers]:
+            hidden_states = decoder_layer(
+                hidden_states,
+                attention_mask=None,
+                position_ids=position_ids,
+                past_key_value=past_key_values,
+                use_cache=True,
+                cache_position=cache_position,
+                position_embeddings=position_embeddings,
+            )[0]
+        hidden_states = tfmr.norm(hidden_states[:, -1])
+        return self.t3.speech_head(hidden_states)  # (n_rows, vocab)
+
+    def _draft_ngram(self, generated_ids: Tensor, k: int) -> List[Tensor]:
+        "Continue the most recent earlier match of the last `ngram_size` tokens."
+        history = generated_ids[0, 1:].tolist()
+        n = self.ngram_size
+        if k <= 0 or len(history) <= n:
+            return []
+        tail = history[-n:]
+        for start in range(len(history) - n - 1, -1, -1):
+            if history[start:start + n] == tail:
+                continuation = history[start + n:start + n + k]
+                return [torch.tensor([t], dtype=torch.long, device=generated_ids.device) for t in continuation]
+        return []
@@ -1,3 +1,4 @@
+from contextlib import nullcontext
 from typing import Optional
 
 import torch
@@ -74,39 +75,52 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         self,
         inputs_embeds: torch.Tensor,
         past_key_values: Optional[torch.Tensor]=None,
+        attention_mask: Optional[torch.Tensor]=None,
+        position_ids: Optional[torch.LongTensor]=None,
         use_cache=True,
         output_attentions=False,
         output_hidden_states=True,
         return_dict=True,
+        num_logits_to_keep: int=0,
     ):
         """
         This is a method used by huggingface's generate() method.
         Overridden here to apply our custom layer norm and speech logit projection layers.
 
         :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given,
-        S should be 1.
+        S is usually 1, or the rest of a prompt whose prefix is already cached.
+        :param attention_mask: optional (B, past + S) padding mask, used when rows of a batch have different lengths.
+        :param position_ids: optional (B, S) RoPE positions, required alongside a padding mask.
+        :param num_logits_to_keep: only project the last `num_logits_to_keep` positions to speech logits (0 = all).
+
+        For decoding, call with `output_hidden_states=False, output_attentions=False, num_logits_to_keep=1`: this keeps
+        the SDPA kernels in every layer and skips the per-layer hidden state tuple and the full-prefix logit projection.
+        If an alignment analyzer is attached, it spies on a single layer by itself. `T3DecodeEngine` shares one backend
+        between threads and leaves it unset, each `T3DecodeSession` applying its own analyzer.
         """
-        is_large_input = inputs_embeds.size(1) != 1
-        has_cache = past_key_values is not None and len(past_key_values) > 0
-        assert not (is_large_input and has_cache)
         assert return_dict
-        assert output_hidden_states
-
-        tfmr_out = self.model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=past_key_values,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=True,
-        )
-        hidden_states = tfmr_out.hidden_states[-1]  # (B, seq, dim)
+
+        with self.alignment_stream_analyzer.watch() if self.alignment_stream_analyzer is not None else nullcontext():
+            tfmr_out = self.model(
+                inputs_embeds=inputs_embeds,
+                past_key_values=past_key_values,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=True,
+            )
+        hidden_states = tfmr_out.last_hidden_state  # (B, seq, dim), same as `hidden_states[-1]`
+        if num_logits_to_keep > 0:
+            hidden_states = hidden_states[:, -num_logits_to_keep:]
 
         logits = self.speech_head(hidden_states)
         # assert inputs_embeds.size(0) == 1 # (disabled for CFG)
 
         # NOTE: hallucination handler may modify logits to force emit an EOS token
-        # logits = self.alignment_stream_analyzer.step(logits)
+        if self.alignment_stream_analyzer is not None:
+            logits[:, -1] = self.alignment_stream_analyzer.step(logits[:, -1])
 
         return CausalLMOutputWithCrossAttentions(
             logits=logits,
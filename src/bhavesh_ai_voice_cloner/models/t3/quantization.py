@@ -0,0 +1,150 @@
+# Copyright (c) 2025 Bhavesh AI
+# MIT License
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import torch
+from torch import nn, Tensor
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from safetensors.torch import save_file
+
+from ...model_hub import file_fingerprint, matches_fingerprint
+from ..utils import MappedSafetensors
+from .inference.decode_engine import T3DecodeEngine
+
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATIONS = ("int8",)
+# bumped when the format of the pre-quantized checkpoints changes
+QUANTIZATION_VERSION = 2
+
+
+def quantized_linear_names(t3) -> List[str]:
+    """
+    The linears run at every decoding step, which dominate its time on CPU: the attention and MLP projections
+    of the Llama layers, and the speech head. The conditioning encoder and the text head stay in fp32.
+    """
+    return [
+        name for name, module in t3.named_modules()
+        if isinstance(module, nn.Linear) and (name.startswith("tfmr.layers.") or name == "speech_head")
+    ]
+
+
+def quantize_weight(weight: Tensor) -> Tuple[Tensor, Tensor]:
+    "Symmetric per-output-channel int8 quantization of a (out, in) weight: (int8 weight, (out,) fp32 scales)."
+    scales = weight.detach().abs().amax(dim=1).float().clamp(min=1e-8) / 127
+    weight_int8 = torch.round(weight.detach().float() / scales[:, None]).clamp(-127, 127).to(torch.int8)
+    return weight_int8, scales
+
+
+def int8_linear(weight_int8: Tensor, scales: Tensor, bias=None) -> DynamicQuantizedLinear:
+    "A dynamically quantized linear (int8 weights, activations quantized per call) running on fbgemm / onednn."
+    out_features, in_features = weight_int8.shape
+    qweight = torch._make_per_channel_quantized_tensor(
+        weight_int8, scales.double(), torch.zeros_like(scales, dtype=torch.long), axis=0,
+    )
+    # built 1x1, as the constructor prepacks a placeholder weight of the full size, which is as slow as the real one
+    linear = DynamicQuantizedLinear(1, 1, bias_=bias is not None, dtype=torch.qint8)
+    linear.in_features, linear.out_features = in_features, out_features
+    linear.set_weight_bias(qweight, None if bias is None else bias.float())
+    return linear
+
+
+def _set_module(root: nn.Module, name: str, module: nn.Module):
+    parent_name, _, child_name = name.rpartition(".")
+    setattr(root.get_submodule(parent_name) if parent_name else root, child_name, module)
+
+
+def _swap_linears(t3, linears: Dict[str, nn.Module]):
+    for name, linear in linears.items():
+        _set_module(t3, name, linear)
+    # the decoding backend holds the speech head it was built with
+    t3.decode_engine = T3DecodeEngine(t3)
+
+
+def quantize_t3(t3, quantization="int8"):
+    "Quantize the `quantized_linear_names` of a loaded (CPU) T3 in place. Returns it."
+    assert quantization in QUANTIZATIONS, f"unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}"
+    linears = {}
+    for name in quantized_linear_names(t3):
+        linear = t3.get_submodule(name)
+        linears[name] = int8_linear(*quantize_weight(linear.weight), bias=linear.bias)
+    _swap_linears(t3, linears)
+    return t3
+
+
+def quantized_checkpoint_path(fpath, quantization="int8") -> Path:
+    "Where the pre-quantized checkpoint of `fpath` is cached, e.g. t3_cfg.int8.safetensors."
+    fpath = Path(fpath)
+    return fpath.with_name(f"{fpath.stem}.{quantization}{fpath.suffix}")
+
+
+def _metadata(source_fpath, quantization) -> Dict[str, str]:
+    "What the quantized checkpoint was made from: the quantization, and the fingerprint of the source file."
+    return dict(
+        quantization=quantization,
+        version=str(QUANTIZATION_VERSION),
+        source=Path(source_fpath).name,
+        **{f"source_{key}": value for key, value in file_fingerprint(source_fpath).items()},
+    )
+
+
+def save_quantized_t3(t3, fpath, source_fpath, quantization="int8"):
+    """
+    Save a quantized T3 as safetensors: `<name>.weight_int8`, `<name>.weight_scale` (and `<name>.bias`) for the
+    quantized linears, the regular state dict for the rest. Written atomically, so that concurrent loaders never
+    read a partial file.
+    """
+    state = {}
+    quantized_prefixes = []
+    for name, module in t3.named_modules():
+        if isinstance(module, DynamicQuantizedLinear):
+            qweight, bias = module._weight_bias()
+            state[f"{name}.weight_int8"] = qweight.int_repr().contiguous()
+            state[f"{name}.weight_scale"] = qweight.q_per_channel_scales().float().contiguous()
+            if bias is not None:
+                state[f"{name}.bias"] = bias.contiguous()
+            quantized_prefixes.append(f"{name}.")
+    for key, tensor in t3.state_dict().items():
+        if not key.startswith(tuple(quantized_prefixes)):
+            state[key] = tensor.contiguous()
+
+    fpath = Path(fpath)
+    tmp_fpath = fpath.with_name(f".{fpath.name}.{os.getpid()}.tmp")
+    save_file(state, tmp_fpath, metadata=_metadata(source_fpath, quantization))
+    os.replace(tmp_fpath, fpath)
+
+
+def is_valid_quantized_checkpoint(fpath, source_fpath, quantization="int8") -> bool:
+    """
+    Whether `fpath` exists and was quantized with this version from the current content of `source_fpath`
+    (see `matches_fingerprint`).
+    """
+    if not Path(fpath).exists():
+        return False
+    metadata = MappedSafetensors(fpath).metadata
+    expected = dict(quantization=quantization, version=str(QUANTIZATION_VERSION), source=Path(source_fpath).name)
+    if any(metadata.get(key) != value for key, value in expected.items()):
+        return False
+    fingerprint = {key[len("source_"):]: value for key, value in metadata.items() if key.startswith("source_")}
+    return matches_fingerprint(source_fpath, fingerprint)
+
+
+def load_quantized_t3_weights(t3, fpath):
+    """
+    Load the pre-quantized checkpoint `fpath` into a (meta-initialized) T3: its linears are swapped for the int8
+    ones, and the other weights assigned the tensors of the memory-mapped file. Parameters missing from the file
+    are left as they are (on the meta device).
+    """
+    state = MappedSafetensors(fpath).state_dict()
+    linears = {}
+    for name in quantized_linear_names(t3):
+        linears[name] = (state.pop(f"{name}.weight_int8"), state.pop(f"{name}.weight_scale"), state.pop(f"{name}.bias", None))
+    # before the swap: the int8 linears only load their own state format
+    result = t3.load_state_dict(state, strict=False, assign=True)
+    if result.unexpected_keys:
+        raise RuntimeError(f"unexpected keys in {fpath}: {result.unexpected_keys}")
+    _swap_linears(t3, {name: int8_linear(*tensors) for name, tensors in linears.items()})
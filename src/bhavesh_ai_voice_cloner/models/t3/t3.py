@@ -3,19 +3,21 @@
 import logging
 from typing import Union, Optional, List
 
-from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
 from transformers import LlamaModel, LlamaConfig
-from transformers.generation.logits_process import MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
 
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
 from .modules.cond_enc import T3CondEnc, T3Cond
 from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
-from .inference.t3_hf_backend import T3HuggingfaceBackend
+from .inference.cfg_schedule import T3CFGSchedule
+from .inference.decode_engine import T3DecodeEngine
+from .inference.kv_cache import T3KVCachePool
+from .inference.prefix_cache import T3CondPrefix, T3PrefixCache
+from .inference.speculative import T3SpeculativeDecoder
 from ..utils import AttrDict
 
 
@@ -62,11 +64,14 @@ class T3(nn.Module):
         # logit projection
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=False)
-        self.compiled = False
+
+        # decoding, shared by all the `inference` calls (thread-safe)
+        self.decode_engine = T3DecodeEngine(self)
 
     @property
     def device(self):
-        return self.speech_head.weight.device
+        # not `speech_head`, which may be quantized (see `quantization.py`)
+        return self.speech_emb.weight.device
 
     def prepare_conditioning(self, t3_cond: T3Cond):
         """
@@ -87,6 +92,17 @@ class T3(nn.Module):
     ):
         # prepare input embeddings (skip backbone tranformer embeddings)
         cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
+        text_speech_emb = self._prepare_text_speech_embeds(text_tokens, speech_tokens, cfg_weight)
+        len_cond = cond_emb.size(1)
+
+        if cond_emb.size(0) != text_speech_emb.size(0):
+             cond_emb = cond_emb.expand(text_speech_emb.size(0), -1, -1)
+
+        # concat
+        embeds = torch.cat([cond_emb, text_speech_emb], dim=1)  # (B, length, dim)
+        return embeds, len_cond
+
+    def _prepare_text_speech_embeds(self, text_tokens, speech_tokens, cfg_weight=0.0):
         text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
         if cfg_weight > 0.0:
             text_emb[1].zero_()  # CFG uncond
@@ -95,17 +111,40 @@ class T3(nn.Module):
         if self.hp.input_pos_emb == "learned":
             text_emb = text_emb + self.text_pos_emb(text_tokens)
             speech_emb = speech_emb + self.speech_pos_emb(speech_tokens)
-        len_cond = cond_emb.size(1)
+        return torch.cat([text_emb, speech_emb], dim=1)  # (B, len_text + len_speech, dim)
 
-        if cond_emb.size(0) != text_emb.size(0):
-             cond_emb = cond_emb.expand(text_emb.size(0), -1, -1)
+    def prepare_inference_embeds(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: torch.LongTensor,
+        initial_speech_tokens: Optional[torch.LongTensor] = None,
+        cfg_weight: float = 0.0,
+        cond_prefix: Optional[T3CondPrefix] = None,
+    ):
+        """
+        Prefill embeddings for autoregressive decoding: conditioning, text and start-of-speech.
+        With CFG, `text_tokens` holds the (cond, uncond) pair and a second BOS embedding is appended to both rows.
+        With a `cond_prefix` (whose states are already in the KV cache), the conditioning is left out.
+        """
+        if initial_speech_tokens is None:
+            initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
 
-        # concat
-        embeds = torch.stack([
-            torch.cat((ce, te, se))
-            for ce, te, se in zip(cond_emb, text_emb, speech_emb)
-        ])  # (B, length, dim)
-        return embeds, len_cond
+        if cond_prefix is None:
+            embeds, len_cond = self.prepare_input_embeds(
+                t3_cond=t3_cond,
+                text_tokens=text_tokens,
+                speech_tokens=initial_speech_tokens,
+                cfg_weight=cfg_weight,
+            )
+        else:
+            embeds = self._prepare_text_speech_embeds(text_tokens, initial_speech_tokens, cfg_weight)
+            len_cond = len(cond_prefix)
+        if cfg_weight > 0:
+            bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=embeds.device)
+            bos_embed = self.speech_emb(bos_token) + self.speech_pos_emb.get_fixed_embedding(0)
+            embeds = torch.cat([embeds, bos_embed.expand(embeds.size(0), -1, -1)], dim=1)
+        return embeds, len_cond  # (B, [len_cond +] len_text + 1 [+ 1], dim)
 
     def forward(
         self,
@@ -200,8 +239,14 @@ class T3(nn.Module):
 
         return loss_text, loss_speech
 
+    def inference(self, **kwargs):
+        """
+        Sample speech tokens, see `inference_stream` for the arguments. Returns a (1, T) tensor.
+        """
+        return torch.cat(list(self.inference_stream(**kwargs)), dim=1)
+
     @torch.inference_mode()
-    def inference(
+    def inference_stream(
         self,
         *,
         t3_cond: T3Cond,
@@ -222,150 +267,51 @@ class T3(nn.Module):
         length_penalty=1.0,
         repetition_penalty=1.2,
         cfg_weight=0,
+        # how the CFG weight evolves over the generation, see `T3CFGSchedule` (a schedule reaching 0 drops the
+        # unconditional row and decodes the rest at batch 1)
+        cfg_schedule: Union[str, T3CFGSchedule]="constant",
+
+        # hallucination checks on the text-speech alignment of one attention layer (slower)
+        alignment_analysis=False,
+
+        # KV cache: "dynamic" grows by concatenation, "static" is preallocated for the whole request, "fp16" and
+        # "int8" are static caches storing compressed states (less memory per stream, see `T3QuantizedCache`)
+        kv_cache="dynamic",
+        kv_cache_pool: Optional[T3KVCachePool]=None,
+
+        # per-voice conditioning states, so that only the text and BOS tokens are prefilled
+        prefix_cache: Optional[T3PrefixCache]=None,
+
+        # draft-and-verify decoding, same output distribution with fewer full forward passes
+        speculative: Optional[T3SpeculativeDecoder]=None,
     ):
         """
+        Yields the sampled speech tokens as they are decoded, as (1, n) tensors; the last one ends with the
+        stop token if it was sampled.
+
         Args:
             text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            kv_cache_pool: reuse static KV buffers across calls (of the pool's `kv_cache` type, which overrides `kv_cache`).
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
         _ensure_BOT_EOT(text_tokens, self.hp)
-        text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
-
-        # Default initial speech to a single start-of-speech token
-        if initial_speech_tokens is None:
-            initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
 
-        # Prepare custom input embeds
-        embeds, len_cond = self.prepare_input_embeds(
+        yield from self.decode_engine.session(
             t3_cond=t3_cond,
             text_tokens=text_tokens,
-            speech_tokens=initial_speech_tokens,
+            initial_speech_tokens=initial_speech_tokens,
+            max_new_tokens=max_new_tokens,
+            stop_on_eos=stop_on_eos,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
             cfg_weight=cfg_weight,
+            cfg_schedule=cfg_schedule,
+            alignment_analysis=alignment_analysis,
+            kv_cache=kv_cache,
+            kv_cache_pool=kv_cache_pool,
+            prefix_cache=prefix_cache,
+            speculative=speculative,
         )
-
-        # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
-        # Note the llama-specific logic. Other tfmr types can be added later.
-
-        self.compiled = False
-
-        # TODO? synchronize the expensive compile function
-        # with self.compile_lock:
-        if not self.compiled:
-            patched_model = T3HuggingfaceBackend(
-                config=self.cfg,
-                llama=self.tfmr,
-                speech_enc=self.speech_emb,
-                speech_head=self.speech_head,
-                alignment_stream_analyzer=None,
-            )
-            self.patched_model = patched_model
-            self.compiled = True
-
-        # # Run normal generate method, which calls our custom extended methods
-        # return self.patched_model.generate(
-        #     inputs=initial_speech_tokens,
-        #     decoder_cond=embeds,
-        #     bos_token_id=self.hp.start_speech_token,
-        #     eos_token_id=(self.hp.stop_speech_token if stop_on_eos else -1),
-        #     pad_token_id=self.hp.stop_speech_token,
-        #     max_new_tokens=max_new_tokens or self.hp.max_speech_tokens,
-        #     num_return_sequences=num_return_sequences,
-        #     temperature=temperature,
-        #     min_p=min_p,
-        #     length_penalty=length_penalty,
-        #     repetition_penalty=repetition_penalty,
-        #     do_sample=do_sample,
-        #     # cache_implementation=None if not self.compiled else "static",
-        # )
-
-        device = embeds.device
-
-        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
-        bos_embed = self.speech_emb(bos_token)  # shape: (B, 1, embed_dim)
-        bos_embed = bos_embed + self.speech_pos_emb.get_fixed_embedding(0)
-
-        # batch_size=2 for CFG
-        bos_embed = torch.cat([bos_embed, bos_embed])
-
-        # Combine condition and BOS token for the initial input if cfg_weight > 0
-        if cfg_weight > 0:
-            inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
-        else:
-            inputs_embeds = embeds
-
-        # Track generated token ids; start with the BOS token.
-        generated_ids = bos_token.clone()
-        predicted = []  # To store the predicted tokens
-
-        # Instantiate the logits processors.
-        min_p_warper = MinPLogitsWarper(min_p=min_p)
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
-
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
-            use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
-            return_dict=True,
-        )
-        # Initialize kv_cache with the full context.
-        past = output.past_key_values
-
-        # ---- Generation Loop using kv_cache ----
-        for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits = output.logits[:, -1, :]
-
-            # CFG
-            if cfg_weight > 0.0:
-                logits_cond = logits[0:1]
-                logits_uncond = logits[1:2]
-                logits = logits_cond + cfg_weight * (logits_cond - logits_uncond)
-
-            logits = logits.squeeze(1)
-
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
-
-            # Apply repetition penalty and top‑p filtering.
-            logits = repetition_penalty_processor(generated_ids, logits)
-            logits = min_p_warper(None, logits)
-            logits = top_p_warper(None, logits)
-
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
-
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
-
-            # Check for EOS token.
-            if next_token.view(-1) == self.hp.stop_speech_token:
-                break
-
-            # Get embedding for the new token.
-            next_token_embed = self.speech_emb(next_token)
-            next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
-
-            #  For CFG
-            if cfg_weight > 0.0:
-                next_token_embed = torch.cat([next_token_embed, next_token_embed])
-
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
-                inputs_embeds=next_token_embed,
-                past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
-                return_dict=True,
-            )
-            # Update the kv_cache.
-            past = output.past_key_values
-
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
@@ -1,4 +1,149 @@
+import json
+import math
+import mmap
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict
+
+import torch
+import torchaudio as ta
+
+
 class AttrDict(dict):
     def __init__(self, *args, **kwargs):
         super(AttrDict, self).__init__(*args, **kwargs)
         self.__dict__ = self
+
+
+@lru_cache(100)
+def get_resampler(src_sr, dst_sr, device):
+    "A `torchaudio` resampler, whose sinc kernel is computed once per (src_sr, dst_sr, device)."
+    return ta.transforms.Resample(src_sr, dst_sr).to(device)
+
+
+# safetensors dtype names
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+class MappedSafetensors:
+    "A safetensors file mapped into memory, its tensors being views of the mapping (copy-on-write)."
+
+    def __init__(self, fpath: Path):
+        with open(fpath, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        header_len = int.from_bytes(self._mmap[:8], "little")
+        self._header = json.loads(self._mmap[8:8 + header_len])
+        self.metadata: Dict[str, str] = self._header.pop("__metadata__", None) or {}
+        self._data_start = 8 + header_len
+
+    @property
+    def nbytes(self):
+        return len(self._mmap)
+
+    def keys(self):
+        return self._header.keys()
+
+    def get_tensor(self, name) -> torch.Tensor:
+        info = self._header[name]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if end == begin:
+            return torch.empty(info["shape"], dtype=dtype)
+        flat = torch.frombuffer(self._mmap, dtype=dtype, count=(end - begin) // dtype.itemsize, offset=self._data_start + begin)
+        return flat.view(info["shape"])
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        return {name: self.get_tensor(name) for name in self.keys()}
+
+
+_empty_weights_lock = threading.Lock()
+_empty_weights_local = threading.local()
+# number of `init_empty_weights` contexts open in all threads, and the `register_parameter` they replaced
+_empty_weights_users = 0
+_register_parameter = None
+
+
+def _register_meta_parameter(module, name, param):
+    _register_parameter(module, name, param)
+    if param is not None and getattr(_empty_weights_local, "depth", 0) and param.device.type != "meta":
+        param = module._parameters[name]
+        module._parameters[name] = type(param)(param.to("meta"), requires_grad=param.requires_grad)
+
+
+@contextmanager
+def init_empty_weights():
+    """
+    Create the parameters of the modules built in the context on the meta device: no memory and no
+    initialization (the init functions are no-ops on meta tensors), for modules whose weights are all loaded
+    next with `load_state_dict(..., assign=True)`. Buffers are created as usual, many being computed in
+    `__init__` (windows, filterbanks, rotary frequencies). Only affects the calling thread.
+    """
+    global _empty_weights_users, _register_parameter
+    with _empty_weights_lock:
+        # patched while any thread is in the context (the calling ones only see the change), restored after the last
+        if _empty_weights_users == 0:
+            _register_parameter = torch.nn.Module.register_parameter
+            torch.nn.Module.register_parameter = _register_meta_parameter
+        _empty_weights_users += 1
+    _empty_weights_local.depth = getattr(_empty_weights_local, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _empty_weights_local.depth -= 1
+        with _empty_weights_lock:
+            _empty_weights_users -= 1
+            if _empty_weights_users == 0:
+                torch.nn.Module.register_parameter = _register_parameter
+
+
+def _init_parameter(name: str, param: torch.Tensor):
+    "Default init of a parameter without its module's `reset_parameters`: as `nn.Linear` for matrices, norm-like vectors otherwise."
+    if param.dim() >= 2:
+        torch.nn.init.kaiming_uniform_(param, a=math.sqrt(5))
+    elif name == "weight":
+        torch.nn.init.ones_(param)
+    else:
+        torch.nn.init.zeros_(param)
+
+
+@torch.no_grad()
+def materialize_meta_parameters(module: torch.nn.Module, device) -> list:
+    """
+    Allocate the parameters left on the meta device after loading (missing from a checkpoint loaded with
+    `strict=False`) and initialize them, without touching the loaded parameters and buffers: with the module's
+    `reset_parameters` when none of its parameters was loaded, else on their own (`_init_parameter`).
+    Returns their names.
+    """
+    names = []
+    for module_name, submodule in module.named_modules():
+        params = dict(submodule.named_parameters(recurse=False))
+        meta = [name for name, p in params.items() if p.device.type == "meta"]
+        if not meta:
+            continue
+        for name in meta:
+            p = params[name]
+            setattr(submodule, name, torch.nn.Parameter(torch.empty_like(p, device=device), requires_grad=p.requires_grad))
+        if len(meta) == len(params) and hasattr(submodule, "reset_parameters"):
+            # some also reset buffers (e.g. the running stats of batch norms), which may have been loaded
+            buffers = {name: b.clone() for name, b in submodule.named_buffers(recurse=False) if b is not None}
+            submodule.reset_parameters()
+            for name, b in buffers.items():
+                getattr(submodule, name).copy_(b)
+        else:
+            for name in meta:
+                _init_parameter(name, getattr(submodule, name))
+        names += [f"{module_name}.{name}" if module_name else name for name in meta]
+    return names
@@ -10,7 +10,7 @@ import torch.nn.functional as F
 from torch import nn, Tensor
 
 from .config import VoiceEncConfig
-from .melspec import melspectrogram
+from ..spectral import get_spectral_frontend
 
 
 def pack(arrays, seq_len: int=None, pad_value=0):
@@ -269,6 +269,8 @@ class VoiceEncoder(nn.Module):
         if "rate" not in kwargs:
             kwargs["rate"] = 1.3  # Resemble's default value.
 
-        mels = [melspectrogram(w, self.hp).T for w in wavs]
+        # the mels of all the wavs in one padded batch, as `melspectrogram`
+        wavs = [torch.as_tensor(np.asarray(wav, dtype=np.float32)) for wav in wavs]
+        mels, mel_lens = get_spectral_frontend(self.device).ve_mel(wavs)
 
-        return self.embeds_from_mels(mels, as_spk=as_spk, batch_size=batch_size, **kwargs)
+        return self.embeds_from_mels(mels.transpose(1, 2), mel_lens, as_spk=as_spk, batch_size=batch_size, **kwargs)
@@ -1,22 +1,25 @@
+import threading
+import time
+import weakref
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Optional
 
-import librosa
 import torch
-import perth
 import torch.nn.functional as F
-from huggingface_hub import hf_hub_download
-from safetensors.torch import load_file
 
 from .models.t3 import T3
+from .models.t3.inference import T3BatchEngine, T3GenerationRequest, T3KVCachePool, T3PrefixCache, T3SpeculativeDecoder
 from .models.s3tokenizer import S3_SR, drop_invalid_tokens
 from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
-
-
-REPO_ID = "ResembleAI/chatterbox"
+from .audio_ingest import INGEST_VERSION, AudioClip
+from .conditionals_cache import ConditionalsCache
+from .voice_bank import VoiceBank
+from .model_hub import MODEL_FILES, REPO_ID, resolve_model_dir
+from .model_registry import MODEL_REGISTRY, acquire_models
 
 
 def punc_norm(text: str) -> str:
@@ -88,19 +91,40 @@ class Conditionals:
                 self.gen[k] = v.to(device=device)
         return self
 
-    def save(self, fpath: Path):
-        arg_dict = dict(
-            t3=self.t3.__dict__,
-            gen=self.gen
+    def state_dict(self):
+        return dict(
+            t3=dict(self.t3.__dict__),
+            gen=dict(self.gen)
         )
-        torch.save(arg_dict, fpath)
+
+    @classmethod
+    def from_state_dict(cls, states):
+        "New `Conditionals` sharing the tensors of `states` (e.g. a `ConditionalsCache` entry)."
+        return cls(T3Cond(**states['t3']), dict(states['gen']))
+
+    def save(self, fpath: Path):
+        torch.save(self.state_dict(), fpath)
 
     @classmethod
     def load(cls, fpath, map_location="cpu"):
         if isinstance(map_location, str):
             map_location = torch.device(map_location)
         kwargs = torch.load(fpath, map_location=map_location, weights_only=True)
-        return cls(T3Cond(**kwargs['t3']), kwargs['gen'])
+        return cls.from_state_dict(kwargs)
+
+
+@dataclass
+class StreamingMetrics:
+    "Timings of one `BhaveshTTS.generate_stream` call, updated as chunks are yielded."
+    first_chunk_latency: Optional[float] = None  # seconds from the call to the first audio chunk
+    total_time: float = 0.0
+    audio_duration: float = 0.0
+    chunk_count: int = 0
+
+    @property
+    def rtf(self):
+        "Real-time factor: processing time over audio duration."
+        return self.total_time / self.audio_duration if self.audio_duration > 0 else None
 
 
 class BhaveshTTS:
@@ -115,7 +139,12 @@ class BhaveshTTS:
         tokenizer: EnTokenizer,
         device: str,
         conds: Conditionals = None,
+        conds_cache: ConditionalsCache = None,
+        voice_bank: VoiceBank = None,
+        kv_cache="dynamic",
     ):
+        import perth  # deferred, takes seconds to import
+
         self.sr = S3GEN_SR  # sample rate of synthesized audio
         self.t3 = t3
         self.s3gen = s3gen
@@ -124,9 +153,46 @@ class BhaveshTTS:
         self.device = device
         self.conds = conds
         self.watermarker = perth.PerthImplicitWatermarker()
+        self._t3_engine = None
+        self._t3_engine_lock = threading.Lock()
+        # preallocated KV buffers reused by the `generate` calls, opt-in ("static", or compressed: "fp16" / "int8");
+        # "dynamic" grows a cache per call
+        self.kv_cache_pool = T3KVCachePool(t3.cfg, kv_cache=kv_cache) if kv_cache != "dynamic" else None
+        # conditioning KV states of recently used voices
+        self.prefix_cache = T3PrefixCache()
+        # `Conditionals` of the reference clips seen before
+        self.conds_cache = conds_cache if conds_cache is not None else ConditionalsCache()
+        # enrolled voices, see `use_voice`
+        self.voice_bank = voice_bank
+        self._release_models = None
+
+    def close(self):
+        "Release the models acquired from `MODEL_REGISTRY` by `from_local`; they are also released on garbage collection."
+        if self._t3_engine is not None:
+            self._t3_engine.stop()
+        if self._release_models is not None:
+            self._release_models()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'BhaveshTTS':
+    def from_local(
+        cls, ckpt_dir, device, estimator_backend="torch", num_estimator_sessions=2, conds_cache_dir=None,
+        voice_bank_dir=None, share_models=True, t3_quantization=None, t3_kv_cache="dynamic",
+    ) -> 'BhaveshTTS':
+        """
+        `estimator_backend` runs the S3Gen flow decoder with "torch" (eager) or "onnxruntime" (CPU), the latter
+        exporting `s3gen_estimator.onnx` next to the checkpoints on first use (and again when `s3gen.safetensors`
+        changes), see `S3Gen.set_estimator_backend`.
+        `conds_cache_dir` keeps the conditionals of reference clips on disk as well as in memory, see `ConditionalsCache`.
+        `voice_bank_dir` opens a `VoiceBank` of enrolled voices for `use_voice`.
+        With `share_models`, the models are shared with the other front-ends loading the same checkpoints on the same
+        device (e.g. S3Gen with `BhaveshVC`) through `MODEL_REGISTRY`, and released by `close`.
+        `t3_quantization="int8"` runs the T3 decoding linears with int8 weights (CPU only), the quantized checkpoint
+        being cached next to the others on first use, see `load_t3`.
+        `t3_kv_cache="static"` decodes T3 with preallocated KV buffers kept in a `T3KVCachePool` between calls
+        (faster, at the cost of up to `T3KVCachePool.max_bytes` of idle buffers), `"fp16"` or `"int8"` with the same
+        buffers storing the states compressed, for less memory per concurrent generation, see `T3QuantizedCache`.
+        The default `"dynamic"` grows a cache per call.
+        """
         ckpt_dir = Path(ckpt_dir)
 
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -135,24 +201,12 @@ class BhaveshTTS:
         else:
             map_location = None
 
-        ve = VoiceEncoder()
-        ve.load_state_dict(
-            load_file(ckpt_dir / "ve.safetensors")
-        )
-        ve.to(device).eval()
-
-        t3 = T3()
-        t3_state = load_file(ckpt_dir / "t3_cfg.safetensors")
-        if "model" in t3_state.keys():
-            t3_state = t3_state["model"][0]
-        t3.load_state_dict(t3_state)
-        t3.to(device).eval()
-
-        s3gen = S3Gen()
-        s3gen.load_state_dict(
-            load_file(ckpt_dir / "s3gen.safetensors"), strict=False
-        )
-        s3gen.to(device).eval()
+        models, registry_keys = acquire_models(ckpt_dir, device, dict(
+            ve={},
+            t3=dict(quantization=t3_quantization),
+            s3gen=dict(estimator_backend=estimator_backend, num_estimator_sessions=num_estimator_sessions),
+        ), share_models=share_models)
+        ve, t3, s3gen = models["ve"], models["t3"], models["s3gen"]
 
         tokenizer = EnTokenizer(
             str(ckpt_dir / "tokenizer.json")
@@ -162,10 +216,22 @@ class BhaveshTTS:
         if (builtin_voice := ckpt_dir / "conds.pt").exists():
             conds = Conditionals.load(builtin_voice, map_location=map_location).to(device)
 
-        return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
+        voice_bank = VoiceBank(voice_bank_dir) if voice_bank_dir is not None else None
+        # the conditionals come from the voice encoder, and the S3Gen speech tokenizer and speaker embedding
+        conds_cache = ConditionalsCache(conds_cache_dir, weight_fpaths=[ckpt_dir / "ve.safetensors", ckpt_dir / "s3gen.safetensors"])
+        tts = cls(
+            t3, s3gen, ve, tokenizer, device, conds=conds, conds_cache=conds_cache, voice_bank=voice_bank, kv_cache=t3_kv_cache,
+        )
+        tts._release_models = weakref.finalize(tts, MODEL_REGISTRY.release_all, registry_keys)
+        return tts
 
     @classmethod
-    def from_pretrained(cls, device) -> 'BhaveshTTS':
+    def from_pretrained(cls, device, revision=None, model_dir=None, offline=None, **kwargs) -> 'BhaveshTTS':
+        """
+        Load the checkpoints of `REPO_ID` found by `resolve_model_dir`: from `model_dir` / `$BHAVESH_MODEL_DIR`,
+        else from the Hugging Face cache, without network calls; downloaded unless `offline`. `revision` pins a
+        branch, tag or commit. `kwargs` go to `from_local`.
+        """
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -174,19 +240,40 @@ class BhaveshTTS:
                 print("MPS not available because the current MacOS version is not 12.3+ and/or you do not have an MPS-enabled device on this machine.")
             device = "cpu"
 
-        for fpath in ["ve.safetensors", "t3_cfg.safetensors", "s3gen.safetensors", "tokenizer.json", "conds.pt"]:
-            local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
+        ckpt_dir = resolve_model_dir(
+            MODEL_FILES["tts"], repo_id=REPO_ID, revision=revision, model_dir=model_dir, offline=offline,
+        )
+        return cls.from_local(ckpt_dir, device, **kwargs)
 
-        return cls.from_local(Path(local_path).parent, device)
+    def use_voice(self, voice_id, exaggeration=None):
+        "Set the voice to one enrolled in `voice_bank`, keeping its exaggeration unless one is given."
+        assert self.voice_bank is not None, "no voice bank, pass `voice_bank_dir` to `from_local`"
+        self.conds = Conditionals.from_state_dict(self.voice_bank.load(voice_id)).to(self.device)
+        if exaggeration is not None:
+            self._update_exaggeration(exaggeration)
 
-    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
-        ## Load reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
+    def save_voice(self, voice_id, overwrite=False):
+        "Enroll the current voice (see `prepare_conditionals`) in `voice_bank`."
+        assert self.voice_bank is not None, "no voice bank, pass `voice_bank_dir` to `from_local`"
+        assert self.conds is not None, "Please `prepare_conditionals` first"
+        self.voice_bank.append({voice_id: self.conds.state_dict()}, overwrite=overwrite)
 
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
-
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+        "Set the voice from a reference clip. The result is looked up in / added to `conds_cache`."
+        namespace = f"tts|{INGEST_VERSION}|{self.ENC_COND_LEN}|{self.DEC_COND_LEN}|{self.conds_cache.weights_id}"
+        cache_key = ConditionalsCache.audio_key(wav_fpath, S3GEN_SR, exaggeration, namespace=namespace)
+        if (states := self.conds_cache.get(cache_key, map_location=self.device)) is not None:
+            self.conds = Conditionals.from_state_dict(states)
+            return
+
+        ## Load reference wav, once for all the sample rates below
+        ref = AudioClip.load(wav_fpath)
+        ref_16k_wav = ref.at(S3_SR)
+
+        s3gen_ref_wav = ref.at(S3GEN_SR)[:self.DEC_COND_LEN]
+        s3gen_ref_dict = self.s3gen.embed_ref(
+            s3gen_ref_wav, S3GEN_SR, device=self.device, ref_wav_16=ref_16k_wav[:self.DEC_COND_LEN * S3_SR // S3GEN_SR],
+        )
 
         # Speech cond prompt tokens
         if plen := self.t3.hp.speech_cond_prompt_len:
@@ -195,7 +282,7 @@ class BhaveshTTS:
             t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
 
         # Voice-encoder speaker embedding
-        ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR))
+        ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav.numpy()], sample_rate=S3_SR))
         ve_embed = ve_embed.mean(axis=0, keepdim=True).to(self.device)
 
         t3_cond = T3Cond(
@@ -204,6 +291,7 @@ class BhaveshTTS:
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
         self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        self.conds_cache.put(cache_key, self.conds.state_dict())
 
     def generate(
         self,
@@ -215,33 +303,30 @@ class BhaveshTTS:
         exaggeration=0.5,
         cfg_weight=0.5,
         temperature=0.8,
+        speculative: T3SpeculativeDecoder = None,
+        n_timesteps=None,
+        solver=None,
+        cfg_schedule="constant",
     ):
+        """
+        `n_timesteps` and `solver` pick the S3Gen flow ODE solver ("euler", "heun", "midpoint", "dpm++2m") or a
+        speed / quality preset ("quality", "balanced", "fast"); the default is 10 Euler steps.
+        `cfg_schedule` lowers or turns off `cfg_weight` as the speech goes on ("linear:<n>", "cutoff:<n>",
+        "alignment", see `T3CFGSchedule`); once it is off, T3 decodes without the unconditional row.
+        """
         if audio_prompt_path:
             self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
         else:
             assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
 
-        # Update exaggeration if needed
-        if exaggeration != self.conds.t3.emotion_adv[0, 0, 0]:
-            _cond: T3Cond = self.conds.t3
-            self.conds.t3 = T3Cond(
-                speaker_emb=_cond.speaker_emb,
-                cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
-                emotion_adv=exaggeration * torch.ones(1, 1, 1),
-            ).to(device=self.device)
+        self._update_exaggeration(exaggeration)
 
         # Norm and tokenize text
-        text = punc_norm(text)
-        text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
+        text_tokens = self._text_to_tokens(text)
 
         if cfg_weight > 0.0:
             text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
 
-        sot = self.t3.hp.start_text_token
-        eot = self.t3.hp.stop_text_token
-        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
-        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
-
         with torch.inference_mode():
             speech_tokens = self.t3.inference(
                 t3_cond=self.conds.t3,
@@ -249,24 +334,188 @@ class BhaveshTTS:
                 max_new_tokens=1000,  # TODO: use the value in config
                 temperature=temperature,
                 cfg_weight=cfg_weight,
+                cfg_schedule=cfg_schedule,
                 repetition_penalty=repetition_penalty,
                 min_p=min_p,
                 top_p=top_p,
+                kv_cache_pool=self.kv_cache_pool,
+                prefix_cache=self.prefix_cache,
+                speculative=speculative,
             )
             # Extract only the conditional batch.
             speech_tokens = speech_tokens[0]
+            return self._speech_tokens_to_wav(speech_tokens, n_timesteps=n_timesteps, solver=solver)
 
-            # TODO: output becomes 1D
-            speech_tokens = drop_invalid_tokens(speech_tokens)
-            
-            speech_tokens = speech_tokens[speech_tokens < 6561]
+    def generate_stream(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        chunk_size=25,
+        speculative: T3SpeculativeDecoder = None,
+        n_timesteps=None,
+        solver=None,
+        cfg_schedule="constant",
+    ):
+        """
+        Same as `generate`, but yields `(wav_chunk, metrics)` while T3 is still sampling: every `chunk_size`
+        new speech tokens (25 tokens = 1s of audio) are turned into a watermarked (1, L) waveform chunk by an
+        `S3GenStreamSession`. Smaller chunks lower the first-chunk latency (`metrics.first_chunk_latency`)
+        at the cost of more S3Gen passes; each pass costs the same however long the utterance gets.
+        """
+        start_time = time.perf_counter()
+
+        if audio_prompt_path:
+            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
+        else:
+            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
 
-            speech_tokens = speech_tokens.to(self.device)
+        self._update_exaggeration(exaggeration)
 
-            wav, _ = self.s3gen.inference(
-                speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
-            )
+        text_tokens = self._text_to_tokens(text)
+        if cfg_weight > 0.0:
+            text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
+
+        metrics = StreamingMetrics()
+
+        def emit(wav):
             wav = wav.squeeze(0).detach().cpu().numpy()
-            watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
+            wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
+            metrics.chunk_count += 1
+            metrics.audio_duration += len(wav) / self.sr
+            metrics.total_time = time.perf_counter() - start_time
+            if metrics.first_chunk_latency is None:
+                metrics.first_chunk_latency = metrics.total_time
+            return torch.from_numpy(wav).unsqueeze(0), metrics
+
+        # `inference_stream`, `push` and `flush` each run in inference mode; it must not be active at the `yield`s,
+        # where the caller's code runs.
+        token_stream = self.t3.inference_stream(
+            t3_cond=self.conds.t3,
+            text_tokens=text_tokens,
+            max_new_tokens=1000,  # TODO: use the value in config
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            cfg_schedule=cfg_schedule,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+            kv_cache_pool=self.kv_cache_pool,
+            prefix_cache=self.prefix_cache,
+            speculative=speculative,
+        )
+        session = self.s3gen.stream_session(
+            self.conds.gen, chunk_size=chunk_size, n_timesteps=n_timesteps, solver=solver,
+        )
+        for new_tokens in token_stream:
+            new_tokens = new_tokens[0]
+            wav = session.push(new_tokens[new_tokens < 6561])
+            if wav.size(1) > 0:
+                yield emit(wav)
+
+        wav = session.flush()
+        if wav.size(1) > 0:
+            yield emit(wav)
+
+    def generate_batch(
+        self,
+        texts,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        n_timesteps=None,
+        solver=None,
+    ):
+        """
+        Same as `generate` for a list of texts in the current voice. T3 decodes all texts together with
+        continuous batching (see `T3BatchEngine`), so throughput grows with the number of texts.
+        Returns a list of waveforms.
+        """
+        if audio_prompt_path:
+            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
+        else:
+            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+
+        self._update_exaggeration(exaggeration)
+
+        requests = [
+            T3GenerationRequest(
+                t3_cond=self.conds.t3,
+                text_tokens=self._text_to_tokens(text),
+                max_new_tokens=1000,  # TODO: use the value in config
+                temperature=temperature,
+                min_p=min_p,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                cfg_weight=cfg_weight,
+            )
+            for text in texts
+        ]
+        with torch.inference_mode():
+            all_speech_tokens = self.t3_engine.generate(requests)
+            return [
+                self._speech_tokens_to_wav(speech_tokens[0], n_timesteps=n_timesteps, solver=solver)
+                for speech_tokens in all_speech_tokens
+            ]
+
+    @property
+    def t3_engine(self) -> T3BatchEngine:
+        """
+        Continuous-batching T3 decoder, created on first use with its background worker, so that the texts of
+        concurrent `generate_batch` calls share its batch. The worker stops on `close` or garbage collection.
+        """
+        with self._t3_engine_lock:
+            if self._t3_engine is None:
+                engine = T3BatchEngine(self.t3, prefix_cache=self.prefix_cache)
+                engine.start()
+                weakref.finalize(self, engine.stop)
+                self._t3_engine = engine
+        return self._t3_engine
+
+    def _update_exaggeration(self, exaggeration):
+        if exaggeration != self.conds.t3.emotion_adv[0, 0, 0]:
+            _cond: T3Cond = self.conds.t3
+            self.conds.t3 = T3Cond(
+                speaker_emb=_cond.speaker_emb,
+                cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
+                emotion_adv=exaggeration * torch.ones(1, 1, 1),
+            ).to(device=self.device)
+
+    def _text_to_tokens(self, text):
+        "Normalize and tokenize text, adding start / stop text tokens. Returns a (1, T) tensor."
+        text = punc_norm(text)
+        text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
+
+        sot = self.t3.hp.start_text_token
+        eot = self.t3.hp.stop_text_token
+        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
+        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return text_tokens
+
+    def _speech_tokens_to_wav(self, speech_tokens, n_timesteps=None, solver=None):
+        "1D T3 output -> watermarked (1, L) waveform."
+        # TODO: output becomes 1D
+        speech_tokens = drop_invalid_tokens(speech_tokens)
+
+        speech_tokens = speech_tokens[speech_tokens < 6561]
+
+        speech_tokens = speech_tokens.to(self.device)
+
+        wav, _ = self.s3gen.inference(
+            speech_tokens=speech_tokens,
+            ref_dict=self.conds.gen,
+            n_timesteps=n_timesteps,
+            solver=solver,
+        )
+        wav = wav.squeeze(0).detach().cpu().numpy()
+        watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
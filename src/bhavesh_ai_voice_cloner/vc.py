@@ -1,16 +1,15 @@
+import weakref
 from pathlib import Path
 
-import librosa
 import torch
-import perth
-from huggingface_hub import hf_hub_download
-from safetensors.torch import load_file
 
 from .models.s3tokenizer import S3_SR
 from .models.s3gen import S3GEN_SR, S3Gen
-
-
-REPO_ID = "ResembleAI/chatterbox"
+from .audio_ingest import INGEST_VERSION, AudioClip
+from .conditionals_cache import ConditionalsCache
+from .voice_bank import VoiceBank
+from .model_hub import MODEL_FILES, REPO_ID, resolve_model_dir
+from .model_registry import MODEL_REGISTRY, acquire_models
 
 
 class BhaveshVC:
@@ -22,11 +21,19 @@ class BhaveshVC:
         s3gen: S3Gen,
         device: str,
         ref_dict: dict=None,
+        conds_cache: ConditionalsCache = None,
+        voice_bank: VoiceBank = None,
     ):
+        import perth  # deferred, takes seconds to import
+
         self.sr = S3GEN_SR
         self.s3gen = s3gen
         self.device = device
         self.watermarker = perth.PerthImplicitWatermarker()
+        # S3Gen reference embeddings of the target voices seen before
+        self.conds_cache = conds_cache if conds_cache is not None else ConditionalsCache()
+        # enrolled voices, see `use_voice`
+        self.voice_bank = voice_bank
         if ref_dict is None:
             self.ref_dict = None
         else:
@@ -34,9 +41,27 @@ class BhaveshVC:
                 k: v.to(device) if torch.is_tensor(v) else v
                 for k, v in ref_dict.items()
             }
+        self._release_models = None
+
+    def close(self):
+        "Release the S3Gen acquired from `MODEL_REGISTRY` by `from_local`; it is also released on garbage collection."
+        if self._release_models is not None:
+            self._release_models()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'BhaveshVC':
+    def from_local(
+        cls, ckpt_dir, device, estimator_backend="torch", num_estimator_sessions=2, conds_cache_dir=None,
+        voice_bank_dir=None, share_models=True,
+    ) -> 'BhaveshVC':
+        """
+        `estimator_backend` runs the S3Gen flow decoder with "torch" (eager) or "onnxruntime" (CPU), the latter
+        exporting `s3gen_estimator.onnx` next to the checkpoints on first use (and again when `s3gen.safetensors`
+        changes), see `S3Gen.set_estimator_backend`.
+        `conds_cache_dir` keeps the embeddings of target voices on disk as well as in memory, see `ConditionalsCache`.
+        `voice_bank_dir` opens a `VoiceBank` of enrolled voices for `use_voice`.
+        With `share_models`, S3Gen is shared with the other front-ends loading the same checkpoint on the same device
+        (e.g. `BhaveshTTS`) through `MODEL_REGISTRY`, and released by `close`.
+        """
         ckpt_dir = Path(ckpt_dir)
         
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -50,16 +75,23 @@ class BhaveshVC:
             states = torch.load(builtin_voice, map_location=map_location)
             ref_dict = states['gen']
 
-        s3gen = S3Gen()
-        s3gen.load_state_dict(
-            load_file(ckpt_dir / "s3gen.safetensors"), strict=False
-        )
-        s3gen.to(device).eval()
+        models, registry_keys = acquire_models(ckpt_dir, device, dict(
+            s3gen=dict(estimator_backend=estimator_backend, num_estimator_sessions=num_estimator_sessions),
+        ), share_models=share_models)
 
-        return cls(s3gen, device, ref_dict=ref_dict)
+        voice_bank = VoiceBank(voice_bank_dir) if voice_bank_dir is not None else None
+        conds_cache = ConditionalsCache(conds_cache_dir, weight_fpaths=[ckpt_dir / "s3gen.safetensors"])
+        vc = cls(models["s3gen"], device, ref_dict=ref_dict, conds_cache=conds_cache, voice_bank=voice_bank)
+        vc._release_models = weakref.finalize(vc, MODEL_REGISTRY.release_all, registry_keys)
+        return vc
 
     @classmethod
-    def from_pretrained(cls, device) -> 'BhaveshVC':
+    def from_pretrained(cls, device, revision=None, model_dir=None, offline=None, **kwargs) -> 'BhaveshVC':
+        """
+        Load the checkpoints of `REPO_ID` found by `resolve_model_dir`: from `model_dir` / `$BHAVESH_MODEL_DIR`,
+        else from the Hugging Face cache, without network calls; downloaded unless `offline`. `revision` pins a
+        branch, tag or commit. `kwargs` go to `from_local`.
+        """
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -68,36 +100,58 @@ class BhaveshVC:
                 print("MPS not available because the current MacOS version is not 12.3+ and/or you do not have an MPS-enabled device on this machine.")
             device = "cpu"
             
-        for fpath in ["s3gen.safetensors", "conds.pt"]:
-            local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
+        ckpt_dir = resolve_model_dir(
+            MODEL_FILES["vc"], repo_id=REPO_ID, revision=revision, model_dir=model_dir, offline=offline,
+        )
+        return cls.from_local(ckpt_dir, device, **kwargs)
 
-        return cls.from_local(Path(local_path).parent, device)
+    def use_voice(self, voice_id):
+        "Set the target voice to one enrolled in `voice_bank` (its S3Gen part)."
+        assert self.voice_bank is not None, "no voice bank, pass `voice_bank_dir` to `from_local`"
+        gen = self.voice_bank.load(voice_id)["gen"]
+        self.ref_dict = {k: v.to(self.device) if torch.is_tensor(v) else v for k, v in gen.items()}
 
     def set_target_voice(self, wav_fpath):
-        ## Load reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
+        "Set the target voice from a reference clip. The result is looked up in / added to `conds_cache`."
+        cache_key = ConditionalsCache.audio_key(
+            wav_fpath, S3GEN_SR, namespace=f"vc|{INGEST_VERSION}|{self.DEC_COND_LEN}|{self.conds_cache.weights_id}",
+        )
+        if (states := self.conds_cache.get(cache_key, map_location=self.device)) is not None:
+            self.ref_dict = dict(states["gen"])
+            return
 
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        self.ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        ## Load reference wav
+        ref = AudioClip.load(wav_fpath)
+        s3gen_ref_wav = ref.at(S3GEN_SR)[:self.DEC_COND_LEN]
+        self.ref_dict = self.s3gen.embed_ref(
+            s3gen_ref_wav, S3GEN_SR, device=self.device, ref_wav_16=ref.at(S3_SR)[:self.DEC_COND_LEN * S3_SR // S3GEN_SR],
+        )
+        self.conds_cache.put(cache_key, dict(gen=dict(self.ref_dict)))
 
     def generate(
         self,
         audio,
         target_voice_path=None,
+        n_timesteps=None,
+        solver=None,
     ):
+        """
+        `n_timesteps` and `solver` pick the S3Gen flow ODE solver or a preset ("quality", "balanced", "fast").
+        """
         if target_voice_path:
             self.set_target_voice(target_voice_path)
         else:
             assert self.ref_dict is not None, "Please `prepare_conditionals` first or specify `target_voice_path`"
 
         with torch.inference_mode():
-            audio_16, _ = librosa.load(audio, sr=S3_SR)
-            audio_16 = torch.from_numpy(audio_16).float().to(self.device)[None, ]
+            audio_16 = AudioClip.load(audio).at(S3_SR).to(self.device)[None, ]
 
             s3_tokens, _ = self.s3gen.tokenizer(audio_16)
             wav, _ = self.s3gen.inference(
                 speech_tokens=s3_tokens,
                 ref_dict=self.ref_dict,
+                n_timesteps=n_timesteps,
+                solver=solver,
             )
             wav = wav.squeeze(0).detach().cpu().numpy()
             watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import torch
+from safetensors.torch import save_file
+
+from .models.utils import MappedSafetensors
+
+
+INDEX_FILENAME = "index.json"
+VOICE_BANK_VERSION = 1
+
+
+class VoiceBank:
+    """
+    Many enrolled voices in a directory of safetensors shards plus an `index.json` mapping each voice ID to
+    its shard. A voice is the state dict of its conditionals (`Conditionals.state_dict()`: the `T3Cond` fields
+    under "t3" and the S3Gen `ref_dict` under "gen"; BhaveshVC only uses "gen"), stored as `<voice_id>/<group>/<name>`.
+
+    Shards are memory-mapped on first use and `load` returns views of the mapping, so loading a voice reads
+    only its own pages and copies nothing (until the tensors are moved to another device). `append` writes
+    new voices in bulk as new shards. Readers and one writer can share a bank in a process; thread-safe.
+    """
+
+    def __init__(self, root, max_shard_bytes=256 << 20):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_shard_bytes = max_shard_bytes
+        self._lock = threading.Lock()
+        self._shards: Dict[str, MappedSafetensors] = {}
+        index_path = self.root / INDEX_FILENAME
+        if index_path.exists():
+            self._index = json.loads(index_path.read_text())
+            assert self._index.get("version") == VOICE_BANK_VERSION, f"unsupported voice bank version in {index_path}"
+        else:
+            self._index = dict(version=VOICE_BANK_VERSION, shards=[], voices={})
+
+    def __len__(self):
+        return len(self._index["voices"])
+
+    def __contains__(self, voice_id):
+        return voice_id in self._index["voices"]
+
+    def ids(self):
+        return list(self._index["voices"])
+
+    @staticmethod
+    def _flatten(voice_id, states: dict) -> Tuple[Dict[str, torch.Tensor], List[str]]:
+        "Tensors by key, and the keys of the None values (e.g. `prompt_feat_len`), which are restored by `load`."
+        tensors, nones = {}, []
+        for group, values in states.items():
+            for name, value in values.items():
+                if value is None:
+                    nones.append(f"{voice_id}/{group}/{name}")
+                    continue
+                if isinstance(value, (int, float)):
+                    value = torch.full((1, 1, 1), float(value))  # e.g. a plain `T3Cond.emotion_adv`
+                if not torch.is_tensor(value):
+                    raise TypeError(f"voice {voice_id!r}: {group}/{name} is a {type(value).__name__}, not a tensor")
+                tensors[f"{voice_id}/{group}/{name}"] = value.detach().cpu().contiguous()
+        return tensors, nones
+
+    def append(self, voices: Dict[str, dict], overwrite=False):
+        "Add voices given as {voice_id: state dict}, packed into as few new shards as `max_shard_bytes` allows."
+        for voice_id in voices:
+            assert "/" not in voice_id, f"voice IDs cannot contain '/': {voice_id!r}"
+            if voice_id in self and not overwrite:
+                raise ValueError(f"voice {voice_id!r} is already in the bank (use overwrite=True to replace it)")
+
+        with self._lock:
+            shards, shard, shard_bytes = [], {}, 0
+            for voice_id, states in voices.items():
+                tensors, nones = self._flatten(voice_id, states)
+                nbytes = sum(t.numel() * t.element_size() for t in tensors.values())
+                if shard and shard_bytes + nbytes > self.max_shard_bytes:
+                    shards.append(shard)
+                    shard, shard_bytes = {}, 0
+                shard[voice_id] = (tensors, nones)
+                shard_bytes += nbytes
+            if shard:
+                shards.append(shard)
+
+            for shard in shards:
+                name = f"shard-{len(self._index['shards']):05d}.safetensors"
+                tensors, storages = {}, set()
+                for voice_tensors, _ in shard.values():
+                    for key, tensor in voice_tensors.items():
+                        # safetensors refuses shared storage, e.g. a default `emotion_adv` common to many voices
+                        ptr = tensor.untyped_storage().data_ptr()
+                        tensors[key] = tensor.clone() if ptr in storages else tensor
+                        storages.add(ptr)
+                tmp_path = self.root / f"{name}.tmp"
+                save_file(tensors, str(tmp_path), metadata={"voices": json.dumps(list(shard))})
+                os.replace(tmp_path, self.root / name)
+                self._index["shards"].append(name)
+                for voice_id, (voice_tensors, nones) in shard.items():
+                    self._index["voices"][voice_id] = dict(shard=name, keys=list(voice_tensors), none_keys=nones)
+            self._write_index()
+
+    def _write_index(self):
+        tmp_path = self.root / f"{INDEX_FILENAME}.tmp"
+        tmp_path.write_text(json.dumps(self._index))
+        os.replace(tmp_path, self.root / INDEX_FILENAME)
+
+    def _shard(self, name) -> MappedSafetensors:
+        shard = self._shards.get(name)
+        if shard is None:
+            with self._lock:
+                shard = self._shards.get(name)
+                if shard is None:
+                    shard = self._shards[name] = MappedSafetensors(self.root / name)
+        return shard
+
+    def load(self, voice_id, device=None) -> dict:
+        "The state dict of a voice, e.g. for `Conditionals.from_state_dict`. Zero-copy unless `device` needs a copy."
+        entry = self._index["voices"].get(voice_id)
+        if entry is None:
+            raise KeyError(f"voice {voice_id!r} is not in the voice bank at {self.root}")
+        shard = self._shard(entry["shard"])
+        states = {}
+        for key in entry["keys"]:
+            _, group, name = key.split("/")
+            tensor = shard.get_tensor(key)
+            states.setdefault(group, {})[name] = tensor.to(device) if device is not None else tensor
+        for key in entry["none_keys"]:
+            _, group, name = key.split("/")
+            states.setdefault(group, {})[name] = None
+        return states
+
+    def reload(self):
+        "Pick up voices appended by another process."
+        index = json.loads((self.root / INDEX_FILENAME).read_text())
+        with self._lock:
+            self._index = index
+
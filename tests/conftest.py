@@ -0,0 +1,46 @@
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+# run against the source tree without installing the package
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+
+@pytest.fixture(scope="session")
+def tiny_t3():
+    "A randomly initialized T3 with 4 small Llama layers (the hidden size stays 1024, which the Perceiver hard-codes)."
+    from bhavesh_ai_voice_cloner.models.t3 import T3
+    from bhavesh_ai_voice_cloner.models.t3.llama_configs import LLAMA_520M_CONFIG_DICT, LLAMA_CONFIGS
+    from bhavesh_ai_voice_cloner.models.t3.modules.t3_config import T3Config
+
+    LLAMA_CONFIGS["Llama_test"] = dict(LLAMA_520M_CONFIG_DICT, num_hidden_layers=4, intermediate_size=256)
+
+    class TestT3Config(T3Config):
+        llama_config_name = "Llama_test"
+
+    torch.manual_seed(0)
+    return T3(TestT3Config()).eval()
+
+
+@pytest.fixture(scope="session")
+def t3_inputs(tiny_t3):
+    "`t3_inputs(text_len, seed)`: random (batch 1) conditioning and text tokens with start / stop tokens for `tiny_t3`."
+    from bhavesh_ai_voice_cloner.models.t3.modules.cond_enc import T3Cond
+
+    hp = tiny_t3.hp
+
+    def make(text_len=12, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        t3_cond = T3Cond(
+            speaker_emb=torch.randn(1, hp.speaker_embed_size, generator=generator),
+            cond_prompt_speech_tokens=torch.randint(0, 6561, (1, hp.speech_cond_prompt_len), generator=generator),
+            emotion_adv=0.5 * torch.ones(1, 1, 1),
+        )
+        text_tokens = torch.randint(1, hp.text_tokens_dict_size - 1, (1, text_len), generator=generator)
+        text_tokens[:, 0] = hp.start_text_token
+        text_tokens[:, -1] = hp.stop_text_token
+        return t3_cond, text_tokens
+
+    return make
@@ -0,0 +1,52 @@
+"""
+`ModelRegistry`: one model per key, shared while referenced.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+from bhavesh_ai_voice_cloner.model_registry import ModelRegistry
+
+
+def test_acquire_and_release(tmp_path):
+    registry = ModelRegistry()
+    key = ModelRegistry.key("s3gen", tmp_path / "s3gen.safetensors", "cpu", estimator_backend="torch")
+    assert key != ModelRegistry.key("s3gen", tmp_path / "s3gen.safetensors", "cpu", estimator_backend="onnx")
+    n_loads, started = [], threading.Event()
+
+    def loader():
+        n_loads.append(1)
+        started.wait(1)  # the other threads wait for this load instead of loading their own model
+        return torch.nn.Linear(2, 2)
+
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(registry.acquire, key, loader) for _ in range(4)]
+        started.set()
+        models = [future.result() for future in futures]
+    assert len(n_loads) == 1 and all(model is models[0] for model in models)
+    assert registry.refs(key) == 4 and len(registry) == 1
+
+    registry.release_all([key] * 3)
+    assert key in registry and registry.refs(key) == 1
+    assert registry.acquire(key, loader) is models[0]
+    registry.release_all([key, key])
+    assert key not in registry and len(registry) == 0
+    registry.release(key)  # released twice: ignored
+
+    # the next user loads a new model
+    assert registry.acquire(key, loader) is not models[0]
+    assert len(n_loads) == 2
+
+
+def test_failed_load_releases(tmp_path):
+    registry = ModelRegistry()
+    key = ModelRegistry.key("t3", tmp_path / "t3_cfg.safetensors", "cpu")
+
+    def loader():
+        raise OSError("missing checkpoint")
+
+    with pytest.raises(OSError):
+        registry.acquire(key, loader)
+    assert key not in registry and registry.refs(key) == 0
@@ -0,0 +1,87 @@
+"""
+`SpectralFrontend` against the per-clip implementations of each feature, on a batch of clips of different lengths.
+"""
+import numpy as np
+import pytest
+import torch
+import torchaudio.compliance.kaldi as Kaldi
+
+from bhavesh_ai_voice_cloner.models.s3gen.utils.mel import mel_spectrogram
+from bhavesh_ai_voice_cloner.models.s3tokenizer import S3_SR, S3Tokenizer
+from bhavesh_ai_voice_cloner.models.s3gen import S3GEN_SR
+from bhavesh_ai_voice_cloner.models.spectral import get_spectral_frontend
+from bhavesh_ai_voice_cloner.models.voice_encoder import VoiceEncConfig
+from bhavesh_ai_voice_cloner.models.voice_encoder.melspec import melspectrogram
+
+
+# seconds; different enough that every clip but the longest is padded in the batch
+CLIP_SECONDS = [0.25, 1.0, 1.37, 2.5]
+# largest difference over the valid frames, relative to the range of the reference features
+RTOL = 1e-4
+
+
+def make_clips(sr, seed=0):
+    "Harmonic tones in noise."
+    rng = np.random.RandomState(seed)
+    clips = []
+    for seconds in CLIP_SECONDS:
+        t = np.arange(int(seconds * sr)) / sr
+        f0 = rng.uniform(90, 300)
+        wav = sum(0.2 / k * np.sin(2 * np.pi * k * f0 * t) for k in range(1, 6)) + 0.02 * rng.randn(t.size)
+        clips.append(torch.from_numpy(wav.astype(np.float32)))
+    return clips
+
+
+def assert_matches(reference, batch, lens, time_dim):
+    assert batch.size(0) == len(reference)
+    for i, ref in enumerate(reference):
+        ref = torch.as_tensor(ref).float()
+        got = batch[i].narrow(time_dim, 0, int(lens[i]))
+        assert got.shape == ref.shape, f"clip {i}: {tuple(got.shape)} vs {tuple(ref.shape)}"
+        value_range = (ref.max() - ref.min()).item()
+        assert (got - ref).abs().max().item() <= RTOL * value_range, f"clip {i} differs"
+
+
+@pytest.fixture(scope="module")
+def frontend():
+    return get_spectral_frontend("cpu")
+
+
+@pytest.fixture(scope="module")
+def clips_16k():
+    return make_clips(S3_SR)
+
+
+def test_s3_log_mel(frontend, clips_16k):
+    tokenizer = S3Tokenizer()
+    batch, lens = frontend.s3_log_mel(clips_16k)
+    assert_matches([tokenizer.log_mel_spectrogram(clip) for clip in clips_16k], batch, lens, time_dim=1)
+    # padding frames are zeroed
+    assert (batch[0, :, lens[0]:] == 0).all()
+
+
+def test_s3gen_mel(frontend):
+    clips = make_clips(S3GEN_SR)
+    batch, lens = frontend.s3gen_mel(clips)
+    assert_matches([mel_spectrogram(clip)[0] for clip in clips], batch, lens, time_dim=1)
+
+
+def test_kaldi_fbank(frontend, clips_16k):
+    batch, lens = frontend.kaldi_fbank(clips_16k)
+    reference = [Kaldi.fbank(clip.unsqueeze(0), num_mel_bins=80, dither=0.0) for clip in clips_16k]
+    assert_matches(reference, batch, lens, time_dim=0)
+
+
+def test_ve_mel(frontend, clips_16k):
+    batch, lens = frontend.ve_mel(clips_16k)
+    reference = [melspectrogram(clip.numpy(), VoiceEncConfig()) for clip in clips_16k]
+    assert_matches(reference, batch, lens, time_dim=1)
+
+
+def test_shared_power_spectrogram(frontend, clips_16k):
+    spec = frontend.power_spectrogram(clips_16k)
+    for feature in (frontend.s3_log_mel, frontend.ve_mel):
+        shared, shared_lens = feature(spec=spec)
+        separate, separate_lens = feature(clips_16k)
+        assert torch.equal(shared_lens, separate_lens)
+        assert torch.equal(shared, separate)
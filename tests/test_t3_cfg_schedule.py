@@ -0,0 +1,31 @@
+"""
+`T3CFGSchedule`: the CFG weight of each sampled token.
+"""
+import pytest
+
+from bhavesh_ai_voice_cloner.models.t3.inference import T3CFGSchedule
+
+
+def weights(schedule, n=6, cfg_weight=0.5, **kwargs):
+    return [T3CFGSchedule.parse(schedule).weight(cfg_weight, step, **kwargs) for step in range(n)]
+
+
+def test_schedules():
+    assert weights("constant") == [0.5] * 6
+    assert weights(None) == [0.5] * 6
+    assert weights("cutoff:2") == [0.5, 0.5, 0, 0, 0, 0]
+    assert weights("cutoff:0") == [0] * 6
+    assert weights("linear:4") == pytest.approx([0.5, 0.375, 0.25, 0.125, 0, 0])
+    assert weights("alignment") == [0.5] * 6
+    assert weights("alignment", text_complete=True) == [0] * 6
+
+
+def test_parse():
+    assert T3CFGSchedule.parse("cutoff:50") == T3CFGSchedule("cutoff", 50)
+    schedule = T3CFGSchedule("linear", 10)
+    assert T3CFGSchedule.parse(schedule) is schedule
+    assert T3CFGSchedule.parse("alignment").needs_alignment
+    with pytest.raises(AssertionError):
+        T3CFGSchedule.parse("cutoff")
+    with pytest.raises(AssertionError):
+        T3CFGSchedule.parse("sometimes")
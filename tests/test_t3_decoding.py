@@ -0,0 +1,110 @@
+"""
+The T3 decoding paths against regular decoding of one request with a `DynamicCache`, on a tiny random T3.
+Greedy sampling (min_p=1 keeps the top token only), so every path has to produce the same tokens.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+from bhavesh_ai_voice_cloner.models.t3.inference import T3BatchEngine, T3GenerationRequest, T3KVCachePool, T3SpeculativeDecoder
+
+
+MAX_NEW_TOKENS = 24
+GREEDY = dict(min_p=1.0, repetition_penalty=1.0)
+
+
+def greedy_tokens(t3, t3_cond, text_tokens, cfg_weight=0.5, max_new_tokens=MAX_NEW_TOKENS, **kwargs):
+    "(T,) speech tokens of `T3.inference` on one request."
+    if cfg_weight > 0:
+        text_tokens = torch.cat([text_tokens, text_tokens])
+    return t3.inference(
+        t3_cond=t3_cond, text_tokens=text_tokens, max_new_tokens=max_new_tokens, cfg_weight=cfg_weight, **GREEDY, **kwargs,
+    )[0]
+
+
+def test_batch_engine_matches_single_requests(tiny_t3, t3_inputs):
+    # different text lengths (left padding), with and without CFG in the same batch, and room for two sequences
+    # only, so that the last request joins the running batch when the second one is retired
+    requests = [(t3_inputs(12, seed=0), 0.5), (t3_inputs(7, seed=1), 0.0), (t3_inputs(15, seed=2), 0.5)]
+    expected = [greedy_tokens(tiny_t3, *inputs, cfg_weight=cfg_weight) for inputs, cfg_weight in requests]
+
+    engine = T3BatchEngine(tiny_t3, max_batch_size=2)
+    outputs = engine.generate([
+        T3GenerationRequest(
+            t3_cond=t3_cond, text_tokens=text_tokens, max_new_tokens=MAX_NEW_TOKENS - i, cfg_weight=cfg_weight, **GREEDY,
+        )
+        for i, ((t3_cond, text_tokens), cfg_weight) in enumerate(requests)
+    ])
+    for i, (tokens, reference) in enumerate(zip(outputs, expected)):
+        assert torch.equal(tokens[0], reference[:MAX_NEW_TOKENS - i]), f"request {i}"
+    assert engine.num_active == 0
+
+
+def test_batch_engine_worker_serves_concurrent_threads(tiny_t3, t3_inputs):
+    requests = [t3_inputs(10, seed=seed) for seed in range(3)]
+    expected = [greedy_tokens(tiny_t3, *inputs) for inputs in requests]
+
+    engine = T3BatchEngine(tiny_t3)
+    engine.start()
+    try:
+        with ThreadPoolExecutor(len(requests)) as pool:
+            outputs = list(pool.map(
+                lambda inputs: engine.generate([T3GenerationRequest(*inputs, max_new_tokens=MAX_NEW_TOKENS, **GREEDY)])[0],
+                requests,
+            ))
+    finally:
+        engine.stop()
+    for i, (tokens, reference) in enumerate(zip(outputs, expected)):
+        assert torch.equal(tokens[0], reference), f"request {i}"
+
+
+@pytest.mark.parametrize("kv_cache", ["static", "fp16", "int8"])
+def test_kv_caches_match_dynamic(tiny_t3, t3_inputs, kv_cache):
+    t3_cond, text_tokens = t3_inputs()
+    reference = greedy_tokens(tiny_t3, t3_cond, text_tokens)
+    assert torch.equal(greedy_tokens(tiny_t3, t3_cond, text_tokens, kv_cache=kv_cache), reference)
+    # the same buffers again, from the pool
+    pool = T3KVCachePool(tiny_t3.cfg, kv_cache=kv_cache)
+    for _ in range(2):
+        assert torch.equal(greedy_tokens(tiny_t3, t3_cond, text_tokens, kv_cache_pool=pool), reference)
+        assert len(pool._free) == 1
+
+
+# the tiny T3 only starts repeating itself (which the n-gram draft needs) after about 30 tokens
+@pytest.mark.parametrize("draft, cfg_weight, max_new_tokens", [("layers", 0.0, 24), ("layers", 0.5, 24), ("ngram", 0.0, 64)])
+def test_speculative_matches_greedy(tiny_t3, t3_inputs, draft, cfg_weight, max_new_tokens):
+    t3_cond, text_tokens = t3_inputs()
+    reference = greedy_tokens(tiny_t3, t3_cond, text_tokens, cfg_weight=cfg_weight, max_new_tokens=max_new_tokens)
+    speculative = T3SpeculativeDecoder(tiny_t3, draft=draft, num_draft_tokens=3, draft_layers=2, ngram_size=2)
+    session = tiny_t3.decode_engine.session(
+        t3_cond=t3_cond, text_tokens=torch.cat([text_tokens] * (2 if cfg_weight > 0 else 1)), max_new_tokens=max_new_tokens,
+        cfg_weight=cfg_weight, speculative=speculative, **GREEDY,
+    )
+    assert torch.equal(torch.cat(list(session), dim=1)[0], reference)
+    assert session.speculative_stats.num_accepted > 0
+
+
+@pytest.mark.parametrize("schedule", ["cutoff:8", "linear:8"])
+def test_cfg_schedule_drops_the_uncond_row(tiny_t3, t3_inputs, schedule):
+    t3_cond, text_tokens = t3_inputs()
+    constant = greedy_tokens(tiny_t3, t3_cond, text_tokens)
+    pool = T3KVCachePool(tiny_t3.cfg)
+    outputs = {}
+    for kv_cache in ["dynamic", "static", "int8"]:
+        session = tiny_t3.decode_engine.session(
+            t3_cond=t3_cond, text_tokens=torch.cat([text_tokens, text_tokens]), max_new_tokens=MAX_NEW_TOKENS, cfg_weight=0.5,
+            cfg_schedule=schedule, kv_cache=kv_cache, **GREEDY,
+        )
+        outputs[kv_cache] = torch.cat(list(session), dim=1)[0]
+        assert session.uncond_dropped_at == 8
+    # the cutoff schedule is constant CFG up to the drop (the linear one already lowers the weight before)
+    if schedule.startswith("cutoff"):
+        assert torch.equal(outputs["dynamic"][:8], constant[:8])
+    for kv_cache in ["static", "int8"]:
+        assert torch.equal(outputs[kv_cache], outputs["dynamic"]), kv_cache
+
+    # a pooled cache goes back to the pool with both rows, and serves the next request
+    for _ in range(2):
+        assert torch.equal(greedy_tokens(tiny_t3, t3_cond, text_tokens, cfg_schedule=schedule, kv_cache_pool=pool), outputs["dynamic"])
+        assert len(pool._free) == 1 and pool._free[0][1].batch_size == 2
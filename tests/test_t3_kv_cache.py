@@ -0,0 +1,96 @@
+"""
+`T3StaticCache` / `T3QuantizedCache` buffers and the `T3KVCachePool` that recycles them.
+"""
+import pytest
+import torch
+from transformers import LlamaConfig
+
+from bhavesh_ai_voice_cloner.models.t3.inference import T3KVCachePool
+from bhavesh_ai_voice_cloner.models.t3.inference.kv_cache import new_static_cache
+
+
+@pytest.fixture(scope="module")
+def config():
+    return LlamaConfig(hidden_size=64, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=4, head_dim=16)
+
+
+def test_pool_reuses_released_caches(config):
+    pool = T3KVCachePool(config, bucket_size=64)
+    cache = pool.acquire(2, 100)
+    assert cache.max_cache_len == 128
+    cache.update(torch.randn(2, 4, 10, 16), torch.randn(2, 4, 10, 16), 0)
+    pool.release(cache)
+    assert pool.nbytes == cache.nbytes
+
+    # same batch size and bucket: the released cache, emptied
+    again = pool.acquire(2, 120)
+    assert again is cache and again.get_seq_length() == 0
+    assert pool.nbytes == 0
+    # another bucket or batch size: a new one
+    assert pool.acquire(2, 200) is not cache
+    assert pool.acquire(1, 100) is not cache
+
+
+def test_pool_evicts_least_recently_released(config):
+    cache_nbytes = new_static_cache(config, 1, 64).nbytes
+    pool = T3KVCachePool(config, bucket_size=64, max_bytes=2 * cache_nbytes)
+    caches = [pool.acquire(1, 64) for _ in range(3)]
+    for cache in caches:
+        pool.release(cache)
+    assert pool.nbytes == 2 * cache_nbytes
+    assert {id(pool.acquire(1, 64)) for _ in range(2)} == {id(caches[1]), id(caches[2])}
+    # larger than the whole budget: not kept
+    pool.release(new_static_cache(config, 4, 64))
+    assert pool.nbytes == 0
+
+
+@pytest.mark.parametrize("kv_cache", ["static", "fp16", "int8"])
+def test_cache_returns_stored_states(config, kv_cache):
+    cache = new_static_cache(config, 2, 64, kv_cache=kv_cache)
+    keys, values = torch.randn(2, 4, 10, 16), torch.randn(2, 4, 10, 16)
+    for layer_idx in range(config.num_hidden_layers):
+        cache.update(keys[:, :, :6], values[:, :, :6], layer_idx)
+    for layer_idx in range(config.num_hidden_layers):
+        cached_keys, cached_values = cache.update(keys[:, :, 6:], values[:, :, 6:], layer_idx)
+        for cached, states in ((cached_keys, keys), (cached_values, values)):
+            if kv_cache == "int8":
+                # rounded to the nearest of 255 levels of the absmax of each token and head
+                atol = states.abs().amax(dim=-1, keepdim=True) / 254 * 1.0001
+                assert ((cached - states).abs() <= atol).all()
+            else:
+                torch.testing.assert_close(cached, states, **(dict(rtol=1e-3, atol=1e-3) if kv_cache == "fp16" else {}))
+    assert cache.get_seq_length() == 10
+
+
+def test_quantized_cache_memory(config):
+    static, fp16, int8 = (new_static_cache(config, 2, 256, kv_cache=kv_cache).nbytes for kv_cache in ("static", "fp16", "int8"))
+    assert fp16 * 2 == static
+    # 1 byte per value and a 4-byte scale per head_dim (16) values, against 4 bytes per value
+    assert int8 * 4 * 16 == static * (16 + 4)
+
+
+@pytest.mark.parametrize("kv_cache", ["static", "int8"])
+@pytest.mark.parametrize("keep", [[0], [1]])
+def test_batch_select_indices_then_reset(config, kv_cache, keep):
+    cache = new_static_cache(config, 2, 64, kv_cache=kv_cache)
+    buffers = [t.data_ptr() for t in cache.key_cache + cache.value_cache]
+    states = torch.randn(2, 4, 6, 16)
+    for layer_idx in range(config.num_hidden_layers):
+        cache.update(states, states, layer_idx)
+    expected = [cache[layer_idx][0][keep].clone() for layer_idx in range(config.num_hidden_layers)]
+
+    cache.batch_select_indices(torch.tensor(keep))
+    assert cache.batch_size == 1
+    for layer_idx in range(config.num_hidden_layers):
+        assert torch.equal(cache[layer_idx][0], expected[layer_idx])
+    # decoding goes on in the same memory
+    new_states = torch.randn(1, 4, 1, 16)
+    for layer_idx in range(config.num_hidden_layers):
+        keys, _ = cache.update(new_states, new_states, layer_idx)
+        assert keys.shape == (1, 4, 7, 16)
+    assert [t.data_ptr() for t in cache.key_cache + cache.value_cache] == buffers
+
+    cache.reset()
+    assert cache.batch_size == 2 and cache.get_seq_length() == 0
+    assert all(t.size(0) == 2 for t in cache.key_cache + cache.value_cache)
+    assert [t.data_ptr() for t in cache.key_cache + cache.value_cache] == buffers
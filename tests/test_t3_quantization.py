@@ -0,0 +1,37 @@
+"""
+`is_valid_quantized_checkpoint`: a cached quantized T3 is reused until its source checkpoint or format changes.
+"""
+import os
+
+import torch
+from safetensors.torch import save_file
+
+from bhavesh_ai_voice_cloner.models.t3 import quantization
+from bhavesh_ai_voice_cloner.models.t3.quantization import _metadata, is_valid_quantized_checkpoint, quantized_checkpoint_path
+
+
+def test_quantized_checkpoint_invalidation(tmp_path, monkeypatch):
+    source = tmp_path / "t3_cfg.safetensors"
+    source.write_bytes(b"weights" * 100)
+    fpath = quantized_checkpoint_path(source, "int8")
+    assert fpath.name == "t3_cfg.int8.safetensors"
+    assert not is_valid_quantized_checkpoint(fpath, source)
+
+    save_file({"weight": torch.zeros(2)}, str(fpath), metadata=_metadata(source, "int8"))
+    assert is_valid_quantized_checkpoint(fpath, source)
+
+    # a new mtime alone (e.g. the checkpoint copied again) falls back to the hash of the content
+    stat = source.stat()
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert is_valid_quantized_checkpoint(fpath, source)
+
+    with monkeypatch.context() as m:
+        m.setattr(quantization, "QUANTIZATION_VERSION", quantization.QUANTIZATION_VERSION + 1)
+        assert not is_valid_quantized_checkpoint(fpath, source)
+
+    source.write_bytes(b"Weights" * 100)  # same size
+    assert not is_valid_quantized_checkpoint(fpath, source)
+    source.write_bytes(b"weights" * 101)
+    assert not is_valid_quantized_checkpoint(fpath, source)
+    source.write_bytes(b"weights" * 100)
+    assert is_valid_quantized_checkpoint(fpath, source)
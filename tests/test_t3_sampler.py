@@ -0,0 +1,84 @@
+"""
+`T3Sampler` against the HF logits processors that `T3.inference` used before it, and its bookkeeping of the
+sampled tokens (repetition penalty counts, rows of a changing batch).
+"""
+import pytest
+import torch
+from transformers.generation.logits_process import MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
+
+from bhavesh_ai_voice_cloner.models.t3.inference import T3Sampler
+
+
+VOCAB_SIZE = 64
+START_TOKEN = 60
+
+
+def hf_probs(logits, generated_ids, temperature, min_p, top_p, repetition_penalty, cfg_weight):
+    "The former recipe of `T3.inference` for one row: (1 or 2, vocab) logits -> (1, vocab) probs."
+    if cfg_weight > 0.0:
+        logits = logits[0:1] + cfg_weight * (logits[0:1] - logits[1:2])
+    if temperature != 1.0:
+        logits = logits / temperature
+    logits = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))(generated_ids, logits)
+    logits = MinPLogitsWarper(min_p=min_p)(None, logits)
+    logits = TopPLogitsWarper(top_p=top_p)(None, logits)
+    return torch.softmax(logits, dim=-1)
+
+
+def random_logits(n_rows, seed):
+    # peaked enough for min_p / top_p to keep a handful of tokens
+    return 4 * torch.randn(n_rows, VOCAB_SIZE, generator=torch.Generator().manual_seed(seed))
+
+
+PARAMS = [
+    dict(temperature=0.8, min_p=0.05, top_p=1.0, repetition_penalty=1.2, cfg_weight=0.5),  # the defaults
+    dict(temperature=1.0, min_p=0.0, top_p=0.8, repetition_penalty=2.0, cfg_weight=0.0),
+    dict(temperature=0.5, min_p=0.1, top_p=0.9, repetition_penalty=1.0, cfg_weight=1.0),
+]
+
+
+@pytest.mark.parametrize("params", PARAMS)
+def test_probs_match_hf_processors(params):
+    sampler = T3Sampler(VOCAB_SIZE, 8, START_TOKEN, **params)
+    n_rows = 2 if params["cfg_weight"] > 0 else 1
+    for step, token in enumerate([3, 7, 3, 12]):
+        logits = random_logits(n_rows, seed=step)
+        expected = hf_probs(logits, sampler.generated_ids, **params)
+        torch.testing.assert_close(sampler.probs(logits), expected, rtol=0, atol=1e-6)
+        sampler.append(torch.tensor([[token]]))
+
+
+def test_per_row_parameters():
+    # rows with different parameters sample as they would on their own, CFG rows next to a row without CFG
+    rows = [PARAMS[0], PARAMS[1], PARAMS[2]]
+    samplers = [T3Sampler(VOCAB_SIZE, 8, START_TOKEN, **params) for params in rows]
+    batched = T3Sampler(VOCAB_SIZE, 8, START_TOKEN, batch_size=3, **{k: [p[k] for p in rows] for k in rows[0]})
+    merged = T3Sampler.cat([T3Sampler(VOCAB_SIZE, 8, START_TOKEN, **params) for params in rows])
+    for step, tokens in enumerate([[3, 5, 7], [3, 3, 9]]):
+        logits = random_logits(6, seed=step)  # 3 conditional rows, then their unconditional rows
+        expected = torch.cat([
+            sampler.probs(logits[[i, 3 + i]] if params["cfg_weight"] > 0 else logits[i:i + 1])
+            for i, (sampler, params) in enumerate(zip(samplers, rows))
+        ])
+        torch.testing.assert_close(batched.probs(logits), expected)
+        torch.testing.assert_close(merged.probs(logits), expected)
+        for sampler, token in zip(samplers, tokens):
+            sampler.append(torch.tensor([[token]]))
+        batched.append(torch.tensor(tokens)[:, None])
+        merged.append(torch.tensor(tokens)[:, None])
+
+    # dropping a row keeps the parameters and counts of the others
+    merged.select_rows(torch.tensor([0, 2]))
+    logits = random_logits(4, seed=2)
+    torch.testing.assert_close(merged.probs(logits), torch.cat([samplers[0].probs(logits[[0, 2]]), samplers[2].probs(logits[[1, 3]])]))
+
+
+def test_truncate_restores_counts():
+    sampler = T3Sampler(VOCAB_SIZE, 8, START_TOKEN)
+    sampler.append(torch.tensor([[3, 7]]))
+    counts = sampler.token_counts.clone()
+    sampler.append(torch.tensor([[3, 3, 12]]))  # e.g. draft tokens
+    sampler.truncate(2)
+    assert sampler.n_generated == 2
+    assert torch.equal(sampler.generated_ids, torch.tensor([[START_TOKEN, 3, 7]]))
+    assert torch.equal(sampler.token_counts, counts)
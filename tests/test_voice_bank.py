@@ -0,0 +1,53 @@
+"""
+`VoiceBank`: voices appended in shards and read back, from the same bank and from another instance.
+"""
+import pytest
+import torch
+
+from bhavesh_ai_voice_cloner.voice_bank import VoiceBank
+
+
+def random_voice(seed):
+    generator = torch.Generator().manual_seed(seed)
+    return dict(
+        t3=dict(speaker_emb=torch.randn(1, 256, generator=generator), emotion_adv=0.5),
+        gen=dict(prompt_token=torch.randint(0, 6561, (1, 50), generator=generator), prompt_feat_len=None),
+    )
+
+
+def assert_voice_equal(states, expected):
+    assert states.keys() == expected.keys()
+    for group, values in expected.items():
+        assert states[group].keys() == values.keys()
+        for name, value in values.items():
+            if value is None:
+                assert states[group][name] is None
+            elif isinstance(value, float):
+                assert torch.equal(states[group][name], torch.full((1, 1, 1), value))
+            else:
+                assert torch.equal(states[group][name], value)
+
+
+def test_append_and_reload(tmp_path):
+    voices = {f"voice-{i}": random_voice(i) for i in range(3)}
+    writer = VoiceBank(tmp_path, max_shard_bytes=3000)  # two voices (1428 bytes each) per shard
+    writer.append(dict(list(voices.items())[:2]))
+    reader = VoiceBank(tmp_path)
+    assert reader.ids() == ["voice-0", "voice-1"]
+
+    writer.append(dict(list(voices.items())[2:]))
+    assert len(writer) == 3 and len(reader) == 2
+    reader.reload()
+    assert "voice-2" in reader
+    for voice_id, expected in voices.items():
+        assert_voice_equal(writer.load(voice_id), expected)
+        assert_voice_equal(reader.load(voice_id), expected)
+    assert len(writer._index["shards"]) == 2
+
+    with pytest.raises(ValueError):
+        writer.append({"voice-0": random_voice(3)})
+    writer.append({"voice-0": random_voice(3)}, overwrite=True)
+    reader.reload()
+    assert_voice_equal(reader.load("voice-0"), random_voice(3))
+    with pytest.raises(KeyError):
+        reader.load("voice-3")